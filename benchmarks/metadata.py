@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+# Measures how long it takes to parse and validate the metadata of userscripts
+# with many directives. Usage:
+#
+#     python benchmarks/metadata.py [DIRECTIVES ...]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import modules.metadata as metadata
+import modules.userscript as userscript
+
+DEFAULT_SIZES: list[int] = [100, 1000, 5000]
+REPETITIONS: int = 5
+
+
+def scriptWith(directives: int) -> str:
+    lines = ["// ==UserScript==", "// @name Benchmark"]
+    for i in range(directives):
+        if i % 3 == 0:
+            lines.append(f"// @match *://*.site{i}.example/*")
+        elif i % 3 == 1:
+            lines.append(f"// @include https://site{i}.example/page/*")
+        else:
+            lines.append(f"// @exclude https://site{i}.example/private/*")
+    lines.append("// @run-at document-start")
+    lines.append("// @run-at document-end") # duplicates of unique directives are ignored
+    lines.append("// ==/UserScript==")
+    return "\n".join(lines) + "\n"
+
+
+def main(sizes: list[int]) -> None:
+    for size in sizes:
+        content = scriptWith(size)
+        seconds = min(timeit.repeat(
+            lambda: userscript.validateMetadata(metadata.parse(metadata.extract(content))),
+            number=1,
+            repeat=REPETITIONS,
+        ))
+        print(f"{size:>8} directives: {1000 * seconds:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main([ int(arg) for arg in sys.argv[1:] ] or DEFAULT_SIZES)
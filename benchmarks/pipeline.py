@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Measures the injection pipeline end to end: UserscriptInjector.response is
+# driven in-process with mitmproxy test flows, on generated web pages and
+# userscripts, and loading userscripts at startup is measured on generated
+# directories. For each scenario, throughput, latency percentiles and peak
+# Python heap usage are reported. Usage:
+#
+#     python benchmarks/pipeline.py [--only TEXT] [--quick] [--save FILE] [--compare FILE]
+#
+# To see what a change does, save a baseline before the change and compare
+# against it after the change, on the same machine:
+#
+#     python benchmarks/pipeline.py --save /tmp/before.json
+#     python benchmarks/pipeline.py --compare /tmp/before.json
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, NamedTuple, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from mitmproxy import http
+from mitmproxy.test import taddons, tflow
+
+import injector
+import modules.arguments as A
+import modules.compiledcache as compiledcache
+import modules.logqueue as logqueue
+from modules.misc import sanitize
+
+KB: int = 1024
+MB: int = 1024 * KB
+
+PAGE_URL: str = "https://bench.example/articles/1"
+SEED: int = 1 # so that every run uses the same corpus
+SECONDS_PER_SCENARIO: float = 2.0
+MIN_OPS: int = 5
+MAX_OPS: int = 1000
+REGRESSION_THRESHOLD: float = 0.10 # relative; noise between runs is usually well below this
+
+STRUCTURE_FULL: str = "full" # DOCTYPE, <head> and <body>
+STRUCTURE_NO_DOCTYPE: str = "no-doctype"
+STRUCTURE_NO_HEAD: str = "no-head"
+STRUCTURE_FRAGMENT: str = "fragment" # no <html>, <head> or <body> at all
+
+TEXT: str = "Lorem ipsum dolor sit amet, café naïve façade, Ærø, 東京 日本語のテキスト. "
+
+
+class Result(NamedTuple):
+    opsPerSecond: float
+    p50: float # seconds
+    p99: float # seconds
+    peakBytes: int
+
+
+class Scenario(NamedTuple):
+    name: str
+    setUp: Callable[[], Callable[[], Callable[[], None]]] # returns a function that prepares one operation and returns it
+
+
+def pageWith(size: int, charset: str, structure: str) -> bytes:
+    rng = random.Random(SEED)
+    paragraphs: list[str] = []
+    length = 0
+    while length < size:
+        paragraph = f"""<div class="c{rng.randrange(100)}"><p>{TEXT * rng.randrange(1, 8)}</p><a href="/a/{rng.randrange(10**6)}">link</a></div>\n"""
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    body = "".join(paragraphs)
+    head = f"""<head><meta charset="{charset}"><title>Benchmark</title><link rel="stylesheet" href="/style.css"></head>"""
+    if structure == STRUCTURE_FULL:
+        html = f"<!DOCTYPE html>\n<html>{head}<body>{body}</body></html>\n"
+    elif structure == STRUCTURE_NO_DOCTYPE:
+        html = f"<html>{head}<body>{body}</body></html>\n"
+    elif structure == STRUCTURE_NO_HEAD:
+        html = f"<!DOCTYPE html>\n<html><body>{body}</body></html>\n"
+    else:
+        html = body
+    return html.encode(charset, "xmlcharrefreplace")
+
+
+# Every `applicableEvery`-th userscript applies to PAGE_URL; the rest match other sites, or are excluded from it.
+def userscriptWith(i: int, applicableEvery: int) -> str:
+    lines = [ "// ==UserScript==", f"// @name Benchmark {i}", f"// @version 1.{i}" ]
+    if i % applicableEvery == 0:
+        lines.append("// @match *://bench.example/*" if i % 2 == 0 else "// @include https://bench.example/articles/*")
+    elif i % 3 == 0:
+        lines.append(f"// @match *://*.site{i}.example/*")
+    elif i % 3 == 1:
+        lines.append(f"// @include https://site{i}.example/page/*")
+    else:
+        lines.append("// @match *://bench.example/*")
+        lines.append("// @exclude *://bench.example/articles/*")
+    if i % 4 == 3:
+        lines.append(f"// @downloadURL https://cdn.example/{i}.user.js")
+    if i % 5 == 4:
+        lines.append("// @run-at document-start")
+    lines.append("// ==/UserScript==")
+    code = f"(function () {{ const id = {i}; document.querySelectorAll('p').forEach(p => p.dataset.benchmark = id); }})();\n"
+    return "\n".join(lines) + "\n" + code * 20
+
+
+def writeUserscripts(directory: str, count: int, applicableEvery: int) -> None:
+    for i in range(count):
+        subdirectory = os.path.join(directory, f"group{i // 100}")
+        os.makedirs(subdirectory, exist_ok=True)
+        with open(os.path.join(subdirectory, f"benchmark{i}.user.js"), "w") as f:
+            f.write(userscriptWith(i, applicableEvery))
+
+
+# With `charsetInHeader` false, the page's charset is only declared by its <meta charset>.
+def flowWith(raw: bytes, charset: str, charsetInHeader: bool, gzipped: bool, acceptEncoding: Optional[str], csp: Optional[str]) -> http.HTTPFlow:
+    flow = tflow.tflow(resp=True)
+    flow.request.url = PAGE_URL
+    if acceptEncoding is not None:
+        flow.request.headers["Accept-Encoding"] = acceptEncoding
+    flow.response.headers["Content-Type"] = f"text/html; charset={charset}" if charsetInHeader else "text/html"
+    if csp is not None:
+        flow.response.headers["Content-Security-Policy"] = csp
+    flow.response.raw_content = raw
+    if gzipped:
+        flow.response.headers["Content-Encoding"] = "gzip"
+    return flow
+
+
+def responseScenario(
+    tctx: taddons.context,
+    addon: injector.UserscriptInjector,
+    directories: dict[int, str],
+    name: str,
+    size: int = 100 * KB,
+    charset: str = "utf-8",
+    charsetInHeader: bool = True,
+    structure: str = STRUCTURE_FULL,
+    scripts: int = 10,
+    engine: str = A.rewrite_engine_default,
+    gzipped: bool = False,
+    acceptEncoding: Optional[str] = None,
+    csp: Optional[str] = None,
+) -> Scenario:
+    def setUp() -> Callable[[], Callable[[], None]]:
+        tctx.configure(addon, **{
+            sanitize(A.userscripts_dir): directories[scripts],
+            sanitize(A.rewrite_engine): engine,
+        })
+        page = pageWith(size, charset, structure)
+        raw = gzip.compress(page, 6) if gzipped else page
+        def prepare() -> Callable[[], None]:
+            flow = flowWith(raw, charset, charsetInHeader, gzipped, acceptEncoding, csp)
+            return lambda: addon.response(flow)
+        return prepare
+    return Scenario(name, setUp)
+
+
+def loadScenario(directories: dict[int, str], name: str, scripts: int, warmCache: bool) -> Scenario:
+    def setUp() -> Callable[[], Callable[[], None]]:
+        warm = compiledcache.disabled() # i.e. only in memory
+        injector.loadUserscripts(directories[scripts], frozenset(), {}, warm)
+        def prepare() -> Callable[[], None]:
+            cache = warm if warmCache else compiledcache.disabled()
+            def operation() -> None:
+                injector.loadUserscripts(directories[scripts], frozenset(), {}, cache)
+            return operation
+        return prepare
+    return Scenario(name, setUp)
+
+
+def percentile(sortedValues: list[float], fraction: float) -> float:
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+
+
+def measure(scenario: Scenario, secondsPerScenario: float) -> Result:
+    prepare = scenario.setUp()
+    prepare()() # warm-up, e.g. for the applicable userscripts cache
+    latencies: list[float] = []
+    deadline = time.perf_counter() + secondsPerScenario
+    while len(latencies) < MIN_OPS or (len(latencies) < MAX_OPS and time.perf_counter() < deadline):
+        operation = prepare()
+        start = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - start)
+    # Separately, because tracing allocations slows everything down:
+    operation = prepare()
+    tracemalloc.start()
+    operation()
+    (_, peakBytes) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+    return Result(
+        opsPerSecond = len(latencies) / sum(latencies),
+        p50 = percentile(latencies, 0.50),
+        p99 = percentile(latencies, 0.99),
+        peakBytes = peakBytes,
+    )
+
+
+def scenarios(tctx: taddons.context, addon: injector.UserscriptInjector, directories: dict[int, str], quick: bool) -> list[Scenario]:
+    sizes = [ 1 * KB, 100 * KB, 1 * MB ] + ([] if quick else [ 10 * MB ])
+    result: list[Scenario] = []
+    for engine in sorted(A.rewrite_engine_values):
+        for size in sizes:
+            result.append(responseScenario(tctx, addon, directories, f"response/{engine}/size={size // KB}KB", size=size, engine=engine))
+    for charset in [ "utf-8", "windows-1252", "shift_jis", "utf-16" ]:
+        result.append(responseScenario(tctx, addon, directories, f"response/charset={charset}", charset=charset))
+    for engine in sorted(A.rewrite_engine_values):
+        result.append(responseScenario(tctx, addon, directories, f"response/{engine}/charset-in-meta-only", charset="windows-1252", charsetInHeader=False, engine=engine))
+    for structure in [ STRUCTURE_FULL, STRUCTURE_NO_DOCTYPE, STRUCTURE_NO_HEAD, STRUCTURE_FRAGMENT ]:
+        result.append(responseScenario(tctx, addon, directories, f"response/structure={structure}", structure=structure))
+    for count in sorted(directories):
+        result.append(responseScenario(tctx, addon, directories, f"response/scripts={count}", scripts=count))
+    result.append(responseScenario(tctx, addon, directories, "response/csp", csp="default-src 'self'; script-src 'self' https://cdn.example"))
+    result.append(responseScenario(tctx, addon, directories, "response/gzip-to-br", gzipped=True, acceptEncoding="gzip, deflate, br"))
+    for count in sorted(directories):
+        if count >= 10:
+            result.append(loadScenario(directories, f"load/scripts={count}/cold", count, warmCache=False))
+            result.append(loadScenario(directories, f"load/scripts={count}/cached", count, warmCache=True))
+    return result
+
+
+def comparison(current: float, baseline: float, higherIsBetter: bool) -> tuple[str, bool]:
+    if baseline == 0:
+        return ("", False)
+    change = (current - baseline) / baseline
+    worse = -change if higherIsBetter else change
+    return (f"{change:+7.1%}", worse > REGRESSION_THRESHOLD)
+
+
+HEADER: str = f"{'scenario':<36} {'ops/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'peak MiB':>9}"
+
+
+# Returns the line to print and whether the scenario got worse than the baseline.
+def reportLine(name: str, r: Result, old: Optional[Result]) -> tuple[str, bool]:
+    line = f"{name:<36} {r.opsPerSecond:>10.1f} {1000 * r.p50:>10.3f} {1000 * r.p99:>10.3f} {r.peakBytes / MB:>9.2f}"
+    if old is None:
+        return (line, False)
+    changes = [
+        comparison(r.opsPerSecond, old.opsPerSecond, higherIsBetter=True),
+        comparison(r.p50, old.p50, higherIsBetter=False),
+        comparison(r.p99, old.p99, higherIsBetter=False),
+        comparison(r.peakBytes, old.peakBytes, higherIsBetter=False),
+    ]
+    regressed = any(worse for _, worse in changes[:2] + changes[3:]) # p99 is too noisy to fail on
+    return (line + "   vs. baseline: " + " ".join(text for text, _ in changes) + ("   REGRESSED" if regressed else ""), regressed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the injection pipeline.")
+    parser.add_argument("--only", metavar="TEXT", help="Only run scenarios whose name contains TEXT")
+    parser.add_argument("--quick", action="store_true", help="Skip the largest pages and userscript directories")
+    parser.add_argument("--seconds", metavar="S", type=float, default=SECONDS_PER_SCENARIO, help=f"Time spent on each scenario (default: {SECONDS_PER_SCENARIO})")
+    parser.add_argument("--save", metavar="FILE", help="Save the results to FILE, to compare against later")
+    parser.add_argument("--compare", metavar="FILE", help=f"Compare the results to those saved in FILE, and exit with status 1 if any got more than {REGRESSION_THRESHOLD:.0%} worse")
+    args = parser.parse_args()
+    baseline: dict[str, Result] = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = { name: Result(*values) for name, values in json.load(f).items() }
+    # What the proxy would log is not what is being measured:
+    injector.LOGGER = logqueue.Logger(open(os.devnull, "w"), open(os.devnull, "w"))
+    addon = injector.UserscriptInjector()
+    results: dict[str, Result] = {}
+    with tempfile.TemporaryDirectory() as root, taddons.context(addon) as tctx:
+        directories: dict[int, str] = {}
+        for count in [ 1, 10, 100, 1000 ] + ([] if args.quick else [ 5000 ]):
+            directories[count] = os.path.join(root, str(count))
+            writeUserscripts(directories[count], count, applicableEvery=10)
+        tctx.configure(addon, **{
+            sanitize(A.no_default_userscripts): True,
+            sanitize(A.cache_dir): "",
+            sanitize(A.rewrite_workers): 0, # measured separately from the pool
+            sanitize(A.page_cache_size): 0, # so that every response is actually rewritten
+            sanitize(A.userscripts_dir): directories[1],
+        })
+        addon.running()
+        print(HEADER)
+        regressed: list[str] = []
+        for scenario in scenarios(tctx, addon, directories, args.quick):
+            if args.only is None or args.only in scenario.name:
+                results[scenario.name] = measure(scenario, args.seconds)
+                (line, worse) = reportLine(scenario.name, results[scenario.name], baseline.get(scenario.name))
+                print(line, flush=True)
+                if worse:
+                    regressed.append(scenario.name)
+    if len(regressed) > 0:
+        print(f"\n{len(regressed)} scenario(s) regressed by more than {REGRESSION_THRESHOLD:.0%}: {', '.join(regressed)}")
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump({ name: list(result) for name, result in results.items() }, f, indent=2)
+    sys.exit(1 if len(regressed) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
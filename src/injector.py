@@ -1,80 +1,92 @@
+import time
+IMPORTS_STARTED_AT: float = time.time() # before the other imports, so that they count towards the startup report
+
+import asyncio
 import functools
-import glob
+import gc
+import itertools
 import os
 import shlex
-from typing import Any, Callable, Iterable, Optional
+import signal
+import threading
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional
 
-from bs4 import BeautifulSoup, Comment, Doctype
-from mitmproxy import ctx, http
+from mitmproxy import ctx, exceptions, http
+from mitmproxy.net import tls
+from mitmproxy.proxy import protocol
 
 import modules.arguments as A
+import modules.charset as charset
 import modules.constants as C
+import modules.compiledcache as compiledcache
+import modules.compression as compression
 import modules.csp as csp
+import modules.hostrules as hostrules
 import modules.inject as inject
 import modules.inline as inline
+import modules.loading as loading
+import modules.logqueue as logqueue
+import modules.matching as matching
 import modules.metadata as metadata
+import modules.metrics as metrics
+import modules.pagecache as pagecache
+import modules.rewriting as rewriting
+import modules.serving as serving
+import modules.splice as splice
+import modules.startup as startup
+from modules.cache import LRUCache
 from modules.misc import sanitize
-from modules.requests import CONTENT_TYPE, containsQueryParam, inferEncoding
+from modules.requests import ACCEPT, ACCEPT_ENCODING, CHUNKED, CONTENT_ENCODING, CONTENT_LENGTH, CONTENT_TYPE, TRANSFER_ENCODING, VARY, containsQueryParam, inferEncoding
+import modules.streaming as streaming
 import modules.text as T
+import modules.tracing as tracing
 import modules.userscript as userscript
+import modules.watching as watching
+import modules.workers as workers
+from modules.settings import Settings
 from modules.userscript import Userscript
-from modules.utilities import first, flag, fromOptional, itemList, second
+from modules.utilities import first, flag, itemList, second
+
+IMPORTS_DONE_AT: float = time.time()
 
-PATTERN_USERSCRIPT: str = "*.user.js"
+PATTERN_USERSCRIPT: str = "*" + loading.USERSCRIPT_SUFFIX
 RELEVANT_CONTENT_TYPES: list[str] = ["text/html", "application/xhtml+xml"]
-CHARSET_DEFAULT: str = "utf-8"
-TAB: str = "    "
-LIST_ITEM_PREFIX: str = TAB + "• "
-HTML_PARSER: str = "lxml"
-# lxml handles non-uppercase DOCTYPE correctly; html.parser does not: It emits
-# <!DOCTYPE doctype html> if the original source code contained <!doctype html>.
-HTML_INFO_COMMENT_PREFIX: str = f"""
-[{T.INFO_MESSAGE}]
-"""
-
-
-def logInfo(s: str) -> None:
-    try:
-        ctx.log.info(s)
-    except Exception:
-        print(s)
+METADATA_TRACE: str = "userscript-proxy-trace" # key in flow.metadata
+TERMLOG_VERBOSITY: str = "termlog_verbosity" # mitmproxy's own option
+HEARTBEAT_INTERVAL_SECONDS: float = 5.0 # well below how long the supervisor waits for one
+DRAIN_CHECK_INTERVAL_SECONDS: float = 0.5
 
-def logWarning(s: str) -> None:
-    try:
-        ctx.log.warn(s)
-    except Exception:
-        print(s)
 
-def logError(s: str) -> None:
-    try:
-        ctx.log.error(s)
-    except Exception:
-        print(s)
+# Raises if mitmproxy is not running, e.g. when the event loop has already been closed at shutdown (see logqueue).
+def logToMitmproxy(level: str, message: str) -> None:
+    ctx.log(message, level)
+
+LOGGER = logqueue.Logger(sink=logToMitmproxy)
 
-def indexOfDTD(soup: BeautifulSoup) -> Optional[int]:
-    index: int = 0
-    for item in soup.contents:
-        if isinstance(item, Doctype):
-            return index
-        index += 1
-    return None
+def logInfo(s: str, category: str = logqueue.CATEGORY_GENERAL) -> None:
+    LOGGER.log(logqueue.LEVEL_INFO, s, category)
 
-bulletList: Callable[[Iterable[str]], str] = functools.partial(itemList, LIST_ITEM_PREFIX)
+def logWarning(s: str, category: str = logqueue.CATEGORY_GENERAL) -> None:
+    LOGGER.log(logqueue.LEVEL_WARN, s, category)
+
+def logError(s: str, category: str = logqueue.CATEGORY_GENERAL) -> None:
+    LOGGER.log(logqueue.LEVEL_ERROR, s, category)
 
 def unsafeSequencesMessage(script: Userscript) -> str:
     sequences = script.unsafeSequences
     return f"""{script.name} cannot be injected because it contains {"these unsafe sequences" if len(sequences) > 1 else "this unsafe sequence"}:
 
-{itemList(TAB, sequences)}
+{itemList(T.TAB, sequences)}
 
 <script> tags cannot contain any of these sequences (case-insensitive):
 
-{itemList(TAB, inline.DANGEROUS_SEQUENCES)}
+{itemList(T.TAB, inline.DANGEROUS_SEQUENCES)}
 
 Possible solutions:
-""" + bulletList([
+""" + T.bulletList([
     f"Make sure the userscript does not contain any of the sequences listed above.",
     f"Make the userscript available online and give it a {metadata.tag(userscript.directive_downloadURL)}",
+    f"Use the {flag(A.serve_userscripts)} flag.",
     f"Remove the {flag(A.inline)} flag.",
 ])
 
@@ -85,63 +97,209 @@ def option(key: str) -> Any:
     return ctx.options.__getattr__(sanitize(key))
 
 
-def loadUserscripts(directory: str) -> list[Userscript]:
-    loadedUserscripts: list[tuple[Userscript, str]] = []
-    workingDirectory = os.getcwd()
+def skipDirs() -> frozenset[str]:
+    return loading.skipDirsFrom(option(A.skip_dirs))
+
+
+# What we know about a userscript file, so that it only has to be parsed again if it has actually changed:
+class UserscriptFile(NamedTuple):
+    state: watching.FileState
+    digest: str # of the content
+    loaded: Optional[tuple[Userscript, inject.Payloads]] # None if the file could not be loaded
+
+
+def loadUserscript(compiled: loading.ParseResult, content: str, digest: str, cache: compiledcache.CompiledCache) -> Optional[tuple[Userscript, inject.Payloads]]:
+    if isinstance(compiled, metadata.MetadataError):
+        logError("Metadata error:")
+        logError(str(compiled))
+        return None
+    cache.put(digest, compiled)
+    script = userscript.fromCompiled(content, compiled)
+    if script.downloadURL is None:
+        logWarning(f"""{script.name} will be injected inline because it does not have a {metadata.tag(userscript.directive_downloadURL)}.""")
+    if script.downloadURL is None and len(script.unsafeSequences) > 0 and not option(A.serve_userscripts):
+        logError(unsafeSequencesMessage(script))
+    return (script, inject.payloadsFor(script))
+
+
+# Only files that are new or have changed since `previous` are read and parsed.
+def loadUserscripts(directory: str, skipDirs: frozenset[str], previous: dict[str, UserscriptFile], cache: compiledcache.CompiledCache) -> dict[str, UserscriptFile]:
+    files: dict[str, UserscriptFile] = {}
     logInfo(f"""Looking recursively for userscripts ({PATTERN_USERSCRIPT}) in directory `{directory}` ...""")
-    os.chdir(directory)
-    pattern = "**/" + PATTERN_USERSCRIPT
-    # recursive=True only affects the meaning of "**".
-    # https://docs.python.org/3/library/glob.html#glob.glob
-    for unsafe_filename in glob.glob(pattern, recursive=True):
-        filename = shlex.quote(unsafe_filename)
-        logInfo("Loading " + filename + " ...")
+    reads = loading.readFiles(
+        loading.userscriptPathsIn(directory, skipDirs),
+        { path: f.state for path, f in previous.items() },
+    )
+    changed: list[tuple[str, watching.FileState, str, str]] = [] # path, state, digest, content
+    for read in reads:
+        filename = shlex.quote(os.path.relpath(read.path, directory))
+        old = previous.get(read.path)
         try:
-            content = open(filename).read()
+            if read.error is not None:
+                raise read.error
+            if read.raw is None or read.state is None or read.digest is None:
+                if old is not None:
+                    files[read.path] = old # unchanged
+                continue
+            if old is not None and old.digest == read.digest:
+                files[read.path] = old._replace(state=read.state) # e.g. touched
+                continue
+            changed.append((read.path, read.state, read.digest, read.raw.decode()))
         except PermissionError:
             logError("Could not read file `"+filename+"`: Permission denied.")
-            continue
         except Exception as e:
             logError("Could not read file `"+filename+"`: " + str(e))
-            continue
-        try:
-            script = userscript.create(content)
-            if script.downloadURL is None:
-                logWarning(f"""{script.name} will be injected inline because it does not have a {metadata.tag(userscript.directive_downloadURL)}.""")
-            loadedUserscripts.append((script, filename))
-            if script.downloadURL is None and len(script.unsafeSequences) > 0:
-                logError(unsafeSequencesMessage(script))
-        except metadata.MetadataError as err:
-            logError("Metadata error:")
-            logError(str(err))
-            continue
-    os.chdir(workingDirectory) # so mitmproxy does not unload the script
+    # Only what is not in the cache needs to be parsed:
+    cached = [ cache.get(digest) for (_, _, digest, _) in changed ]
+    compiled = iter(loading.compileAll([ content for (_, _, _, content), fromCache in zip(changed, cached) if fromCache is None ]))
+    for (path, state, digest, content), fromCache in zip(changed, cached):
+        logInfo("Loading " + shlex.quote(os.path.relpath(path, directory)) + " ...")
+        files[path] = UserscriptFile(
+            state = state,
+            digest = digest,
+            loaded = loadUserscript(next(compiled) if fromCache is None else fromCache, content, digest, cache),
+        )
+    files = { read.path: files[read.path] for read in reads if read.path in files } # in path order
+    for path in previous:
+        if path not in files:
+            logInfo("Unloading " + shlex.quote(os.path.relpath(path, directory)) + " ...")
+    loadedUserscripts = [ (f.loaded[0], path) for path, f in files.items() if f.loaded is not None ]
     logInfo("")
     logInfo(str(len(loadedUserscripts)) + " userscript(s) loaded:")
     logInfo("")
-    logInfo(bulletList(map(
-        lambda s: f"{first(s).name} ({second(s)})",
+    logInfo(T.bulletList(map(
+        lambda s: f"{first(s).name} ({shlex.quote(os.path.relpath(second(s), directory))})",
         loadedUserscripts
     )))
     logInfo("")
-    return list(map(first, loadedUserscripts))
+    return files
+
+
+# Everything derived from one particular set of loaded userscripts. Never
+# modified; a new generation is created instead, so that responses that are
+# already being handled can keep using the one they started with.
+class LoadedUserscripts(NamedTuple):
+    generation: int # bumped whenever the set of userscripts changes
+    userscripts: list[Userscript]
+    payloads: list[inject.Payloads] # same order as userscripts
+    matchIndex: matching.MatchIndex
+    served: list[serving.ServedScript] # same order as userscripts
+    servedByDigest: dict[str, serving.ServedScript]
+
+
+def loadedUserscripts(generation: int, files: Iterable[UserscriptFile]) -> LoadedUserscripts:
+    loaded = [ f.loaded for f in files if f.loaded is not None ]
+    userscripts = [ script for (script, _) in loaded ]
+    served = [ serving.servedScript(payloads) for (_, payloads) in loaded ]
+    return LoadedUserscripts(
+        generation = generation,
+        userscripts = userscripts,
+        payloads = [ payloads for (_, payloads) in loaded ],
+        matchIndex = matching.index(userscripts),
+        served = served,
+        servedByDigest = { s.digest: s for s in served },
+    )
+
+
+def currentSettings() -> Settings:
+    return Settings(
+        inline = option(A.inline),
+        listInjected = option(A.list_injected),
+        bypassCsp = option(A.bypass_csp),
+        cspHashes = option(A.csp_hashes),
+        queryParamToDisable = option(A.query_param_to_disable),
+        rewriteEngine = option(A.rewrite_engine),
+        streamThreshold = option(A.stream_threshold),
+        upstreamEncoding = option(A.upstream_encoding),
+        compressionLevel = option(A.compression_level),
+        lanCompressionLevel = option(A.lan_compression_level),
+        serveUserscripts = option(A.serve_userscripts),
+        bundleUserscripts = option(A.bundle_userscripts),
+    )
 
 
 class UserscriptInjector:
     def __init__(self) -> None:
-        self.userscripts: list[Userscript] = []
+        self.loaded: LoadedUserscripts = loadedUserscripts(0, [])
+        self.defaultFiles: dict[str, UserscriptFile] = {}
+        self.customFiles: dict[str, UserscriptFile] = {}
+        self.reloadLock = threading.Lock()
+        self.watcher: Optional[watching.Watcher] = None
+        self.compiledCache: compiledcache.CompiledCache = compiledcache.disabled()
+        self.compressionStats = compression.Stats()
+        self.rewritePool: Optional[workers.WorkerPool] = None
+        self.eventLoop: Optional[asyncio.AbstractEventLoop] = None
+        self.settings: Optional[Settings] = None
+        self.applicableCache: LRUCache[tuple[int, str], list[int]] = LRUCache(A.url_cache_size_default)
+        self.cspCache: LRUCache[tuple[str, tuple[str, ...]], str] = LRUCache(csp.CACHE_SIZE)
+        self.pageCache = pagecache.PageCache(0, None)
+        self.pagesInFlight: dict[pagecache.PageKey, list[tuple[http.HTTPFlow, Settings, float]]] = {} # flows waiting for the same page to be rewritten
+        self.bundles = serving.Bundles()
+        self.metrics = metrics.Metrics()
+        self.metricsExporter: Optional[metrics.Exporter] = None
+        self.tracer: Optional[tracing.Tracer] = None
+        self.hostRules: Optional[hostrules.HostRules] = None # None means that all traffic is intercepted
+        self.interceptMatchedHosts = False
+        self.rulesWatcher: Optional[watching.Watcher] = None
+        self.isRunning = False
+        self.draining = False
+        self.startupReport = startup.Report(IMPORTS_STARTED_AT, IMPORTS_DONE_AT)
 
 
     def load(self, loader: Any) -> None:
+        loader.add_option(sanitize(A.rules), Optional[str], None, A.rules_help)
+        loader.add_option(sanitize(A.no_default_rules), bool, False, A.no_default_rules_help)
+        loader.add_option(sanitize(A.intercept_rules), bool, False, A.intercept_help)
         loader.add_option(sanitize(A.inline), bool, False, A.inline_help)
         loader.add_option(sanitize(A.no_default_userscripts), bool, False, A.no_default_userscripts_help)
         loader.add_option(sanitize(A.list_injected), bool, False, A.list_injected_help)
         loader.add_option(sanitize(A.bypass_csp), Optional[str], A.bypass_csp_default, A.bypass_csp_help)
+        loader.add_option(sanitize(A.csp_hashes), bool, False, A.csp_hashes_help)
+        loader.add_option(sanitize(A.fast_start), bool, False, A.fast_start_help)
         loader.add_option(sanitize(A.userscripts_dir), Optional[str], A.userscripts_dir_default, A.userscripts_dir_help)
         loader.add_option(sanitize(A.query_param_to_disable), str, A.query_param_to_disable_default, A.query_param_to_disable_help)
+        loader.add_option(sanitize(A.rewrite_engine), str, A.rewrite_engine_default, A.rewrite_engine_help)
+        loader.add_option(sanitize(A.stream_threshold), Optional[int], A.stream_threshold_default, A.stream_threshold_help)
+        loader.add_option(sanitize(A.url_cache_size), int, A.url_cache_size_default, A.url_cache_size_help)
+        loader.add_option(sanitize(A.watch), bool, False, A.watch_help)
+        loader.add_option(sanitize(A.cache_dir), Optional[str], A.cache_dir_default, A.cache_dir_help)
+        loader.add_option(sanitize(A.skip_dirs), str, A.skip_dirs_default, A.skip_dirs_help)
+        loader.add_option(sanitize(A.serve_userscripts), bool, False, A.serve_userscripts_help)
+        loader.add_option(sanitize(A.bundle_userscripts), bool, False, A.bundle_userscripts_help)
+        loader.add_option(sanitize(A.metrics_dir), Optional[str], A.metrics_dir_default, A.metrics_dir_help)
+        loader.add_option(sanitize(A.metrics_name), Optional[str], A.metrics_name_default, A.metrics_name_help)
+        loader.add_option(sanitize(A.upstream_encoding), Optional[str], A.upstream_encoding_default, A.upstream_encoding_help)
+        loader.add_option(sanitize(A.compression_level), int, A.compression_level_default, A.compression_level_help)
+        loader.add_option(sanitize(A.lan_compression_level), int, A.lan_compression_level_default, A.lan_compression_level_help)
+        loader.add_option(sanitize(A.rewrite_workers), int, A.rewrite_workers_default, A.rewrite_workers_help)
+        loader.add_option(sanitize(A.rewrite_pool), str, A.rewrite_pool_default, A.rewrite_pool_help)
+        loader.add_option(sanitize(A.rewrite_queue), int, A.rewrite_queue_default, A.rewrite_queue_help)
+        loader.add_option(sanitize(A.page_cache_size), int, A.page_cache_size_default, A.page_cache_size_help)
+        loader.add_option(sanitize(A.page_cache_dir), Optional[str], A.page_cache_dir_default, A.page_cache_dir_help)
+        loader.add_option(sanitize(A.trace_file), Optional[str], A.trace_file_default, A.trace_file_help)
+        loader.add_option(sanitize(A.heartbeat_file), Optional[str], A.heartbeat_file_default, A.heartbeat_file_help)
+        loader.add_option(sanitize(A.trace_sample), int, A.trace_sample_default, A.trace_sample_help)
+        loader.add_option(sanitize(A.trace_slow_ms), int, A.trace_slow_ms_default, A.trace_slow_ms_help)
+        loader.add_option(sanitize(A.log_levels), str, A.log_levels_default, A.log_levels_help)
+        loader.add_option(sanitize(A.log_sample), str, A.log_sample_default, A.log_sample_help)
 
 
     def configure(self, updates: Any) -> None:
+        if TERMLOG_VERBOSITY in updates:
+            verbosity: str = ctx.options.__getattr__(TERMLOG_VERBOSITY)
+            LOGGER.verbosity = verbosity if verbosity in logqueue.LEVELS else logqueue.LEVEL_INFO # debug and alert are never used here
+        if sanitize(A.log_levels) in updates:
+            try:
+                LOGGER.levels = logqueue.levelsFrom(option(A.log_levels))
+            except ValueError as e:
+                logWarning(f"Ignoring {flag(A.log_levels)}: {e}")
+                LOGGER.levels = {}
+        if sanitize(A.log_sample) in updates:
+            try:
+                LOGGER.samples = logqueue.samplesFrom(option(A.log_sample))
+            except ValueError as e:
+                logWarning(f"Ignoring {flag(A.log_sample)}: {e}")
+                LOGGER.samples = {}
         useDefaultUserscripts = True
         if sanitize(A.no_default_userscripts) in updates and option(A.no_default_userscripts):
             logInfo(f"""Built-in default userscripts will be skipped due to {flag(A.no_default_userscripts)} flag.""")
@@ -150,86 +308,695 @@ class UserscriptInjector:
             logWarning(f"""Only inline injection will be used due to {flag(A.inline)} flag.""")
         if sanitize(A.query_param_to_disable) in updates:
             logInfo(f"""Userscripts will not be injected when the request URL contains a `{option(A.query_param_to_disable)}` query parameter.""")
-        if sanitize(A.userscripts_dir) in updates:
-            userscripts = loadUserscripts(C.DEFAULT_USERSCRIPTS_DIR) if useDefaultUserscripts else []
-            userscriptsDirectory = option(A.userscripts_dir)
-            if userscriptsDirectory is None:
-                logWarning(f"No custom userscripts will be loaded, because {flag(A.userscripts_dir)} was not provided.")
-            else:
-                userscripts.extend(loadUserscripts(userscriptsDirectory))
-            self.userscripts = userscripts
+        if sanitize(A.url_cache_size) in updates:
+            self.applicableCache = LRUCache(option(A.url_cache_size))
+        if sanitize(A.metrics_dir) in updates or sanitize(A.metrics_name) in updates:
+            self.restartMetricsExporter()
+        if any(sanitize(key) in updates for key in [ A.trace_file, A.trace_sample, A.trace_slow_ms ]):
+            self.restartTracer()
+        if sanitize(A.page_cache_size) in updates or sanitize(A.page_cache_dir) in updates:
+            self.restartPageCache()
+        if any(sanitize(key) in updates for key in [ A.rules, A.no_default_rules, A.intercept_rules ]):
+            started = time.perf_counter()
+            self.reloadHostRules()
+            self.startupReport.add(startup.PHASE_HOST_RULES, time.perf_counter() - started)
+        if any(sanitize(key) in updates for key in [ A.rules, A.no_default_rules, A.intercept_rules, A.watch ]):
+            self.restartRulesWatcher()
+        if sanitize(A.cache_dir) in updates:
+            cacheDirectory: Optional[str] = option(A.cache_dir)
+            self.compiledCache = compiledcache.disabled() if cacheDirectory is None or cacheDirectory == "" else compiledcache.load(cacheDirectory)
+        if sanitize(A.userscripts_dir) in updates or sanitize(A.skip_dirs) in updates:
+            started = time.perf_counter()
+            with self.reloadLock:
+                self.defaultFiles = loadUserscripts(C.DEFAULT_USERSCRIPTS_DIR, skipDirs(), {}, self.compiledCache) if useDefaultUserscripts else {}
+                userscriptsDirectory = option(A.userscripts_dir)
+                if userscriptsDirectory is None:
+                    logWarning(f"No custom userscripts will be loaded, because {flag(A.userscripts_dir)} was not provided.")
+                    self.customFiles = {}
+                else:
+                    self.customFiles = loadUserscripts(userscriptsDirectory, skipDirs(), {}, self.compiledCache)
+                self.saveCompiledCache(itertools.chain(self.defaultFiles.values(), self.customFiles.values()))
+                self.swapInUserscripts()
+            self.startupReport.add(startup.PHASE_USERSCRIPTS, time.perf_counter() - started)
+        if sanitize(A.watch) in updates or sanitize(A.userscripts_dir) in updates or sanitize(A.skip_dirs) in updates:
+            self.restartWatcher()
+        if any(sanitize(key) in updates for key in [ A.rewrite_workers, A.rewrite_pool, A.rewrite_queue ]):
+            self.restartRewritePool()
+        self.settings = currentSettings()
+
+
+    def swapInUserscripts(self) -> None:
+        # A single assignment, so every response sees either the old generation or the new one, never a mix:
+        self.loaded = loadedUserscripts(self.loaded.generation + 1, itertools.chain(self.defaultFiles.values(), self.customFiles.values()))
+        self.applicableCache.clear()
+        self.bundles.clear()
+
+
+    # Called with reloadLock held.
+    def saveCompiledCache(self, files: Iterable[UserscriptFile]) -> None:
+        try:
+            self.compiledCache.save(f.digest for f in files)
+        except OSError as e:
+            logWarning(f"Could not save compiled userscripts to {flag(A.cache_dir)}: {e}")
+
+
+    def restartWatcher(self) -> None:
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        userscriptsDirectory: Optional[str] = option(A.userscripts_dir)
+        if option(A.watch) and userscriptsDirectory is not None:
+            # The options are read on the event loop, so that is where reloading starts:
+            loop = asyncio.get_event_loop()
+            directory: str = userscriptsDirectory
+            self.watcher = watching.Watcher(
+                [ directory ],
+                listFiles = functools.partial(loading.userscriptPathsIn, directory, skipDirs=skipDirs()),
+                onChange = lambda: loop.call_soon_threadsafe(self.reloadUserscripts, directory),
+            )
+            self.watcher.start()
+            logInfo(f"""Userscripts in `{directory}` will be reloaded when they change due to {flag(A.watch)} flag.""")
+
+
+    def restartRulesWatcher(self) -> None:
+        if self.rulesWatcher is not None:
+            self.rulesWatcher.stop()
+            self.rulesWatcher = None
+        pattern: Optional[str] = option(A.rules)
+        if option(A.watch) and pattern is not None:
+            loop = asyncio.get_event_loop()
+            useDefaultRules: bool = not option(A.no_default_rules)
+            useIntercept: bool = option(A.intercept_rules)
+            self.rulesWatcher = watching.Watcher(
+                hostrules.watchedDirectories(hostrules.rulePatterns(pattern, useDefaultRules, useIntercept)),
+                listFiles = lambda: hostrules.ruleFiles(pattern, useDefaultRules, useIntercept),
+                onChange = lambda: loop.call_soon_threadsafe(self.reloadHostRules),
+            )
+            self.rulesWatcher.start()
+
+
+    def reloadHostRules(self) -> None:
+        pattern: Optional[str] = option(A.rules)
+        useDefaultRules: bool = not option(A.no_default_rules)
+        if self.hostRules is not None:
+            logInfo(f"Host rules until now: {hostrules.summary(self.hostRules)}")
+        if pattern is None and not useDefaultRules:
+            self.hostRules = None
+            return
+        files = hostrules.ruleFiles(pattern, useDefaultRules, option(A.intercept_rules))
+        try:
+            (loaded, errors) = hostrules.load(files)
+        except OSError as e:
+            logError(f"Could not read rules, so the ones read before are still used: {e}")
+            return
+        for error in errors:
+            logError(error)
+        # A single assignment each, and both are only read on the event loop, so no connection sees a mix:
+        self.hostRules = loaded
+        self.interceptMatchedHosts = option(A.intercept_rules)
+        patterns = len(loaded.regexes)
+        logInfo(f"""{len(loaded.rules)} rules loaded from {len(files)} file(s) ({len(loaded.rules) - patterns - len(errors)} by host, {patterns} by pattern); traffic from matching hosts will be {"intercepted" if self.interceptMatchedHosts else "ignored"}.""")
+
+
+    def restartRewritePool(self) -> None:
+        if self.rewritePool is not None:
+            self.rewritePool.shutdown() # Jobs already submitted still finish.
+            self.rewritePool = None
+        if option(A.rewrite_workers) > 0:
+            self.eventLoop = asyncio.get_event_loop()
+            self.rewritePool = workers.WorkerPool(option(A.rewrite_pool), option(A.rewrite_workers), max(1, option(A.rewrite_queue)))
+
+
+    def restartMetricsExporter(self) -> None:
+        if self.metricsExporter is not None:
+            self.metricsExporter.stop()
+            self.metricsExporter = None
+        directory: Optional[str] = option(A.metrics_dir)
+        name: Optional[str] = option(A.metrics_name)
+        if directory is not None and directory != "":
+            self.metricsExporter = metrics.Exporter(directory, str(os.getpid()) if name is None else name, self.metrics)
+            self.metricsExporter.start()
+
+
+    def restartTracer(self) -> None:
+        if self.tracer is not None:
+            self.tracer.stop()
+            self.tracer = None
+        path: Optional[str] = option(A.trace_file)
+        if path is not None and path != "":
+            writer = tracing.TraceWriter(path)
+            writer.start()
+            self.tracer = tracing.Tracer(writer, option(A.trace_sample), option(A.trace_slow_ms) / 1000)
+            logInfo(f"""Trace records of {"every web page" if option(A.trace_sample) <= 1 else "one in every " + str(option(A.trace_sample)) + " web pages"} will be written to `{path}`.""")
+
+
+    def restartPageCache(self) -> None:
+        spillDirectory: Optional[str] = option(A.page_cache_dir) or None
+        try:
+            self.pageCache = pagecache.PageCache(option(A.page_cache_size), spillDirectory)
+        except OSError as e:
+            logWarning(f"Could not use {flag(A.page_cache_dir)} `{spillDirectory}`, so rewritten pages are only cached in memory: {e}")
+            self.pageCache = pagecache.PageCache(option(A.page_cache_size), None)
+
+
+    # Runs on the event loop. The userscripts are read and parsed in an executor, so that the proxy keeps handling flows in the meantime with the current generation.
+    def reloadUserscripts(self, directory: str) -> None:
+        if option(A.userscripts_dir) != directory:
+            return # changed while the reload was pending
+        logInfo(f"Userscripts in `{directory}` have changed; reloading ...")
+        future = asyncio.get_event_loop().run_in_executor(None, self.loadChangedUserscripts, directory, skipDirs())
+        future.add_done_callback(lambda f: self.finishReload(directory, f))
+
+
+    # Runs in an executor. Reloads that overlap are done one after the other, and each one reads what is on disk when it runs.
+    def loadChangedUserscripts(self, directory: str, skipDirs: frozenset[str]) -> dict[str, UserscriptFile]:
+        with self.reloadLock:
+            files = loadUserscripts(directory, skipDirs, self.customFiles, self.compiledCache)
+            self.saveCompiledCache(itertools.chain(self.defaultFiles.values(), files.values()))
+            return files
+
+
+    # Runs on the event loop, in the order the reloads were started.
+    def finishReload(self, directory: str, future: asyncio.Future) -> None:
+        try:
+            files: dict[str, UserscriptFile] = future.result()
+        except Exception as e:
+            logError(f"Could not reload userscripts in `{directory}`: {e!r}")
+            return
+        if option(A.userscripts_dir) != directory:
+            return # changed while reloading
+        self.customFiles = files
+        self.swapInUserscripts()
+
+
+    # mitmproxy calls this right after loading the script, before configuring it, and again once all addons are loaded.
+    # Either way, the proxy is up once the current callback, which includes configuring, has finished.
+    def running(self) -> None:
+        if not self.isRunning:
+            self.isRunning = True
+            asyncio.get_event_loop().call_soon(self.startRunning)
+
+
+    # Everything logged until now (e.g. which userscripts were loaded) has been written right away.
+    def startRunning(self) -> None:
+        if not option(A.fast_start):
+            self.warmUp()
+        logInfo(f"Startup: {self.startupReport.summary(time.time())}")
+        LOGGER.goAsynchronous(asyncio.get_event_loop())
+        self.beat()
+        try:
+            asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, self.drain)
+        except NotImplementedError:
+            pass # not supported on Windows
+        if option(A.fast_start):
+            # Connections are already being handled; a page that needs the parser before this is done just waits for the import.
+            future = asyncio.get_event_loop().run_in_executor(None, self.warmUp)
+            future.add_done_callback(lambda _: self.freezeLongLivedObjects())
+
+
+    def warmUp(self) -> None:
+        started = time.perf_counter()
+        try:
+            rewriting.warmUp()
+        except Exception as e:
+            logWarning(f"Could not warm up the rewriting engines: {e}")
+        self.startupReport.add(startup.PHASE_WARM_UP, time.perf_counter() - started)
+
+
+    # What is still there after startup (modules, userscripts, rules) mostly stays until the proxy exits, so the garbage collector need not keep traversing it.
+    def freezeLongLivedObjects(self) -> None:
+        gc.collect()
+        gc.freeze()
+        logInfo(f"Warmed up in {self.startupReport.phases[startup.PHASE_WARM_UP]:.3f} s; {gc.get_freeze_count()} objects exempted from garbage collection.")
+
+
+    # Runs on the event loop, so the heartbeat stops if the event loop gets stuck.
+    def beat(self) -> None:
+        path: Optional[str] = option(A.heartbeat_file)
+        if path is None or path == "":
+            return
+        try:
+            with open(path, "a"):
+                pass
+            os.utime(path)
+        except OSError:
+            pass # The supervisor will notice if this keeps failing.
+        asyncio.get_event_loop().call_later(HEARTBEAT_INTERVAL_SECONDS, self.beat)
+
+
+    # On SIGUSR1, when a replacement is listening on the same port: stop accepting connections, so that the replacement gets all new ones, and exit once the open ones are closed.
+    # The supervisor stops the proxy anyway if that takes too long.
+    # Closing the listening socket resets connections still waiting to be accepted, unless net.ipv4.tcp_migrate_req hands them to the replacement.
+    def drain(self) -> None:
+        server = ctx.master.server
+        if self.draining or not hasattr(server, "handler_counter"):
+            return
+        self.draining = True
+        logInfo(f"Draining: no longer accepting connections; exiting once the {server.handler_counter.count} open one(s) are closed.")
+        # Waits for the accept loop to notice, so it must not block the event loop:
+        future = asyncio.get_event_loop().run_in_executor(None, server.shutdown)
+        future.add_done_callback(lambda _: self.exitWhenIdle(server))
+
+
+    def exitWhenIdle(self, server: Any) -> None:
+        if server.handler_counter.count == 0:
+            logInfo("All connections are closed; exiting.")
+            ctx.master.shutdown()
+        else:
+            asyncio.get_event_loop().call_later(DRAIN_CHECK_INTERVAL_SECONDS, self.exitWhenIdle, server)
+
+
+    def done(self) -> None:
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.rewritePool is not None:
+            self.rewritePool.shutdown()
+        if self.metricsExporter is not None:
+            self.metricsExporter.stop()
+        if self.tracer is not None:
+            self.tracer.stop()
+        if self.rulesWatcher is not None:
+            self.rulesWatcher.stop()
+        if self.hostRules is not None:
+            logInfo(f"Host rules: {hostrules.summary(self.hostRules)}")
+        logInfo(f"Applicable userscripts cache: {self.applicableCache.summary()}")
+        logInfo(f"Content-Security-Policy cache: {self.cspCache.summary()}")
+        logInfo(f"Compression: {self.compressionStats.summary()}")
+        logInfo(f"Page cache: {self.pageCache.summary()}")
+        LOGGER.stop()
+
+
+    # mitmproxy proposes the first layer of every tunnel here, whether it carries TLS or not (usually a TlsLayer, even
+    # without TLS); this is where it is decided whether to ignore the connection, as mitmproxy does with --ignore-hosts:
+    # the server address is checked first, then the SNI of a TLS client as (sni, 443). Layers inside a TlsLayer belong
+    # to a connection that has already been decided on.
+    def next_layer(self, layer: Any) -> None:
+        hostRules = self.hostRules
+        if hostRules is None or isinstance(layer.ctx, protocol.TlsLayer) or (isinstance(layer, protocol.RawTCPLayer) and layer.ignore):
+            return
+        address = layer.server_conn.address
+        if address and hostrules.lookup(hostRules, address[0], address[1]) is not None:
+            self.decideConnection(layer, True)
+        elif isTlsClient(layer):
+            # Reading the SNI blocks until the client has sent it, which may be never. So, like mitmproxy itself does, it is
+            # read in a thread of the connection's own rather than on the event loop or in a shared pool, where a few
+            # silent clients would hold up every other connection:
+            layer.reply.take()
+            loop = asyncio.get_event_loop()
+            threading.Thread(
+                target = lambda: deliverSni(loop, layer.client_conn, lambda sni: self.decideConnectionBySni(layer, hostRules, sni)),
+                daemon = True,
+            ).start()
+        elif address:
+            self.decideConnection(layer, False)
+
+
+    def decideConnectionBySni(self, layer: Any, hostRules: hostrules.HostRules, sni: Optional[str]) -> None:
+        matched = sni is not None and hostrules.lookup(hostRules, sni, hostrules.SNI_PORT) is not None
+        if matched or layer.server_conn.address:
+            self.decideConnection(layer, matched)
+        else:
+            sendReply(layer) # Like mitmproxy, a connection without a known server is never ignored just because nothing matched.
+
+
+    def decideConnection(self, layer: Any, matched: bool) -> None:
+        ignored = matched != self.interceptMatchedHosts
+        self.metrics.count(metrics.CONNECTIONS, { "decision": metrics.DECISION_IGNORED if ignored else metrics.DECISION_INTERCEPTED })
+        if ignored:
+            layer.reply.send(protocol.RawTCPLayer(layer.ctx, ignore=True))
+        sendReply(layer)
+
+
+    # Returns positions in loaded.userscripts.
+    def applicableUserscripts(self, loaded: LoadedUserscripts, url: str) -> list[int]:
+        key = (loaded.generation, url)
+        cached = self.applicableCache.get(key)
+        if cached is not None:
+            return cached
+        isApplicable: Callable[[Userscript], bool] = userscript.applicableChecker(url)
+        applicable = [ position for position in matching.lookupPositions(loaded.matchIndex, url) if isApplicable(loaded.userscripts[position]) ]
+        self.applicableCache.put(key, applicable)
+        return applicable
+
+
+    def candidatesFor(self, flow: http.HTTPFlow, settings: Settings) -> Optional[list[csp.Injection]]:
+        requestURL = flow.request.pretty_url # should work in transparent mode too, unless the Host header is spoofed
+        if containsQueryParam(settings.queryParamToDisable, flow.request):
+            logInfo(f"""Not injecting any userscripts into {requestURL} because it contains a `{settings.queryParamToDisable}` query parameter.""", logqueue.CATEGORY_PAGE)
+            return None
+        loaded = self.loaded
+        candidates: list[csp.Injection] = []
+        served: list[Optional[serving.ServedScript]] = [] # same order as candidates
+        for position in self.applicableUserscripts(loaded, requestURL):
+            script = loaded.userscripts[position]
+            useInline = settings.inline or script.downloadURL is None
+            useServed = useInline and settings.serveUserscripts # Served scripts are not part of the page, so they may contain anything.
+            if useInline and not useServed and len(script.unsafeSequences) > 0:
+                logError(unsafeSequencesMessage(script), logqueue.CATEGORY_PAGE)
+                continue
+            if LOGGER.wants(logqueue.LEVEL_INFO, logqueue.CATEGORY_INJECTION): # This is the most frequent message by far.
+                logInfo(f"""Injecting {script.name}{"" if script.version is None else " " + C.VERSION_PREFIX + script.version} into {requestURL} ({inject.MODE_SERVED if useServed else inject.MODE_INLINE if useInline else inject.MODE_LINKED}) ...""", logqueue.CATEGORY_INJECTION)
+            shouldAllow = useInline and settings.bypassCsp == A.bypass_csp_script # If not inline (or served), then URL is used for bypassing; if bypass for nothing or everything, then the nonce would have no effect anyway.
+            shouldUseHash = shouldAllow and not useServed and settings.cspHashes # Served scripts have no inline content to hash.
+            candidates.append(csp.Injection(
+                userscript = script,
+                nonce = csp.generateNonce() if shouldAllow and not shouldUseHash else None,
+                payload = serving.payloadFor(loaded.served[position], requestURL) if useServed else inject.chosenPayload(loaded.payloads[position], useInline),
+                mode = inject.MODE_SERVED if useServed else inject.MODE_INLINE if useInline else inject.MODE_LINKED,
+                hashed = shouldUseHash,
+            ))
+            served.append(loaded.served[position] if useServed else None)
+        if settings.bundleUserscripts:
+            return serving.withBundles(candidates, served, self.bundles, requestURL)
+        return candidates
+
+
+    def responseheaders(self, flow: http.HTTPFlow) -> None:
+        settings = self.settings
+        response = flow.response
+        if settings is None or settings.streamThreshold is None or not isWebPage(response):
+            return
+        # We cannot change the length of the body as seen by the client without also changing how mitmproxy reads it from the server, so only chunked bodies can be streamed.
+        if CHUNKED not in response.headers.get(TRANSFER_ENCODING, "").lower():
+            return
+        contentEncoding = response.headers.get(CONTENT_ENCODING, "")
+        encoding = inferEncoding(response)
+        # Without a charset in the header, the beginning of the page tells (see the streamer):
+        if not streaming.isStreamableEncoding(contentEncoding) or (encoding is not None and not splice.isAsciiCompatible(encoding)):
+            return
+        if containsQueryParam(settings.queryParamToDisable, flow.request):
+            return # handled (and logged) in the response hook
+        candidates = self.candidatesFor(flow, settings)
+        if candidates is None or (len(candidates) == 0 and not settings.listInjected):
+            return # nothing to inject, so the page is passed through untouched (and counted) by the response hook
+        handleContentSecurityPolicy(response, [ csp.source(c) for c in candidates ], settings, self.cspCache)
+        if CONTENT_ENCODING in response.headers:
+            del response.headers[CONTENT_ENCODING] # We decode the body ourselves.
+        response.stream = streamer(candidates, encoding, contentEncoding, settings.streamThreshold, settings, lambda injections, errors: self.finishStream(flow, injections, errors))
+
+
+    def request(self, flow: http.HTTPFlow) -> None:
+        settings = self.settings
+        request = flow.request
+        if settings is None:
+            return
+        if settings.serveUserscripts:
+            digest = serving.digestFromPath(request.path)
+            if digest is not None:
+                # Answered right here, without contacting the server:
+                script = self.loaded.servedByDigest.get(digest)
+                flow.response = serving.response(self.bundles.get(digest) if script is None else script, request, self.compressionStats)
+                return
+        if settings.upstreamEncoding is None or not isPageRequest(request):
+            return
+        if containsQueryParam(settings.queryParamToDisable, request) or len(self.applicableUserscripts(self.loaded, request.pretty_url)) == 0:
+            return # The response will be passed through untouched, so the client may as well get what it asked for.
+        request.headers[ACCEPT_ENCODING] = compression.negotiatedAcceptEncoding(request.headers.get(ACCEPT_ENCODING, ""), settings.upstreamEncoding)
 
 
     def response(self, flow: http.HTTPFlow) -> None:
+        settings = self.settings
         response = flow.response
-        if CONTENT_TYPE in response.headers:
-            if any(map(lambda t: t in response.headers[CONTENT_TYPE], RELEVANT_CONTENT_TYPES)):
-                # Response is a web page; proceed.
-                injections: list[csp.Injection] = []
-                soup = BeautifulSoup(
-                    response.content,
-                    HTML_PARSER,
-                    from_encoding=inferEncoding(response)
-                )
-                requestURL = flow.request.pretty_url # should work in transparent mode too, unless the Host header is spoofed
-                if containsQueryParam(option(A.query_param_to_disable), flow.request):
-                    logInfo(f"""Not injecting any userscripts into {requestURL} because it contains a `{option(A.query_param_to_disable)}` query parameter.""")
+        if settings is None or response.stream:
+            return # Injection (if any) is done while streaming.
+        start = time.perf_counter()
+        isPage = isWebPage(response)
+        matchStart = time.perf_counter()
+        self.metrics.observeStages({ metrics.STAGE_CONTENT_TYPE: matchStart - start })
+        if isPage:
+            # Response is a web page; proceed.
+            record = None if self.tracer is None else self.tracer.begin(flow.request.pretty_url)
+            if record is not None:
+                flow.metadata[METADATA_TRACE] = record
+                self.addTraceTimings(flow, { metrics.STAGE_CONTENT_TYPE: matchStart - start })
+            candidates = self.candidatesFor(flow, settings)
+            self.observeStages(flow, { metrics.STAGE_MATCH: time.perf_counter() - matchStart })
+            if candidates is None or (len(candidates) == 0 and not settings.listInjected):
+                if candidates is not None:
+                    self.compressionStats.recordPassThrough()
+                self.finishFlow(flow, metrics.OUTCOME_SKIPPED, start)
+                return
+            raw = response.raw_content
+            if raw is None:
+                self.finishFlow(flow, metrics.OUTCOME_SKIPPED, start)
+                return
+            contentEncoding = response.headers.get(CONTENT_ENCODING)
+            encoding = inferEncoding(response)
+            acceptEncoding = flow.request.headers.get(ACCEPT_ENCODING, "")
+            level = settings.lanCompressionLevel if compression.isLocalClient(flow.client_conn.address) else settings.compressionLevel
+            pageKey: Optional[pagecache.PageKey] = None
+            if self.pageCache.enabled() and pagecache.isCacheable(candidates):
+                pageKey = pagecache.keyFor(pagecache.bodyDigest(raw), contentEncoding, encoding, candidates, settings, compression.chosenEncoding(acceptEncoding, level), level)
+            if record is not None:
+                record.update(traceOfPage(len(raw), encoding, candidates))
+            if pageKey is not None:
+                cached = self.pageCache.get(pageKey)
+                if cached is not None:
+                    self.serveRewritten(flow, cached, settings)
+                    self.countInjections(candidates)
+                    self.finishFlow(flow, metrics.OUTCOME_CACHED, start)
                     return
-                isApplicable: Callable[[Userscript], bool] = userscript.applicableChecker(requestURL)
-                for script in self.userscripts:
-                    if isApplicable(script):
-                        useInline = option(A.inline) or script.downloadURL is None
-                        if useInline and len(script.unsafeSequences) > 0:
-                            logError(unsafeSequencesMessage(script))
-                            continue
-                        logInfo(f"""Injecting {script.name}{"" if script.version is None else " " + C.VERSION_PREFIX + script.version} into {requestURL} ({"inline" if useInline else "linked"}) ...""")
-                        shouldUseNonce = useInline and option(A.bypass_csp) == A.bypass_csp_script # If not inline, then URL is used for bypassing; if bypass for nothing or everything, then the nonce would have no effect anyway.
-                        nonce = csp.generateNonce() if shouldUseNonce else None
-                        result = inject.inject(script, soup, inject.Options(
-                            inline = option(A.inline),
-                            nonce = nonce
-                        ))
-                        if type(result) is BeautifulSoup:
-                            soup = result
-                            injections.append(csp.Injection(
-                                userscript = script,
-                                nonce = nonce,
-                            ))
-                        else:
-                            logError("Injection failed due to the following error:")
-                            logError(str(result))
-
-                handleContentSecurityPolicy(response, injections)
-                index_DTD: Optional[int] = indexOfDTD(soup)
-                # Insert information comment:
-                if option(A.list_injected):
-                    namesOfInjectedScripts = [ i.userscript.name + ("" if i.userscript.version is None else " " + T.stringifyVersion(i.userscript.version)) for i in injections ]
-                    soup.insert(0 if index_DTD is None else 1+index_DTD, Comment(
-                        HTML_INFO_COMMENT_PREFIX + (
-                            "No matching userscripts for this URL." if namesOfInjectedScripts == []
-                            else "These scripts were inserted:\n" + bulletList(namesOfInjectedScripts)
-                        ) + "\n"
-                    ))
-                # Serialize and encode:
-                response.content = str(soup).encode(
-                    fromOptional(soup.original_encoding, CHARSET_DEFAULT),
-                    "replace"
-                )
-
-
-def handleContentSecurityPolicy(response: http.HTTPFlow.response, injections: list[csp.Injection]) -> None:
+                waiting = self.pagesInFlight.get(pageKey)
+                if waiting is not None:
+                    flow.reply.take()
+                    waiting.append((flow, settings, start))
+                    return
+            job = functools.partial(rewriting.rewriteBody, raw, contentEncoding, encoding, candidates, settings, acceptEncoding, level)
+            pool = self.rewritePool
+            loop = self.eventLoop
+            if pool is None or loop is None:
+                self.finishRewrite(flow, settings, pageKey, start, job)
+                return
+            future = pool.trySubmit(job)
+            if future is None:
+                logWarning(f"Too many pages are being rewritten already, so {flow.request.pretty_url} is passed through unchanged. Consider increasing {flag(A.rewrite_queue)} or {flag(A.rewrite_workers)}.", logqueue.CATEGORY_PAGE)
+                self.finishFlow(flow, metrics.OUTCOME_OVERLOADED, start)
+                return
+            # The flow is held back until the rewrite is done; the event loop is free to handle other flows in the meantime.
+            flow.reply.take()
+            if pageKey is not None:
+                self.pagesInFlight[pageKey] = []
+            future.add_done_callback(lambda f: loop.call_soon_threadsafe(self.finishRewrite, flow, settings, pageKey, start, f.result))
+
+
+    # Runs on the event loop. getResult either returns the rewritten body or raises.
+    # Flows that have been waiting for the same page get the same result.
+    # `start` is when the response hook started handling the flow.
+    def finishRewrite(self, flow: http.HTTPFlow, settings: Settings, pageKey: Optional[pagecache.PageKey], start: float, getResult: Callable[[], rewriting.Rewritten]) -> None:
+        waiting = [] if pageKey is None else self.pagesInFlight.pop(pageKey, [])
+        outcome = metrics.OUTCOME_FAILED
+        try:
+            rewritten = getResult()
+        except ValueError as e:
+            logError(f"Could not decode {flow.request.pretty_url}, so no userscripts will be injected: {e}", logqueue.CATEGORY_PAGE)
+        except Exception as e:
+            logError(f"Rewriting {flow.request.pretty_url} failed, so it is passed through unchanged: {e!r}", logqueue.CATEGORY_PAGE)
+        else:
+            if len(rewritten.errors) > 0:
+                logError("\n".join(rewritten.errors), logqueue.CATEGORY_PAGE) # as one message, so that repetitions are collapsed as a whole
+            self.compressionStats.add(rewritten.measurements)
+            self.observeStages(flow, rewritten.timings)
+            self.metrics.count(metrics.BYTES_IN, {}, len(flow.response.raw_content or b""))
+            self.metrics.count(metrics.BYTES_OUT, {}, len(rewritten.raw))
+            self.countInjections(rewritten.injections)
+            page = pagecache.CachedPage(
+                raw = rewritten.raw,
+                contentEncoding = rewritten.contentEncoding,
+                sources = [ csp.source(i) for i in rewritten.injections ],
+            )
+            if pageKey is not None and len(rewritten.errors) == 0: # so that errors keep being logged
+                self.pageCache.put(pageKey, page)
+            self.serveRewritten(flow, page, settings)
+            outcome = metrics.OUTCOME_REWRITTEN
+            for (waitingFlow, waitingSettings, _) in waiting:
+                self.pageCache.recordCoalesced(page)
+                self.serveRewritten(waitingFlow, page, waitingSettings)
+                self.countInjections(rewritten.injections)
+        finally:
+            self.finishFlow(flow, outcome, start)
+            for (waitingFlow, _, waitingStart) in waiting:
+                self.finishFlow(waitingFlow, metrics.OUTCOME_FAILED if outcome == metrics.OUTCOME_FAILED else metrics.OUTCOME_COALESCED, waitingStart)
+            for f in [ flow, *[ waitingFlow for (waitingFlow, _, _) in waiting ] ]:
+                if f.reply.state == "taken":
+                    if not f.reply.has_message:
+                        f.reply.ack()
+                    f.reply.commit()
+
+
+    def serveRewritten(self, flow: http.HTTPFlow, page: pagecache.CachedPage, settings: Settings) -> None:
+        cspStart = time.perf_counter()
+        action = handleContentSecurityPolicy(flow.response, page.sources, settings, self.cspCache)
+        self.observeStages(flow, { metrics.STAGE_CSP: time.perf_counter() - cspStart })
+        setContent(flow.response, page.raw, page.contentEncoding)
+        record = flow.metadata.get(METADATA_TRACE)
+        if record is not None:
+            record[tracing.CSP] = action
+
+
+    def observeStages(self, flow: http.HTTPFlow, timings: dict[str, float]) -> None:
+        self.metrics.observeStages(timings)
+        self.addTraceTimings(flow, timings)
+
+
+    def addTraceTimings(self, flow: http.HTTPFlow, timings: dict[str, float]) -> None:
+        record = flow.metadata.get(METADATA_TRACE)
+        if record is not None and self.tracer is not None:
+            self.tracer.addTimings(record, timings)
+
+
+    # Every web page handled by the response hook ends up here exactly once.
+    def finishFlow(self, flow: http.HTTPFlow, outcome: str, start: float) -> None:
+        total = time.perf_counter() - start
+        self.metrics.count(metrics.PAGES, { "outcome": outcome })
+        self.observeStages(flow, { metrics.STAGE_TOTAL: total })
+        record = flow.metadata.pop(METADATA_TRACE, None)
+        if record is not None and self.tracer is not None:
+            record[tracing.OUTCOME] = outcome
+            self.tracer.end(record, total)
+
+
+    # Called by the streamer, in the thread streaming the response, once what it has injected and any errors are known:
+    def finishStream(self, flow: http.HTTPFlow, injections: list[csp.Injection], errors: list[str]) -> None:
+        if len(errors) > 0:
+            logError("\n".join(errors), logqueue.CATEGORY_PAGE) # as one message, so that repetitions are collapsed as a whole
+        self.metrics.count(metrics.PAGES, { "outcome": metrics.OUTCOME_FAILED if len(errors) > 0 else metrics.OUTCOME_STREAMED })
+        self.countInjections(injections)
+
+
+    def countInjections(self, injections: list[csp.Injection]) -> None:
+        for injection in injections:
+            for script in (injection.userscript, *injection.bundled):
+                self.metrics.count(metrics.INJECTIONS, { "script": script.name })
+
+
+def isPageRequest(request: http.HTTPRequest) -> bool:
+    accept = request.headers.get(ACCEPT, "")
+    return any(map(lambda t: t in accept, RELEVANT_CONTENT_TYPES))
+
+
+def setContent(response: http.HTTPResponse, raw: bytes, contentEncoding: str) -> None:
+    response.raw_content = raw
+    if contentEncoding == compression.IDENTITY:
+        if CONTENT_ENCODING in response.headers:
+            del response.headers[CONTENT_ENCODING]
+    else:
+        response.headers[CONTENT_ENCODING] = contentEncoding
+    response.headers[CONTENT_LENGTH] = str(len(response.raw_content))
+    if ACCEPT_ENCODING.lower() not in response.headers.get(VARY, "").lower():
+        response.headers[VARY] = ", ".join(filter(None, [ response.headers.get(VARY, ""), ACCEPT_ENCODING ]))
+
+
+# What a trace record says about a page before it is rewritten:
+def traceOfPage(size: int, encoding: Optional[str], candidates: list[csp.Injection]) -> dict[str, Any]:
+    return {
+        tracing.SIZE: size,
+        tracing.ENCODING: encoding,
+        tracing.SCRIPTS: [ script.name for c in candidates for script in (c.userscript, *c.bundled) ],
+        tracing.INJECTIONS: [ { tracing.SCRIPT: c.userscript.name, tracing.MODE: c.mode, tracing.NONCE: c.nonce is not None, tracing.HASH: c.hashed } for c in candidates ],
+    }
+
+
+def sendReply(layer: Any) -> None:
+    if layer.reply.state == "taken":
+        if not layer.reply.has_message:
+            layer.reply.ack()
+        layer.reply.commit()
+
+
+def isTlsClient(layer: Any) -> bool:
+    try:
+        return tls.is_tls_record_magic(layer.client_conn.rfile.peek(3)) # already read by mitmproxy, so this does not block
+    except exceptions.TcpException:
+        return False
+
+
+# Runs in its own thread and calls `decide` on `loop` with the SNI, or None if there is none.
+def deliverSni(loop: asyncio.AbstractEventLoop, clientConnection: Any, decide: Callable[[Optional[str]], None]) -> None:
+    try:
+        sni = sniOf(clientConnection)
+    except Exception:
+        sni = None # The connection must be decided on no matter what, or it would hang forever.
+    try:
+        loop.call_soon_threadsafe(decide, sni)
+    except RuntimeError:
+        pass # The event loop is closed, i.e. the proxy has shut down.
+
+
+def sniOf(clientConnection: Any) -> Optional[str]:
+    try:
+        sni = tls.ClientHello.from_file(clientConnection.rfile).sni
+    except exceptions.TlsProtocolException:
+        return None
+    return None if sni is None else sni.decode("idna")
+
+
+def isWebPage(response: http.HTTPResponse) -> bool:
+    return CONTENT_TYPE in response.headers and any(map(lambda t: t in response.headers[CONTENT_TYPE], RELEVANT_CONTENT_TYPES))
+
+
+# `headerEncoding` is the charset from the Content-Type header, if any.
+# `finish` is called with the injected userscripts and any errors once the page has been streamed (or has failed to).
+def streamer(
+    candidates: list[csp.Injection],
+    headerEncoding: Optional[str],
+    contentEncoding: str,
+    threshold: int,
+    settings: Settings,
+    finish: Callable[[list[csp.Injection], list[str]], None],
+) -> Callable[[Iterable[bytes]], Iterator[bytes]]:
+    def rewritten(content: bytes) -> bytes:
+        result = rewriting.rewrite(content, headerEncoding, candidates, settings)
+        finish(result.injections, result.errors)
+        return result.content
+    def stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+        iterator = streaming.decoded(chunks, contentEncoding)
+        buffer = b""
+        try:
+            for chunk in iterator:
+                buffer += chunk
+                if len(buffer) > threshold and len(buffer) >= charset.PRESCAN_BYTES:
+                    break
+            else:
+                # The entire page was received before reaching the threshold, so we can rewrite it like any other page.
+                yield rewritten(buffer)
+                return
+            encoding = charset.resolve(headerEncoding, buffer)
+            if encoding is None or not splice.isAsciiCompatible(encoding):
+                # E.g. a page without any declared charset, which only BeautifulSoup can make sense of, given all of it:
+                yield rewritten(b"".join(itertools.chain([buffer], iterator)))
+                return
+            (early, late) = rewriting.encodedTags(candidates, encoding)
+            yield from streaming.injected(
+                itertools.chain([buffer], iterator),
+                early = early,
+                late = late,
+                comment = splice.encodedComment(rewriting.infoCommentText(candidates, settings), encoding),
+            )
+        except Exception as e:
+            finish([], [f"Streaming failed, so the rest of the page is lost: {e!r}"])
+            raise
+        finish(candidates, [])
+    return stream
+
+
+# Returns what was done, as one of the tracing.CSP_* values.
+def handleContentSecurityPolicy(response: http.HTTPFlow.response, sourcesToAllow: list[str], settings: Settings, cache: LRUCache[tuple[str, tuple[str, ...]], str]) -> str:
     # If there is a CSP header, we may need to modify it for the userscript(s) to work.
     ContentSecurityPolicy = "Content-Security-Policy"
     if ContentSecurityPolicy in response.headers:
-        bypassCspValue = option(A.bypass_csp)
+        bypassCspValue = settings.bypassCsp
         if bypassCspValue == A.bypass_csp_script:
-            logInfo(f"Bypassing host site's Content Security Policy for userscripts only (not any resources injected _by_ userscripts, such as stylesheets and images). Try `{flag(A.bypass_csp)} {A.bypass_csp_everything}` if something does not work properly.")
-            response.headers[ContentSecurityPolicy] = csp.headerWithScriptsAllowed(response.headers[ContentSecurityPolicy], injections)
+            logInfo(f"Bypassing host site's Content Security Policy for userscripts only (not any resources injected _by_ userscripts, such as stylesheets and images). Try `{flag(A.bypass_csp)} {A.bypass_csp_everything}` if something does not work properly.", logqueue.CATEGORY_CSP)
+            response.headers[ContentSecurityPolicy] = csp.cachedHeaderWithScriptsAllowed(cache, response.headers[ContentSecurityPolicy], sourcesToAllow)
+            return tracing.CSP_ALLOWED
         elif bypassCspValue == A.bypass_csp_everything:
-            logInfo(f"Bypassing host site's Content Security Policy altogether due to `{flag(A.bypass_csp)} {A.bypass_csp_everything}`.")
+            logInfo(f"Bypassing host site's Content Security Policy altogether due to `{flag(A.bypass_csp)} {A.bypass_csp_everything}`.", logqueue.CATEGORY_CSP)
             del response.headers[ContentSecurityPolicy]
+            return tracing.CSP_REMOVED
         else:
-            logWarning(f"Host site has a Content Security Policy. Try the {flag(A.bypass_csp)} flag if userscripts don't work properly.")
+            logWarning(f"Host site has a Content Security Policy. Try the {flag(A.bypass_csp)} flag if userscripts don't work properly.", logqueue.CATEGORY_CSP)
+            return tracing.CSP_KEPT
+    return tracing.CSP_NONE
 
 
 addons = [ UserscriptInjector() ]
@@ -1,20 +1,27 @@
 #!/usr/bin/env python3
 
-import glob
+import time
+STARTED_AT: float = time.time() # before the other imports, so that they count towards the startup report
+
 import os
 import shlex
+import signal
 import subprocess
+import sys
+from typing import Optional
 
 from modules.argparser import getArgparser
 import modules.arguments as A
-import modules.constants as C
+import modules.hostrules as hostrules
 import modules.ignore as ignore
 from modules.misc import sanitize
+import modules.startup as startup
 import modules.text as T
-from modules.utilities import flag, idem, itemList
+from modules.utilities import flag, itemList
 
 FILENAME_INJECTOR: str = "injector.py"
-MATCH_NO_HOSTS = r"^$"
+FILENAME_SHARED_PORT_MITMDUMP: str = "mitmdump_shared_port.py"
+MAX_RULES_SHOWN: int = 100 # Blocklists can have many thousands.
 
 
 def printInfo(
@@ -22,17 +29,20 @@ def printInfo(
     useIntercept: bool,
     useTransparent: bool,
     filterRules: list[str],
+    rulesAreFiles: bool,
 ) -> None:
     print()
     print("mitmproxy will be run in " + ("TRANSPARENT" if useTransparent else "REGULAR") + " mode.")
     print()
     if useFiltering:
-        print(f"Traffic from hosts matching any of these rules will be {'INTERCEPTED' if useIntercept else 'IGNORED'} by mitmproxy:")
+        print(f"Traffic from hosts matching any of {'the rules in these files' if rulesAreFiles else 'these rules'} will be {'INTERCEPTED' if useIntercept else 'IGNORED'} by mitmproxy:")
         print()
-        print(itemList("    ", filterRules))
+        print(itemList("    ", filterRules[:MAX_RULES_SHOWN]))
+        if len(filterRules) > MAX_RULES_SHOWN:
+            print(f"    ... and {len(filterRules) - MAX_RULES_SHOWN} more")
         print()
         if useTransparent:
-            print(f"Please note that ignore/intercept rules based on hostnames may not work in transparent mode; it may be necessary to use IP addresses instead.")
+            print(f"Please note that in transparent mode, rules based on hostnames only work for TLS traffic, whose server name is sent by the client; other traffic can only be matched by IP address.")
     else:
         print(f"Since {flag(A.no_default_rules)} was given and {flag(A.rules)} was not, ALL traffic will be intercepted.")
     print()
@@ -44,10 +54,20 @@ def checkThatUserscriptsDirectoryExistsIfSpecified(directory: str) -> None:
         exit(1)
 
 
+# E.g. /cache/pages -> /cache/pages-2 for worker 2. Worker 1 keeps the path as given, so that a single worker (the default) uses the same files as a proxy started without --worker:
+def perWorker(path: Optional[str], worker: Optional[int]) -> Optional[str]:
+    if path is None or path == "" or worker is None or worker == 1:
+        return path
+    (root, extension) = os.path.splitext(os.path.normpath(path))
+    return f"{root}-{worker}{extension}"
+
+
 try:
-    workingDirectory = os.getcwd()
     args = getArgparser().parse_args()
-    print(T.WELCOME_MESSAGE)
+    worker: Optional[int] = args.worker
+    printDetails = worker is None or worker == 1 # The other workers would just print the same thing.
+    if printDetails:
+        print(T.WELCOME_MESSAGE)
     globPattern = args.rules
     useCustomFiltering = globPattern is not None
     useDefaultRules = not args.no_default_rules
@@ -57,56 +77,82 @@ try:
     bypassCsp = args.bypass_csp
     userscriptsDirectory = args.userscripts_dir
     checkThatUserscriptsDirectoryExistsIfSpecified(userscriptsDirectory)
-    def ruleFilesContent_default() -> str:
-        if useDefaultRules:
-            print(f"Reading default {'intercept' if useIntercept else 'ignore'} rules ...")
-            globPatternForDefaultRules = C.DEFAULT_INTERCEPT_RULES if useIntercept else C.DEFAULT_IGNORE_RULES
-            filenames: list[str] = [ shlex.quote(unsafeFilename) for unsafeFilename in glob.glob(globPatternForDefaultRules) ]
-            acc = ""
-            for filename in filenames:
-                print("Reading " + filename + " ...")
-                acc += open(filename).read()
-            return acc
-        else:
-            return ""
-    def ruleFilesContent_custom() -> str:
-        if useCustomFiltering:
-            print(f"Reading custom {'intercept' if useIntercept else 'ignore'} rules ({globPattern}) ...")
-            filenames: list[str] = [ shlex.quote(unsafeFilename) for unsafeFilename in glob.glob(globPattern) ]
-            acc = ""
-            for filename in filenames:
-                print("Reading " + filename + " ...")
-                acc += open(filename).read()
-            os.chdir(workingDirectory)
-            return acc
-        else:
-            return ""
-    ruleFilesContent = ruleFilesContent_default() + "\n" + ruleFilesContent_custom()
-    filterRules = ignore.rulesIn(ruleFilesContent)
-    printInfo(
-        useFiltering=useFiltering,
-        useIntercept=useIntercept,
-        useTransparent=useTransparent,
-        filterRules=filterRules,
-    )
-    maybeNegate = ignore.negate if useIntercept else idem
-    regex = maybeNegate(ignore.entireIgnoreRegex(ruleFilesContent)) if useFiltering else MATCH_NO_HOSTS
+    if useDefaultRules and printDetails:
+        print(f"Reading default {'intercept' if useIntercept else 'ignore'} rules ...")
+    if useCustomFiltering and printDetails:
+        print(f"Reading custom {'intercept' if useIntercept else 'ignore'} rules ({globPattern}) ...")
+    # The addon reads the same files again (see hostrules), so that they can be reloaded without restarting mitmdump.
+    # Only to show them here, so with a large blocklist, this is skipped with --fast-start:
+    filterRules: list[str] = []
+    for filename in hostrules.ruleFiles(globPattern, useDefaultRules, useIntercept):
+        if args.fast_start:
+            filterRules.append(filename)
+            continue
+        if printDetails:
+            print("Reading " + shlex.quote(filename) + " ...")
+        filterRules += ignore.rulesIn(open(filename).read())
+    if printDetails:
+        printInfo(
+            useFiltering=useFiltering,
+            useIntercept=useIntercept,
+            useTransparent=useTransparent,
+            filterRules=filterRules,
+            rulesAreFiles=args.fast_start,
+        )
     script = os.path.join(os.path.dirname(__file__), FILENAME_INJECTOR)
-    subprocess.run([
-        "mitmdump", "--ignore-hosts", regex,
+    pageCacheDirectory = perWorker(args.page_cache_dir, worker)
+    traceFile = perWorker(args.trace_file, worker)
+    # Workers share the port, which plain mitmdump does not allow:
+    mitmdump = [ "mitmdump" ] if worker is None else [ sys.executable, os.path.join(os.path.dirname(__file__), FILENAME_SHARED_PORT_MITMDUMP) ]
+    with subprocess.Popen([
+        *mitmdump,
         "--listen-port", str(args.port),
         "--mode", "transparent" if useTransparent else "regular",
         "--showhost", # use Host header for URL display
         "-s", script,
+        "--set", "" if globPattern is None else f"""{sanitize(A.rules)}={globPattern}""",
+        "--set", f"""{sanitize(A.no_default_rules)}={str(args.no_default_rules).lower()}""",
+        "--set", f"""{sanitize(A.intercept_rules)}={str(useIntercept).lower()}""",
         "--set", f"""{sanitize(A.inline)}={str(args.inline).lower()}""",
         "--set", f"""{sanitize(A.list_injected)}={str(args.list_injected).lower()}""",
         "--set", f"""{sanitize(A.no_default_userscripts)}={str(args.no_default_userscripts).lower()}""",
         "--set", "" if bypassCsp is None else f"""{sanitize(A.bypass_csp)}={bypassCsp}""",
+        "--set", f"""{sanitize(A.csp_hashes)}={str(args.csp_hashes).lower()}""",
+        "--set", f"""{sanitize(A.fast_start)}={str(args.fast_start).lower()}""",
         "--set", "" if userscriptsDirectory is None else f"""{sanitize(A.userscripts_dir)}={userscriptsDirectory}""",
         "--set", f"""{sanitize(A.query_param_to_disable)}={args.query_param_to_disable}""",
+        "--set", f"""{sanitize(A.rewrite_engine)}={args.rewrite_engine}""",
+        "--set", f"""{sanitize(A.url_cache_size)}={args.url_cache_size}""",
+        "--set", f"""{sanitize(A.watch)}={str(args.watch).lower()}""",
+        "--set", f"""{sanitize(A.cache_dir)}={args.cache_dir}""",
+        "--set", f"""{sanitize(A.skip_dirs)}={args.skip_dirs}""",
+        "--set", f"""{sanitize(A.serve_userscripts)}={str(args.serve_userscripts).lower()}""",
+        "--set", f"""{sanitize(A.bundle_userscripts)}={str(args.bundle_userscripts).lower()}""",
+        "--set", f"""{sanitize(A.compression_level)}={args.compression_level}""",
+        "--set", f"""{sanitize(A.lan_compression_level)}={args.lan_compression_level}""",
+        "--set", f"""{sanitize(A.rewrite_workers)}={args.rewrite_workers}""",
+        "--set", f"""{sanitize(A.rewrite_pool)}={args.rewrite_pool}""",
+        "--set", f"""{sanitize(A.rewrite_queue)}={args.rewrite_queue}""",
+        "--set", f"""{sanitize(A.page_cache_size)}={args.page_cache_size}""",
+        "--set", "" if pageCacheDirectory is None else f"""{sanitize(A.page_cache_dir)}={pageCacheDirectory}""",
+        "--set", "" if traceFile is None else f"""{sanitize(A.trace_file)}={traceFile}""",
+        "--set", "" if args.heartbeat_file is None else f"""{sanitize(A.heartbeat_file)}={args.heartbeat_file}""",
+        "--set", f"""{sanitize(A.trace_sample)}={args.trace_sample}""",
+        "--set", f"""{sanitize(A.trace_slow_ms)}={args.trace_slow_ms}""",
+        "--set", f"""{sanitize(A.log_levels)}={args.log_levels}""",
+        "--set", f"""{sanitize(A.log_sample)}={args.log_sample}""",
+        "--set", "" if args.metrics_dir is None else f"""{sanitize(A.metrics_dir)}={args.metrics_dir}""",
+        "--set", "" if args.metrics_name is None else f"""{sanitize(A.metrics_name)}={args.metrics_name}""",
+        "--set", "" if args.upstream_encoding is None else f"""{sanitize(A.upstream_encoding)}={args.upstream_encoding}""",
+        "--set", "" if args.stream_threshold is None else f"""{sanitize(A.stream_threshold)}={args.stream_threshold}""",
         # Empty string breaks the argument chain:
         "--rawtcp" if useTransparent else "", # for apps like Facebook Messenger
-    ])
+    ], env=startup.environmentForMitmdump(STARTED_AT)) as process:
+        # Exit only once mitmdump has, so that whoever stops us (e.g. the supervisor) knows when the port is free, or that mitmdump is stuck:
+        signal.signal(signal.SIGTERM, lambda signum, frame: process.terminate())
+        # Asks mitmdump to stop accepting connections and exit once the open ones are closed (see the injector):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: process.send_signal(signum))
+        process.wait()
 except KeyboardInterrupt:
     print("")
     print("Interrupted by user.")
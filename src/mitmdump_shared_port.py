@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+# Runs mitmdump with the same arguments, except that the proxy's listening
+# socket is bound with SO_REUSEPORT, so that several of these processes can
+# listen on the same port and the kernel spreads incoming connections across
+# them. mitmproxy binds that socket before it loads any addon, so this cannot be
+# done in the injector.
+
+import socket
+import sys
+from typing import Any
+
+from mitmproxy.tools.main import mitmdump
+
+LISTEN_PORT_FLAG: str = "--listen-port"
+
+
+def listenPort(arguments: list[str]) -> int:
+    return int(arguments[arguments.index(LISTEN_PORT_FLAG) + 1])
+
+
+def bindWithReusePort(port: int) -> None:
+    originalBind = socket.socket.bind
+    def bind(self: socket.socket, address: Any) -> None:
+        # Only the listening socket; outgoing connections are left alone.
+        if self.type == socket.SOCK_STREAM and isinstance(address, tuple) and address[1] == port:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        originalBind(self, address)
+    socket.socket.bind = bind # type: ignore
+
+
+if __name__ == "__main__":
+    bindWithReusePort(listenPort(sys.argv))
+    sys.exit(mitmdump(sys.argv[1:]))
@@ -14,11 +14,49 @@ def getArgparser() -> ArgumentParser:
         default=A.bypass_csp_default,
         help=A.bypass_csp_help,
     )
+    argparser.add_argument(
+        flag(A.bundle_userscripts),
+        action="store_true",
+        help=A.bundle_userscripts_help,
+    )
+    argparser.add_argument(
+        flag(A.csp_hashes),
+        action="store_true",
+        help=A.csp_hashes_help,
+    )
+    argparser.add_argument(
+        flag(A.cache_dir),
+        type=str,
+        metavar=A.metavar_dir,
+        default=A.cache_dir_default,
+        help=A.cache_dir_help,
+    )
+    argparser.add_argument(
+        flag(A.compression_level),
+        type=int,
+        metavar=A.metavar_level,
+        default=A.compression_level_default,
+        help=A.compression_level_help,
+    )
     argparser.add_argument(
         flag(A.intercept),
         action="store_true",
         help=A.intercept_help,
     )
+    argparser.add_argument(
+        flag(A.metrics_dir),
+        type=str,
+        metavar=A.metavar_dir,
+        default=A.metrics_dir_default,
+        help=A.metrics_dir_help,
+    )
+    argparser.add_argument(
+        flag(A.metrics_name),
+        type=str,
+        metavar=A.metavar_name,
+        default=A.metrics_name_default,
+        help=A.metrics_name_help,
+    )
     argparser.add_argument(
         flag(A.no_default_rules),
         action="store_true",
@@ -29,16 +67,63 @@ def getArgparser() -> ArgumentParser:
         action="store_true",
         help=A.no_default_userscripts_help,
     )
+    argparser.add_argument(
+        flag(A.fast_start),
+        action="store_true",
+        help=A.fast_start_help,
+    )
+    argparser.add_argument(
+        flag(A.heartbeat_file),
+        type=str,
+        metavar=A.metavar_file,
+        default=A.heartbeat_file_default,
+        help=A.heartbeat_file_help,
+    )
     argparser.add_argument(
         flag(A.inline), shortFlag(A.inline_short),
         action="store_true",
         help=A.inline_help,
     )
+    argparser.add_argument(
+        flag(A.lan_compression_level),
+        type=int,
+        metavar=A.metavar_level,
+        default=A.lan_compression_level_default,
+        help=A.lan_compression_level_help,
+    )
     argparser.add_argument(
         flag(A.list_injected),
         action="store_true",
         help=A.list_injected_help,
     )
+    argparser.add_argument(
+        flag(A.log_levels),
+        type=str,
+        metavar=A.metavar_levels,
+        default=A.log_levels_default,
+        help=A.log_levels_help,
+    )
+    argparser.add_argument(
+        flag(A.log_sample),
+        type=str,
+        metavar=A.metavar_samples,
+        default=A.log_sample_default,
+        help=A.log_sample_help,
+    )
+    argparser.add_argument(
+        flag(A.page_cache_dir),
+        type=str,
+        metavar=A.metavar_dir,
+        default=A.page_cache_dir_default,
+        help=A.page_cache_dir_help,
+    )
+    argparser.add_argument(
+        flag(A.page_cache_size),
+        type=int,
+        metavar=A.metavar_bytes,
+        default=A.page_cache_size_default,
+        help=A.page_cache_size_help,
+    )
     argparser.add_argument(
         flag(A.port), shortFlag(A.port_short),
         type=int,
@@ -52,17 +137,101 @@ def getArgparser() -> ArgumentParser:
         default=A.query_param_to_disable_default,
         help=A.query_param_to_disable_help,
     )
+    argparser.add_argument(
+        flag(A.rewrite_engine),
+        type=str,
+        metavar=A.metavar_engine,
+        choices=A.rewrite_engine_values,
+        default=A.rewrite_engine_default,
+        help=A.rewrite_engine_help,
+    )
+    argparser.add_argument(
+        flag(A.rewrite_pool),
+        type=str,
+        metavar=A.metavar_pool,
+        choices=A.rewrite_pool_values,
+        default=A.rewrite_pool_default,
+        help=A.rewrite_pool_help,
+    )
+    argparser.add_argument(
+        flag(A.rewrite_queue),
+        type=int,
+        metavar=A.metavar_n,
+        default=A.rewrite_queue_default,
+        help=A.rewrite_queue_help,
+    )
+    argparser.add_argument(
+        flag(A.rewrite_workers),
+        type=int,
+        metavar=A.metavar_n,
+        default=A.rewrite_workers_default,
+        help=A.rewrite_workers_help,
+    )
     argparser.add_argument(
         flag(A.rules),
         type=str,
         metavar=A.metavar_file,
         help=A.rules_help,
     )
+    argparser.add_argument(
+        flag(A.serve_userscripts),
+        action="store_true",
+        help=A.serve_userscripts_help,
+    )
+    argparser.add_argument(
+        flag(A.skip_dirs),
+        type=str,
+        metavar=A.metavar_names,
+        default=A.skip_dirs_default,
+        help=A.skip_dirs_help,
+    )
+    argparser.add_argument(
+        flag(A.stream_threshold),
+        type=int,
+        metavar=A.metavar_bytes,
+        default=A.stream_threshold_default,
+        help=A.stream_threshold_help,
+    )
+    argparser.add_argument(
+        flag(A.trace_file),
+        type=str,
+        metavar=A.metavar_file,
+        default=A.trace_file_default,
+        help=A.trace_file_help,
+    )
+    argparser.add_argument(
+        flag(A.trace_sample),
+        type=int,
+        metavar=A.metavar_n,
+        default=A.trace_sample_default,
+        help=A.trace_sample_help,
+    )
+    argparser.add_argument(
+        flag(A.trace_slow_ms),
+        type=int,
+        metavar=A.metavar_ms,
+        default=A.trace_slow_ms_default,
+        help=A.trace_slow_ms_help,
+    )
     argparser.add_argument(
         flag(A.transparent), shortFlag(A.transparent_short),
         action="store_true",
         help=A.transparent_help,
     )
+    argparser.add_argument(
+        flag(A.upstream_encoding),
+        type=str,
+        metavar=A.metavar_encodings,
+        default=A.upstream_encoding_default,
+        help=A.upstream_encoding_help,
+    )
+    argparser.add_argument(
+        flag(A.url_cache_size),
+        type=int,
+        metavar=A.metavar_n,
+        default=A.url_cache_size_default,
+        help=A.url_cache_size_help,
+    )
     argparser.add_argument(
         flag(A.userscripts_dir), shortFlag(A.userscripts_dir_short),
         type=str,
@@ -70,4 +239,16 @@ def getArgparser() -> ArgumentParser:
         default=A.userscripts_dir_default,
         help=A.userscripts_dir_help,
     )
+    argparser.add_argument(
+        flag(A.watch), shortFlag(A.watch_short),
+        action="store_true",
+        help=A.watch_help,
+    )
+    argparser.add_argument(
+        flag(A.worker),
+        type=int,
+        metavar=A.metavar_n,
+        default=A.worker_default,
+        help=A.worker_help,
+    )
     return argparser
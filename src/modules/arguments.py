@@ -1,3 +1,5 @@
+import os
+
 from modules.utilities import flag
 
 # Helpers/utilities:
@@ -5,6 +7,17 @@ metavar_file = "FILE"
 metavar_dir = "DIR"
 metavar_param = "PARAM"
 metavar_allow = "ALLOW"
+metavar_engine = "ENGINE"
+metavar_bytes = "BYTES"
+metavar_n = "N"
+metavar_names = "NAMES"
+metavar_encodings = "ENCODINGS"
+metavar_level = "LEVEL"
+metavar_pool = "POOL"
+metavar_ms = "MS"
+metavar_levels = "LEVELS"
+metavar_samples = "SAMPLES"
+metavar_name = "NAME"
 
 RULES = "rules"
 
@@ -16,23 +29,71 @@ bypass_csp_default = bypass_csp_script
 bypass_csp_values = { bypass_csp_nothing, bypass_csp_script, bypass_csp_everything }
 bypass_csp_help = f"Bypass host site's Content Security Policy to allow userscripts to run properly. If {metavar_allow} is '{bypass_csp_script}', the CSP is bypassed only for the userscript itself. Use '{bypass_csp_everything}' to allow everything, which may be necessary if the userscript injects CSS, images etc. Note that the latter completely disables any CSP from every host site into which a userscript is injected. Default: '{bypass_csp_default}'."
 
+csp_hashes = "csp-hashes"
+csp_hashes_help = f"With {flag(bypass_csp)} {bypass_csp_script}, allow inline userscripts by their SHA-256 hashes, computed once when userscripts are loaded, instead of by a random nonce for each page, so that the same page always gets the same Content-Security-Policy header"
+
+cache_dir = "cache-dir"
+cache_dir_default = os.path.join(os.path.expanduser("~"), ".cache", "userscript-proxy")
+cache_dir_help = f"Cache parsed userscripts in directory {metavar_dir}, so that unchanged ones load faster after a restart; an empty string disables the cache (default: {cache_dir_default})"
+
+compression_level = "compression-level"
+compression_level_default = 4
+compression_level_help = f"Compress web pages into which userscripts have been injected at {metavar_level} 1-9 (using br or gzip, whichever the client supports), or send them uncompressed if {metavar_level} is 0 (default: {compression_level_default})"
+
+fast_start = "fast-start"
+fast_start_help = "Start handling connections before the parser for web pages has been imported and set up, doing that in the background instead, then exempt everything loaded at startup from garbage collection; only the rule files are listed at startup, not the rules in them"
+
+heartbeat_file = "heartbeat-file"
+heartbeat_file_default = None
+heartbeat_file_help = f"Touch {metavar_file} every few seconds from mitmproxy's event loop, so that a supervisor can tell whether the proxy is still responsive"
+
 inline = "inline"
 inline_short = "i"
 inline_help = "Always insert userscripts inline, never linked"
 
 intercept = "intercept"
 intercept_help = f"Invert the meaning of {flag(RULES)} so that traffic from matched hosts is intercepted instead of ignored"
+# Not a flag; how the launcher passes on --intercept, because mitmproxy already has an option called `intercept`:
+intercept_rules = "intercept-rules"
+
+lan_compression_level = "lan-compression-level"
+lan_compression_level_default = 0
+lan_compression_level_help = f"Like {flag(compression_level)}, but for clients on the local network (default: {lan_compression_level_default})"
 
 list_injected = "list-injected"
 list_injected_short = "l"
 list_injected_help = "Insert an HTML comment with a list of injected userscripts"
 
+log_levels = "log-levels"
+log_levels_default = ""
+log_levels_help = f"Turn down messages about individual web pages by category; {metavar_levels} is a comma-separated list like 'injection=warn,csp=off' (categories: injection, csp, page; levels: info, warn, error, off)"
+
+log_sample = "log-sample"
+log_sample_default = ""
+log_sample_help = f"Only log one in every N messages of a category; {metavar_samples} is a comma-separated list like 'injection=100' (categories: injection, csp, page)"
+
+metrics_dir = "metrics-dir"
+metrics_dir_default = None
+metrics_dir_help = f"Write metrics (counters and latency histograms) to directory {metavar_dir} every few seconds, for the control server to serve"
+
+metrics_name = "metrics-name"
+metrics_name_default = None
+metrics_name_help = f"Name the metrics snapshot written to {flag(metrics_dir)} after {metavar_name}, so that the supervisor can tell which process wrote it; default: the process ID"
+
 no_default_rules = "no-default-rules"
 no_default_rules_help = f"Skip built-in default ignore/intercept rules"
 
 no_default_userscripts = "no-default-userscripts"
 no_default_userscripts_help = f"""Skip built-in default userscripts"""
 
+page_cache_size = "page-cache-size"
+page_cache_size_default = 32 * 1024 * 1024
+page_cache_size_help = f"Keep up to {metavar_bytes} bytes of rewritten web pages in memory, so that a page that has not changed does not have to be rewritten again; 0 disables the cache (default: {page_cache_size_default})"
+
+page_cache_dir = "page-cache-dir"
+page_cache_dir_default = None
+page_cache_dir_help = f"Move rewritten web pages that no longer fit in {flag(page_cache_size)} to directory {metavar_dir} instead of forgetting them"
+
 port = "port"
 port_short = "p"
 port_default = 8080
@@ -43,15 +104,79 @@ query_param_to_disable_short = "q"
 query_param_to_disable_default = "nouserscripts"
 query_param_to_disable_help = f"""Disable userscripts when the request URL contains a PARAM query parameter, for example "foo" to disable userscripts for http://example.com?foo (default: {query_param_to_disable_default})"""
 
+rewrite_engine = "rewrite-engine"
+rewrite_engine_soup = "soup"
+rewrite_engine_splice = "splice"
+rewrite_engine_default = rewrite_engine_soup
+rewrite_engine_values = { rewrite_engine_soup, rewrite_engine_splice }
+rewrite_engine_help = f"How to insert userscripts into web pages. '{rewrite_engine_soup}' parses and re-serializes the entire page. '{rewrite_engine_splice}' inserts the <script> tags directly into the raw bytes of the page, which is much faster for large pages, and falls back to '{rewrite_engine_soup}' for pages it cannot handle. Default: '{rewrite_engine_default}'."
+
+rewrite_workers = "rewrite-workers"
+rewrite_workers_default = 0
+rewrite_workers_help = f"Rewrite web pages using {metavar_n} workers, so that large pages do not hold up the rest of the proxy; 0 rewrites them in the proxy's main thread (default: {rewrite_workers_default})"
+
+rewrite_pool = "rewrite-pool"
+rewrite_pool_thread = "thread"
+rewrite_pool_process = "process"
+rewrite_pool_default = rewrite_pool_thread
+rewrite_pool_values = { rewrite_pool_thread, rewrite_pool_process }
+rewrite_pool_help = f"Whether {flag(rewrite_workers)} are threads or processes. '{rewrite_pool_thread}' has less overhead; '{rewrite_pool_process}' isolates rewriting completely from the rest of the proxy. Default: '{rewrite_pool_default}'."
+
+rewrite_queue = "rewrite-queue"
+rewrite_queue_default = 64
+rewrite_queue_help = f"Pass web pages through without injecting userscripts if {metavar_n} pages are already being rewritten or waiting to be (default: {rewrite_queue_default})"
+
 rules = RULES
 rules_short = "r"
 rules_help = f"Ignore (or, with {flag(intercept)}, intercept) traffic from hosts matching any of the rules specified in {metavar_file} (file name or glob pattern)"
 
+serve_userscripts = "serve-userscripts"
+serve_userscripts_help = "Serve userscripts that would otherwise be inserted inline from the proxy itself, at a reserved path on each site, so that browsers can cache them"
+
+bundle_userscripts = "bundle-userscripts"
+bundle_userscripts_help = f"Serve userscripts that {flag(serve_userscripts)} serves and that are injected next to each other as one bundle, so that each page needs fewer requests"
+
+skip_dirs = "skip-dirs"
+skip_dirs_default = "node_modules,.git"
+skip_dirs_help = f"Do not look for userscripts in directories with any of the comma-separated {metavar_names} (default: {skip_dirs_default})"
+
+stream_threshold = "stream-threshold"
+stream_threshold_default = None
+stream_threshold_help = f"Stream server-streamed (chunked) web pages to the client with userscripts injected on the fly, instead of waiting for the entire page, once more than {metavar_bytes} bytes have been received. Pages that end before that are handled as usual. Streaming is disabled by default."
+
+trace_file = "trace-file"
+trace_file_default = None
+trace_file_help = f"Append one JSON line per handled web page, with what was done to it and how long each stage took, to {metavar_file} (rotated when it grows large)"
+
+trace_sample = "trace-sample"
+trace_sample_default = 1
+trace_sample_help = f"Only trace one in every {metavar_n} web pages (default: {trace_sample_default})"
+
+trace_slow_ms = "trace-slow-ms"
+trace_slow_ms_default = 0
+trace_slow_ms_help = f"Only trace web pages that took at least {metavar_ms} milliseconds to handle (default: {trace_slow_ms_default})"
+
 transparent = "transparent"
 transparent_short = "t"
 transparent_help = "Transparent mode"
 
+upstream_encoding = "upstream-encoding"
+upstream_encoding_default = None
+upstream_encoding_help = f"When requesting web pages into which userscripts will be injected, only accept the comma-separated content {metavar_encodings} (that the client also accepts) from the server, for example 'gzip' or 'identity', which are cheaper to decompress than e.g. 'br'. By default, the client's Accept-Encoding header is passed on unchanged."
+
+url_cache_size = "url-cache-size"
+url_cache_size_default = 1024
+url_cache_size_help = f"Remember which userscripts apply to each of the {metavar_n} most recently requested URLs; 0 disables the cache (default: {url_cache_size_default})"
+
 userscripts_dir = "userscripts-dir"
 userscripts_dir_short = "u"
 userscripts_dir_default = None
 userscripts_dir_help = f"Load userscripts from directory {metavar_dir}"
+
+watch = "watch"
+watch_short = "w"
+watch_help = f"Reload userscripts from {flag(userscripts_dir)} and rules from {flag(rules)} whenever they change, without restarting the proxy"
+
+worker = "worker"
+worker_default = None
+worker_help = f"Run as worker number {metavar_n} of several proxies sharing {flag(port)}, as started by the supervisor; {flag(page_cache_dir)} and {flag(trace_file)} get the number as a suffix for workers other than 1, so that workers do not get in each other's way"
@@ -0,0 +1,47 @@
+import threading
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+# Thread-safe, because mitmproxy may run hooks (and streamed responses) in several threads.
+class LRUCache(Generic[K, V]):
+    def __init__(self, maxSize: int) -> None:
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[K, V] = OrderedDict()
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        if self.maxSize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        return f"{self.hits} hits, {self.misses} misses ({0 if lookups == 0 else round(100 * self.hits / lookups)}% hit ratio), {self.size()}/{self.maxSize} entries"
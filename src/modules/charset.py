@@ -0,0 +1,117 @@
+import codecs
+import re
+from typing import Optional
+
+from modules.splice import REGEX_TAG_REST
+
+# Which character encoding a browser will decode a page with, determined the
+# way the HTML spec prescribes as far as that is possible without decoding the
+# page: a byte order mark, then the charset in the Content-Type header, then a
+# <meta> element within the first PRESCAN_BYTES. Only a page that declares no
+# charset at all is left to BeautifulSoup, which guesses from the entire
+# document.
+#
+# Knowing the charset lets the splice engine handle the page, and it is the
+# charset that the injected <script> tags are encoded in (see
+# inject.encodedPayload).
+
+PRESCAN_BYTES: int = 1024
+
+BYTE_ORDER_MARKS: list[tuple[bytes, str]] = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+]
+
+# A <meta> element cannot declare UTF-16, since it could not have been read if the page were in UTF-16:
+META_UTF16_REPLACEMENT: str = "utf-8"
+# The only label browsers support that Python does not:
+LABEL_X_USER_DEFINED: str = "x-user-defined"
+X_USER_DEFINED_REPLACEMENT: str = "cp1252"
+
+ATTRIBUTE_CHARSET: bytes = b"charset"
+ATTRIBUTE_CONTENT: bytes = b"content"
+ATTRIBUTE_HTTP_EQUIV: bytes = b"http-equiv"
+HTTP_EQUIV_CONTENT_TYPE: bytes = b"content-type"
+
+REGEXGROUP_ATTRIBUTES: str = "attributes"
+
+# Comments and other tags are skipped as a whole, so that e.g. `<meta charset>` in an attribute value is not mistaken for an element:
+REGEX_PRESCAN: re.Pattern = re.compile(
+    rb"<!--.*?-->"
+    + rb"|<meta(?=[\s/])(?P<" + REGEXGROUP_ATTRIBUTES.encode() + rb">" + REGEX_TAG_REST + rb")"
+    + rb"|</?[a-zA-Z]" + REGEX_TAG_REST
+    + rb"|<[!/?][^>]*>",
+    re.IGNORECASE | re.DOTALL,
+)
+REGEX_ATTRIBUTE: re.Pattern = re.compile(rb"""([^\s/>"'=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+)))?""")
+REGEX_CONTENT_CHARSET: re.Pattern = re.compile(rb"""charset\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s;"']+))""", re.IGNORECASE)
+
+
+# Returns a codec name as returned by codecs.lookup, or None if Python does not know `label` as a text encoding.
+def codecFor(label: str) -> Optional[str]:
+    label = label.strip().strip("\"'").lower()
+    if label == LABEL_X_USER_DEFINED:
+        return X_USER_DEFINED_REPLACEMENT
+    try:
+        name = codecs.lookup(label).name
+        "".encode(name) # raises LookupError for bytes-to-bytes codecs like zlib
+        return name
+    except (LookupError, ValueError):
+        return None
+
+
+def resolve(headerCharset: Optional[str], document: bytes) -> Optional[str]:
+    fromByteOrderMark = byteOrderMarkEncoding(document)
+    if fromByteOrderMark is not None:
+        return fromByteOrderMark
+    fromHeader = None if headerCharset is None else codecFor(headerCharset)
+    if fromHeader is not None:
+        return fromHeader
+    return metaEncoding(document[:PRESCAN_BYTES])
+
+
+def byteOrderMarkEncoding(document: bytes) -> Optional[str]:
+    return next((encoding for (bom, encoding) in BYTE_ORDER_MARKS if document.startswith(bom)), None)
+
+
+# b"" if the document does not start with one.
+def byteOrderMark(document: bytes) -> bytes:
+    return next((bom for (bom, _) in BYTE_ORDER_MARKS if document.startswith(bom)), b"")
+
+
+def metaEncoding(prefix: bytes) -> Optional[str]:
+    for match in REGEX_PRESCAN.finditer(prefix):
+        attributes = match.group(REGEXGROUP_ATTRIBUTES)
+        if attributes is None:
+            continue # a comment or another tag
+        encoding = metaElementEncoding(attributes)
+        if encoding is not None:
+            return META_UTF16_REPLACEMENT if encoding.startswith("utf-16") else encoding
+    return None
+
+
+def metaElementEncoding(attributes: bytes) -> Optional[str]:
+    seen: set[bytes] = set()
+    isContentType = False
+    needsContentType: Optional[bool] = None # True if the charset comes from a content attribute, which only counts with http-equiv="content-type"
+    encoding: Optional[str] = None
+    for match in REGEX_ATTRIBUTE.finditer(attributes):
+        name = match.group(1).lower()
+        if name in seen:
+            continue # only the first one counts
+        seen.add(name)
+        value: bytes = next((v for v in match.groups()[1:] if v is not None), b"")
+        if name == ATTRIBUTE_HTTP_EQUIV:
+            isContentType = value.strip().lower() == HTTP_EQUIV_CONTENT_TYPE
+        elif name == ATTRIBUTE_CHARSET and needsContentType is None:
+            encoding = codecFor(value.decode("ascii", "replace"))
+            needsContentType = False
+        elif name == ATTRIBUTE_CONTENT and needsContentType is None:
+            contentCharset = REGEX_CONTENT_CHARSET.search(value)
+            if contentCharset is not None:
+                encoding = codecFor(next(v for v in contentCharset.groups() if v is not None).decode("ascii", "replace"))
+                needsContentType = True
+    if needsContentType is None or (needsContentType and not isContentType):
+        return None
+    return encoding
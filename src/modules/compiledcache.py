@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+from typing import Any, Iterable, Optional
+
+import modules.constants as C
+from modules.userscript import CompiledMetadata
+
+# On-disk cache of CompiledMetadata, keyed by a hash of the userscript's
+# content, so that unchanged userscripts do not have to be parsed again after a
+# restart. The whole cache is discarded if it was written by another version,
+# because what we compute from a userscript may differ between versions.
+
+CACHE_FILENAME: str = "compiled-userscripts.json"
+# Bump if the structure of the cache file changes:
+FORMAT: int = 1
+
+KEY_VERSION: str = "version"
+KEY_FORMAT: str = "format"
+KEY_ENTRIES: str = "entries"
+
+
+class CompiledCache:
+    def __init__(self, path: Optional[str], entries: dict[str, CompiledMetadata]) -> None:
+        self.path = path # None means that the cache is not persisted
+        self.entries = entries
+        self.dirty = False
+
+    def get(self, digest: str) -> Optional[CompiledMetadata]:
+        return self.entries.get(digest)
+
+    # Putting back what was just gotten (e.g. for a cache hit) does not make the cache dirty, so it is not written again.
+    def put(self, digest: str, compiled: CompiledMetadata) -> None:
+        if self.entries.get(digest) == compiled:
+            return
+        self.entries[digest] = compiled
+        self.dirty = True
+
+    # Only the entries in use are kept, so that the cache does not grow forever.
+    def save(self, inUse: Iterable[str]) -> None:
+        keep = set(inUse)
+        if not self.dirty and keep == set(self.entries):
+            return
+        self.entries = { digest: compiled for digest, compiled in self.entries.items() if digest in keep }
+        self.dirty = False
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so that a crash cannot leave a half-written cache behind:
+        (fd, temporaryPath) = tempfile.mkstemp(dir=directory, prefix=CACHE_FILENAME + ".")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    KEY_VERSION: C.VERSION,
+                    KEY_FORMAT: FORMAT,
+                    KEY_ENTRIES: { digest: compiled._asdict() for digest, compiled in self.entries.items() },
+                }, f)
+            os.replace(temporaryPath, self.path)
+        except BaseException:
+            os.unlink(temporaryPath)
+            raise
+
+
+def disabled() -> CompiledCache:
+    return CompiledCache(None, {})
+
+
+# A missing, unreadable, outdated or corrupt cache is treated as empty.
+def load(directory: str) -> CompiledCache:
+    path = os.path.join(directory, CACHE_FILENAME)
+    try:
+        with open(path) as f:
+            stored: Any = json.load(f)
+        if stored[KEY_VERSION] != C.VERSION or stored[KEY_FORMAT] != FORMAT:
+            return CompiledCache(path, {})
+        return CompiledCache(path, {
+            digest: CompiledMetadata(**fields) for digest, fields in stored[KEY_ENTRIES].items()
+        })
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return CompiledCache(path, {})
@@ -0,0 +1,140 @@
+import gzip
+import ipaddress
+import threading
+import time
+from typing import Any, NamedTuple, Optional
+
+import brotli
+from mitmproxy.net.http import encoding
+
+# Decompressing a web page before injecting userscripts into it and
+# compressing it again afterwards, instead of letting mitmproxy do it with its
+# default (maximum) compression levels. The compression level is chosen per
+# client; CPU time and bytes are recorded so that the levels can be tuned.
+
+IDENTITY: str = "identity"
+GZIP: str = "gzip"
+BROTLI: str = "br"
+# In order of preference, if the client accepts several of them:
+PREFERRED_ENCODINGS: list[str] = [ BROTLI, GZIP ]
+MIN_LEVEL: int = 0 # uncompressed
+MAX_LEVEL: int = 9
+SEPARATOR: str = ","
+PARAMETER_SEPARATOR: str = ";"
+QUALITY_ZERO: list[str] = [ "q=0", "q=0.0", "q=0.00", "q=0.000" ]
+
+
+class Measurements(NamedTuple):
+    decompressedBytesIn: int
+    decompressedBytesOut: int
+    decompressSeconds: float
+    compressedBytesIn: int
+    compressedBytesOut: int
+    compressSeconds: float
+
+
+# Thread-safe, but not shared between processes; use measurements/add for that.
+class Stats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.decompressedBytesIn = 0
+        self.decompressedBytesOut = 0
+        self.decompressSeconds = 0.0
+        self.compressedBytesIn = 0
+        self.compressedBytesOut = 0
+        self.compressSeconds = 0.0
+        self.passedThrough = 0
+
+    def recordDecompression(self, bytesIn: int, bytesOut: int, seconds: float) -> None:
+        with self._lock:
+            self.decompressedBytesIn += bytesIn
+            self.decompressedBytesOut += bytesOut
+            self.decompressSeconds += seconds
+
+    def recordCompression(self, bytesIn: int, bytesOut: int, seconds: float) -> None:
+        with self._lock:
+            self.compressedBytesIn += bytesIn
+            self.compressedBytesOut += bytesOut
+            self.compressSeconds += seconds
+
+    def measurements(self) -> Measurements:
+        with self._lock:
+            return Measurements(
+                decompressedBytesIn = self.decompressedBytesIn,
+                decompressedBytesOut = self.decompressedBytesOut,
+                decompressSeconds = self.decompressSeconds,
+                compressedBytesIn = self.compressedBytesIn,
+                compressedBytesOut = self.compressedBytesOut,
+                compressSeconds = self.compressSeconds,
+            )
+
+    def add(self, m: Measurements) -> None:
+        self.recordDecompression(m.decompressedBytesIn, m.decompressedBytesOut, m.decompressSeconds)
+        self.recordCompression(m.compressedBytesIn, m.compressedBytesOut, m.compressSeconds)
+
+    def recordPassThrough(self) -> None:
+        with self._lock:
+            self.passedThrough += 1
+
+    def summary(self) -> str:
+        with self._lock:
+            return (
+                f"decompressed {self.decompressedBytesIn} -> {self.decompressedBytesOut} bytes in {self.decompressSeconds:.3f} s CPU, "
+                + f"compressed {self.compressedBytesIn} -> {self.compressedBytesOut} bytes in {self.compressSeconds:.3f} s CPU, "
+                + f"{self.passedThrough} page(s) passed through untouched"
+            )
+
+
+def acceptedEncodings(acceptEncoding: str) -> set[str]:
+    accepted: set[str] = set()
+    for item in acceptEncoding.split(SEPARATOR):
+        [name, *parameters] = [ part.strip().lower() for part in item.split(PARAMETER_SEPARATOR) ]
+        if name != "" and not any(parameter in QUALITY_ZERO for parameter in parameters):
+            accepted.add(name)
+    return accepted
+
+
+# What to ask the server for instead of what the client accepts; the client must still be able to handle the response as is.
+def negotiatedAcceptEncoding(clientAcceptEncoding: str, cheaperEncodings: str) -> str:
+    accepted = acceptedEncodings(clientAcceptEncoding)
+    negotiated = [ e for e in acceptedEncodings(cheaperEncodings) if e in accepted ]
+    return SEPARATOR.join(sorted(negotiated)) if len(negotiated) > 0 else IDENTITY
+
+
+def isLocalClient(address: Any) -> bool:
+    try:
+        ip = ipaddress.ip_address(address[0])
+    except (TypeError, ValueError, IndexError):
+        return False
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_private or ip.is_loopback or ip.is_link_local
+
+
+def chosenEncoding(acceptEncoding: str, level: int) -> str:
+    if level <= MIN_LEVEL:
+        return IDENTITY
+    accepted = acceptedEncodings(acceptEncoding)
+    return next((e for e in PREFERRED_ENCODINGS if e in accepted), IDENTITY)
+
+
+def decompressed(raw: bytes, contentEncoding: Optional[str], stats: Stats) -> bytes: # raises ValueError
+    if contentEncoding is None or contentEncoding.strip().lower() in [ "", IDENTITY ]:
+        return raw
+    start = time.thread_time()
+    content: bytes = encoding.decode(raw, contentEncoding)
+    stats.recordDecompression(len(raw), len(content), time.thread_time() - start)
+    return content
+
+
+def compressed(content: bytes, contentEncoding: str, level: int, stats: Stats) -> bytes:
+    level = max(1, min(level, MAX_LEVEL))
+    start = time.thread_time()
+    if contentEncoding == GZIP:
+        raw = gzip.compress(content, compresslevel=level)
+    elif contentEncoding == BROTLI:
+        raw = brotli.compress(content, quality=level)
+    else:
+        return content
+    stats.recordCompression(len(content), len(raw), time.thread_time() - start)
+    return raw
@@ -1,17 +1,26 @@
 import secrets
 from typing import NamedTuple, Optional
 
+from modules.cache import LRUCache
+from modules.inject import Payload
 from modules.userscript import Userscript
 
 # Reference: https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Security-Policy
 
+NONCE_SOURCE_PREFIX: str = "'nonce-"
+CACHE_SIZE: int = 256 # distinct combinations of site CSP headers and userscripts
+
 
 class Injection(NamedTuple):
     userscript: Userscript
     nonce: Optional[str]
+    payload: Payload
+    mode: str # inject.MODE_*
+    bundled: tuple[Userscript, ...] = () # further userscripts included in the same payload
+    hashed: bool = False # allowed by the hash of its inline script rather than by nonce or URL
 
 
-def headerWithScriptsAllowed(cspHeaderValue: str, injections: list[Injection]) -> str:
+def headerWithScriptsAllowed(cspHeaderValue: str, sourcesToAllow: list[str]) -> str:
     # Example CSP header:
     #
     #     Content-Security-Policy: default-src 'self'; frame-src 'self'; img-src https:; connect-src 'self'
@@ -22,14 +31,27 @@ def headerWithScriptsAllowed(cspHeaderValue: str, injections: list[Injection]) -
         # Browsers fall back to default-src if there is no script-src.
         # Since there was no script-src directive and we are adding one, we include the default-src (if present) in it to avoid breaking the site's effective CSP.
         cspDict["script-src"] = cspDict["default-src"] if "default-src" in cspDict else ""
-    sourcesToAllow = [ source(i) for i in injections ]
     cspDict["script-src"] += " " + " ".join(sourcesToAllow)
     return '; '.join([ f'{key} {value}' for key, value in cspDict.items() ])
 
 
+# The result only depends on the arguments, so it is remembered, except when a random nonce would make that pointless.
+def cachedHeaderWithScriptsAllowed(cache: LRUCache[tuple[str, tuple[str, ...]], str], cspHeaderValue: str, sourcesToAllow: list[str]) -> str:
+    if any(s.startswith(NONCE_SOURCE_PREFIX) for s in sourcesToAllow):
+        return headerWithScriptsAllowed(cspHeaderValue, sourcesToAllow)
+    key = (cspHeaderValue, tuple(sourcesToAllow))
+    header = cache.get(key)
+    if header is None:
+        header = headerWithScriptsAllowed(cspHeaderValue, sourcesToAllow)
+        cache.put(key, header)
+    return header
+
+
 def source(injection: Injection) -> str:
     if injection.nonce is not None:
-        return f"'nonce-{injection.nonce}'"
+        return f"{NONCE_SOURCE_PREFIX}{injection.nonce}'"
+    elif injection.hashed and injection.payload.hashSource is not None:
+        return injection.payload.hashSource
     else:
         # MDN about host (i.e. download URL) sources: "Unlike other values below, single quotes shouldn't be used."
         return injection.userscript.downloadURL
@@ -37,3 +59,4 @@ def source(injection: Injection) -> str:
 
 def generateNonce() -> str:
     return secrets.token_hex() # If no argument is passed, "a reasonable default is used" for the number of bytes.
+
@@ -0,0 +1,137 @@
+import glob
+import os
+import re
+from typing import NamedTuple, Optional
+
+import modules.constants as C
+import modules.ignore as ignore
+
+# Decides which connections are ignored (or, with --intercept, intercepted)
+# based on the host and port they are made to. Most rules are plain hostnames,
+# optionally with a port; a host matches such a rule if the rule is the host
+# itself or one of its parent domains, so those rules are looked up by each
+# suffix of the host (e.g. x.site.com, site.com, com), which is what walking a
+# reversed-label trie amounts to, without a node per label. Only the other
+# rules (wildcards and regexes) are combined into one regex. Thus even a
+# blocklist with hundreds of thousands of hosts costs a handful of dictionary
+# lookups per connection.
+
+LABEL_SEPARATOR: str = "."
+PORT_SEPARATOR: str = ":"
+REGEX_PLAIN_RULE: re.Pattern = re.compile(r"^([a-z0-9_-]+(?:\.[a-z0-9_-]+)*)(?::(\d+))?$", re.IGNORECASE)
+SNI_PORT: int = 443 # what mitmproxy checks a TLS client's SNI against
+
+
+class HostRules(NamedTuple):
+    rules: list[str] # as written
+    hosts: dict[str, int] # rules without a port, by host; the values are positions in rules
+    hostsWithPort: dict[tuple[str, int], int]
+    regex: Optional[re.Pattern] # all other rules combined, to check them all at once; None if they cannot be combined
+    regexes: list[tuple[int, re.Pattern]] # the same rules one by one, to find out which one matched
+    hits: list[int] # same order as rules
+
+
+def rulePatterns(customPattern: Optional[str], useDefaultRules: bool, useIntercept: bool) -> list[str]:
+    patterns: list[str] = []
+    if useDefaultRules:
+        patterns.append(C.DEFAULT_INTERCEPT_RULES if useIntercept else C.DEFAULT_IGNORE_RULES)
+    if customPattern is not None:
+        patterns.append(customPattern)
+    return patterns
+
+
+def ruleFiles(customPattern: Optional[str], useDefaultRules: bool, useIntercept: bool) -> list[str]:
+    return [ path for pattern in rulePatterns(customPattern, useDefaultRules, useIntercept) for path in glob.glob(pattern) ]
+
+
+# The directories to watch for changes to the files matched by the patterns, i.e. what precedes the first component
+# with a wildcard (e.g. rules/ for rules/*/hosts.txt), so that directories that only start matching later are noticed too:
+def watchedDirectories(patterns: list[str]) -> list[str]:
+    directories: list[str] = []
+    for pattern in patterns:
+        (directory, _) = os.path.split(pattern)
+        while glob.has_magic(directory):
+            directory = os.path.dirname(directory)
+        directory = directory or os.curdir
+        if directory not in directories:
+            directories.append(directory)
+    return directories
+
+
+# Returns the rules and a list of errors, e.g. invalid regexes (which are left out). Raises OSError.
+def load(files: list[str]) -> tuple[HostRules, list[str]]:
+    rules: list[str] = []
+    for path in files:
+        with open(path) as f:
+            rules += ignore.rulesIn(f.read())
+    return compiled(rules)
+
+
+def compiled(rules: list[str]) -> tuple[HostRules, list[str]]:
+    hosts: dict[str, int] = {}
+    hostsWithPort: dict[tuple[str, int], int] = {}
+    regexes: list[tuple[int, re.Pattern]] = []
+    errors: list[str] = []
+    for position, rule in enumerate(rules):
+        match = REGEX_PLAIN_RULE.match(rule)
+        if match is not None:
+            (host, port) = (match.group(1).lower(), match.group(2))
+            if port is None:
+                hosts.setdefault(host, position)
+            else:
+                hostsWithPort.setdefault((host, int(port)), position)
+            continue
+        regex = ignore.ignoreRegex(rule)
+        try:
+            regexes.append((position, re.compile(regex, re.IGNORECASE)))
+        except re.error as e:
+            errors.append(f"Invalid rule `{rule}`: {e}")
+    return (HostRules(
+        rules = rules,
+        hosts = hosts,
+        hostsWithPort = hostsWithPort,
+        regex = combinedRegex([ r for (_, r) in regexes ]),
+        regexes = regexes,
+        hits = [ 0 for _ in rules ],
+    ), errors)
+
+
+def combinedRegex(regexes: list[re.Pattern]) -> Optional[re.Pattern]:
+    if len(regexes) == 0:
+        return None
+    try:
+        return re.compile("|".join(f"(?:{r.pattern})" for r in regexes), re.IGNORECASE)
+    except re.error:
+        return None # e.g. a rule with an inline flag, which is only allowed at the very start
+
+
+# Returns the position of a matching rule, if any, and counts the hit.
+def lookup(hostRules: HostRules, host: str, port: int) -> Optional[int]:
+    position = plainRuleFor(hostRules, host.lower(), port)
+    if position is None and len(hostRules.regexes) > 0:
+        address = host + PORT_SEPARATOR + str(port) # like mitmproxy's --ignore-hosts
+        if hostRules.regex is None or hostRules.regex.search(address) is not None:
+            position = next((p for (p, r) in hostRules.regexes if r.search(address) is not None), None)
+    if position is not None:
+        hostRules.hits[position] += 1
+    return position
+
+
+def plainRuleFor(hostRules: HostRules, host: str, port: int) -> Optional[int]:
+    suffix = host
+    while True:
+        position = hostRules.hosts.get(suffix)
+        if position is None and len(hostRules.hostsWithPort) > 0:
+            position = hostRules.hostsWithPort.get((suffix, port))
+        if position is not None:
+            return position
+        dot = suffix.find(LABEL_SEPARATOR)
+        if dot < 0:
+            return None
+        suffix = suffix[dot + 1:]
+
+
+def summary(hostRules: HostRules, top: int = 10) -> str:
+    hit = sorted([ (count, position) for position, count in enumerate(hostRules.hits) if count > 0 ], reverse=True)
+    mostHit = ", ".join(f"`{hostRules.rules[position]}` ({count})" for (count, position) in hit[:top])
+    return f"{sum(hostRules.hits)} connections matched {len(hit)} of {len(hostRules.rules)} rules" + ("" if len(hit) == 0 else f"; most matched: {mostHit}")
@@ -4,7 +4,6 @@ from modules.patterns import isIncludePattern_regex, regexify, withoutSurroundin
 
 COMMENT_PREFIX: str = "#"
 PORT_PREFIX: str = ":"
-PIPE: str = "|"
 REGEX_COMMENT: re.Pattern = re.compile(r"\#.*$")
 
 def rulesIn(text: str) -> list[str]:
@@ -28,15 +27,3 @@ def ignoreRegex(ignoreRule: str) -> str:
         if isIncludePattern_regex(ignoreRule)
         else r"^(?:.+\.)?" + withPortSuffix(regexify(ignoreRule)) + r"$"
     )
-
-
-def entireIgnoreRegex(ignoreFileContent: str) -> str:
-    return PIPE.join(map(
-        ignoreRegex,
-        rulesIn(ignoreFileContent)
-    ))
-
-
-# https://stackoverflow.com/a/2637899
-def negate(regex: str) -> str:
-    return "^(?!(?:" + regex + ")$).*$"
@@ -1,58 +1,167 @@
-from typing import NamedTuple, Optional, Union
-
-from bs4 import BeautifulSoup, Tag
+import base64
+import codecs
+import hashlib
+import html
+from typing import TYPE_CHECKING, Iterable, NamedTuple, Optional, Union
 
 import modules.constants as C
 import modules.userscript as userscript
 from modules.userscript import Userscript, document_end, document_idle
 from modules.utilities import fromOptional, idem, stripIndentation
 
+# Importing BeautifulSoup (and lxml) is a noticeable part of starting the proxy,
+# and nothing here needs it except for type annotations (see rewriting):
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup, Tag
+
 class Options(NamedTuple):
     inline: bool
     nonce: Optional[str]
 
 
-def inject(script: Userscript, soup: BeautifulSoup, options: Options) -> Union[BeautifulSoup, Exception]:
+# Everything needed to build the <script> element for a userscript, independent of how it is inserted into the page:
+class ScriptTag(NamedTuple):
+    attributes: dict[str, str]
+    string: Optional[str]
+    late: bool # insert at the end of <body> rather than early in the document
+
+
+def scriptTag(script: Userscript, options: Options) -> ScriptTag:
     useInline = options.inline or script.downloadURL is None
-    tag = soup.new_tag("script")
+    attributes: dict[str, str] = {}
     if options.nonce is not None:
-        tag["nonce"] = options.nonce # Used to bypass CSP for inline-injected userscripts.
-    tag[C.ATTRIBUTE_UP_VERSION] = C.VERSION
+        attributes["nonce"] = options.nonce # Used to bypass CSP for inline-injected userscripts.
+    attributes[C.ATTRIBUTE_UP_VERSION] = C.VERSION
     withLoadListenerIfRunAtIdle = userscript.withEventListener("load") if script.runAt == document_idle else idem
     withNoframesIfNoframes = userscript.withNoframes if script.noframes else idem
+    string: Optional[str] = None
+    if useInline:
+        string = "\n" + withNoframesIfNoframes(withLoadListenerIfRunAtIdle(script.content))
+    else:
+        s = "s" # JS variable name
+        src = userscript.withVersionSuffix(script.downloadURL, script.version)
+        JS_insertScriptTag = f"""document.head.appendChild({s});"""
+        JS_insertionCode = (stripIndentation(f"""
+            const {s} = document.createElement("script");
+            {s}.setAttribute("{C.ATTRIBUTE_UP_VERSION}", "{C.VERSION}");
+            {s}.src = "{src}";
+            {withLoadListenerIfRunAtIdle(JS_insertScriptTag)}
+        """))
+        if script.runAt == document_idle or script.noframes:
+            string = withNoframesIfNoframes(JS_insertionCode)
+        else:
+            attributes["src"] = src
+    return ScriptTag(
+        attributes = attributes,
+        string = string,
+        late = script.runAt == document_end,
+    )
+
+
+# A script tag prepared once per userscript when it is loaded, so that injecting it only requires concatenation:
+class Payload(NamedTuple):
+    tag: ScriptTag # without nonce
+    beforeNonce: str # serialized tag up to where a nonce attribute would go
+    afterNonce: str # the rest of the serialized tag
+    encoded: dict[str, tuple[bytes, bytes]] # beforeNonce and afterNonce by codec name, filled in as needed
+    digest: str # of beforeNonce and afterNonce, to tell payloads apart without comparing them
+    hashSource: Optional[str] # CSP source allowing the tag's inline script, e.g. 'sha256-...'; None if the tag has no inline script
+
+
+class Payloads(NamedTuple):
+    inline: Payload
+    linked: Optional[Payload] # only for userscripts with a @downloadURL
+
+
+ATTRIBUTE_NONCE: str = "nonce"
+
+# How a userscript ends up in a page:
+MODE_INLINE: str = "inline"
+MODE_LINKED: str = "linked" # from its @downloadURL
+MODE_SERVED: str = "served" # from the proxy itself
+MODE_BUNDLED: str = "bundled" # from the proxy itself, together with others
+PRE_ENCODED_CHARSETS: list[str] = ["utf-8"]
+
+
+def serializedAttributes(attributes: Iterable[tuple[str, str]]) -> str:
+    return "".join([ f' {name}="{html.escape(value)}"' for name, value in attributes ])
+
+
+def serialize(tag: ScriptTag) -> str:
+    # Sorted to match the attribute order in BeautifulSoup's output:
+    return f"""<script{serializedAttributes(sorted(tag.attributes.items()))}>{"" if tag.string is None else tag.string}</script>"""
+
+
+def payloadFor(tag: ScriptTag) -> Payload:
+    attributes = sorted(tag.attributes.items())
+    beforeNonce = "<script" + serializedAttributes([ a for a in attributes if a[0] < ATTRIBUTE_NONCE ])
+    afterNonce = serializedAttributes([ a for a in attributes if a[0] > ATTRIBUTE_NONCE ]) + ">" + ("" if tag.string is None else tag.string) + "</script>"
+    return Payload(
+        tag = tag,
+        beforeNonce = beforeNonce,
+        afterNonce = afterNonce,
+        encoded = { charset: (beforeNonce.encode(charset, "replace"), afterNonce.encode(charset, "replace")) for charset in PRE_ENCODED_CHARSETS },
+        digest = hashlib.sha256("\0".join([beforeNonce, afterNonce]).encode("utf-8", "replace")).hexdigest(),
+        hashSource = None if tag.string is None else hashSource(tag.string),
+    )
+
+
+def hashSource(script: str) -> str:
+    # Browsers hash the script as parsed, and HTML parsing turns every line break into \n:
+    normalized = script.replace("\r\n", "\n").replace("\r", "\n")
+    return "'sha256-" + base64.b64encode(hashlib.sha256(normalized.encode("utf-8", "replace")).digest()).decode("ascii") + "'"
+
+
+def payloadsFor(script: Userscript) -> Payloads:
+    return Payloads(
+        inline = payloadFor(scriptTag(script, Options(inline=True, nonce=None))),
+        linked = None if script.downloadURL is None else payloadFor(scriptTag(script, Options(inline=False, nonce=None))),
+    )
+
+
+def chosenPayload(payloads: Payloads, inline: bool) -> Payload:
+    return payloads.inline if inline or payloads.linked is None else payloads.linked
+
+
+def withNonce(tag: ScriptTag, nonce: Optional[str]) -> ScriptTag:
+    return tag if nonce is None else tag._replace(attributes={ **tag.attributes, ATTRIBUTE_NONCE: nonce })
+
+
+# `encoding` must be a codec name as returned by codecs.lookup.
+def encodedPayload(payload: Payload, nonce: Optional[str], encoding: str) -> bytes:
+    encoded = payload.encoded.get(encoding)
+    if encoded is None:
+        encoded = (payload.beforeNonce.encode(encoding, "replace"), payload.afterNonce.encode(encoding, "replace"))
+        payload.encoded[encoding] = encoded
+    (beforeNonce, afterNonce) = encoded
+    return beforeNonce + ("" if nonce is None else serializedAttributes([(ATTRIBUTE_NONCE, nonce)])).encode(encoding) + afterNonce
+
+
+def encodedTags(injections: list[tuple[Payload, Optional[str]]], encoding: str) -> tuple[bytes, bytes]:
+    codec = codecs.lookup(encoding).name
+    # insertEarlyIn inserts each tag before the previously inserted one, so they end up in reverse order:
+    early = [ encodedPayload(payload, nonce, codec) for payload, nonce in reversed(injections) if not payload.tag.late ]
+    late = [ encodedPayload(payload, nonce, codec) for payload, nonce in injections if payload.tag.late ]
+    return (b"".join(early), b"".join(late))
+
+
+def inject(prepared: ScriptTag, soup: "BeautifulSoup") -> Union["BeautifulSoup", Exception]:
+    tag = soup.new_tag("script", attrs=prepared.attributes)
     try:
-        if useInline:
-            tag.string = "\n" + withNoframesIfNoframes(withLoadListenerIfRunAtIdle(script.content))
-            if script.runAt == document_end:
-                insertLateIn(soup, tag)
-            else:
-                insertEarlyIn(soup, tag)
+        if prepared.string is not None:
+            tag.string = prepared.string
+        # Tag prepared. Insert it:
+        if prepared.late:
+            insertLateIn(soup, tag)
         else:
-            s = "s" # JS variable name
-            src = userscript.withVersionSuffix(script.downloadURL, script.version)
-            JS_insertScriptTag = f"""document.head.appendChild({s});"""
-            JS_insertionCode = (stripIndentation(f"""
-                const {s} = document.createElement("script");
-                {s}.setAttribute("{C.ATTRIBUTE_UP_VERSION}", "{C.VERSION}");
-                {s}.src = "{src}";
-                {withLoadListenerIfRunAtIdle(JS_insertScriptTag)}
-            """))
-            if script.runAt == document_idle or script.noframes:
-                tag.string = withNoframesIfNoframes(JS_insertionCode)
-            else:
-                tag["src"] = src
-            # Tag prepared. Insert it:
-            if script.runAt == document_end:
-                insertLateIn(soup, tag)
-            else:
-                insertEarlyIn(soup, tag)
+            insertEarlyIn(soup, tag)
         return soup
     except Exception as e:
         return e
 
 
 
-def insertEarlyIn(soup: BeautifulSoup, tag: Tag) -> None:
+def insertEarlyIn(soup: "BeautifulSoup", tag: "Tag") -> None:
     if soup.body is not None and soup.body.find() is not None:
         soup.body.find().insert_before(tag)
     elif soup.title is not None:
@@ -63,5 +172,5 @@ def insertEarlyIn(soup: BeautifulSoup, tag: Tag) -> None:
         soup.append(tag)
 
 
-def insertLateIn(soup: BeautifulSoup, tag: Tag) -> None:
+def insertLateIn(soup: "BeautifulSoup", tag: "Tag") -> None:
     fromOptional(soup.body, soup).append(tag)
@@ -0,0 +1,100 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, Optional, Union
+
+import modules.metadata as metadata
+import modules.userscript as userscript
+from modules.userscript import CompiledMetadata
+from modules.watching import FileState, stateOf
+
+# Finding, reading and parsing userscript files. Reading is I/O-bound (and may
+# be slow if the directory is on a network mount), so it is done on a thread
+# pool; parsing is CPU-bound, so it is done on a process pool if there is
+# enough of it. Results are always returned in the order of the paths.
+
+USERSCRIPT_SUFFIX: str = ".user.js"
+HIDDEN_PREFIX: str = "." # skipped like glob does
+SKIP_DIRS_SEPARATOR: str = ","
+READ_WORKERS: int = 16
+# Below this, starting worker processes takes longer than parsing:
+PARALLEL_PARSE_THRESHOLD: int = 16
+
+ParseResult = Union[CompiledMetadata, metadata.MetadataError]
+
+
+class FileRead(NamedTuple):
+    path: str
+    state: Optional[FileState]
+    raw: Optional[bytes] # None if unchanged (or unreadable)
+    digest: Optional[str]
+    error: Optional[Exception]
+
+
+def skipDirsFrom(value: str) -> frozenset[str]:
+    return frozenset(name.strip() for name in value.split(SKIP_DIRS_SEPARATOR) if name.strip() != "")
+
+
+def userscriptPathsIn(directory: str, skipDirs: frozenset[str]) -> list[str]:
+    paths: list[str] = []
+    visited: set[tuple[int, int]] = set() # (device, inode), to not loop forever on symlinks
+    pending: list[str] = [directory]
+    while len(pending) > 0:
+        current = pending.pop()
+        try:
+            stat = os.stat(current)
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.name.startswith(HIDDEN_PREFIX):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            if entry.name not in skipDirs:
+                                pending.append(entry.path)
+                        elif entry.name.endswith(USERSCRIPT_SUFFIX) and entry.is_file():
+                            paths.append(entry.path)
+                    except OSError:
+                        continue # e.g. a broken symlink
+        except OSError:
+            continue # e.g. removed while we were looking
+    return sorted(paths)
+
+
+def readFile(path: str, previous: Optional[FileState]) -> FileRead:
+    try:
+        state = stateOf(path) # before reading, so that a concurrent write is noticed next time
+        if state == previous:
+            return FileRead(path, state, None, None, None)
+        with open(path, "rb") as f:
+            raw = f.read()
+        return FileRead(path, state, raw, hashlib.sha256(raw).hexdigest(), None)
+    except Exception as e:
+        return FileRead(path, None, None, None, e)
+
+
+def readFiles(paths: list[str], previous: dict[str, FileState]) -> list[FileRead]:
+    if len(paths) <= 1:
+        return [ readFile(path, previous.get(path)) for path in paths ]
+    with ThreadPoolExecutor(max_workers=min(READ_WORKERS, len(paths))) as pool:
+        return list(pool.map(lambda path: readFile(path, previous.get(path)), paths))
+
+
+def compiledOrError(content: str) -> ParseResult:
+    try:
+        return userscript.compiledMetadata(content)
+    except metadata.MetadataError as err:
+        return err
+
+
+def compileAll(contents: list[str]) -> list[ParseResult]:
+    if len(contents) >= PARALLEL_PARSE_THRESHOLD:
+        try:
+            with ProcessPoolExecutor() as pool:
+                return list(pool.map(compiledOrError, contents, chunksize=max(1, len(contents) // (4 * (os.cpu_count() or 1)))))
+        except (OSError, NotImplementedError, BrokenProcessPool):
+            pass # e.g. no multiprocessing support on this platform; parse here instead
+    return [ compiledOrError(content) for content in contents ]
@@ -0,0 +1,216 @@
+import asyncio
+import queue
+import sys
+import threading
+import time
+from typing import Callable, NamedTuple, Optional, TextIO
+
+# Log messages are handed over to a background thread, which collapses
+# repetitions and hands what is left to the sink (i.e. mitmproxy's log, so that
+# messages show up in mitmweb too and termlog_verbosity applies) in batches on
+# the event loop, so that handling a response never waits for any of that.
+# Messages about individual pages belong to a category, which can be turned
+# down to a level or sampled, and a message that is logged over and over (e.g.
+# the same error for every request) is written once and then summarized
+# periodically. Until the proxy is running, messages are handed to the sink
+# right away, so that nothing logged during startup can get lost or reordered.
+# Whatever the sink does not take, e.g. because the event loop is already
+# closed when the proxy shuts down, is written to the terminal directly.
+
+LEVEL_OFF: str = "off"
+LEVEL_ERROR: str = "error"
+LEVEL_WARN: str = "warn"
+LEVEL_INFO: str = "info"
+LEVELS: dict[str, int] = { LEVEL_OFF: -1, LEVEL_ERROR: 0, LEVEL_WARN: 1, LEVEL_INFO: 2 } # like mitmproxy's log tiers
+
+CATEGORY_GENERAL: str = "general" # startup, (re)loading userscripts etc.; always logged in full
+CATEGORY_INJECTION: str = "injection" # which userscripts are injected into which page
+CATEGORY_CSP: str = "csp" # what is done to Content-Security-Policy headers
+CATEGORY_PAGE: str = "page" # problems with individual pages
+CATEGORIES: list[str] = [ CATEGORY_INJECTION, CATEGORY_CSP, CATEGORY_PAGE ] # the ones that can be configured
+
+SPEC_SEPARATOR: str = ","
+SPEC_ASSIGNMENT: str = "="
+SUMMARY_INTERVAL_SECONDS: float = 60.0
+MAX_DISTINCT: int = 10000 # messages remembered for collapsing repetitions, per summary interval
+
+
+class Record(NamedTuple):
+    level: str
+    category: str
+    message: str
+
+
+# Parses e.g. "injection=warn,csp=off". Raises ValueError.
+def levelsFrom(spec: str) -> dict[str, str]:
+    levels: dict[str, str] = {}
+    for (category, value) in assignmentsIn(spec):
+        if value not in LEVELS:
+            raise ValueError(f"`{value}` is not a log level; use one of {', '.join(LEVELS)}")
+        levels[category] = value
+    return levels
+
+
+# Parses e.g. "injection=100", meaning one in every 100 messages. Raises ValueError.
+def samplesFrom(spec: str) -> dict[str, int]:
+    samples: dict[str, int] = {}
+    for (category, value) in assignmentsIn(spec):
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError(f"`{value}` is not a positive integer")
+        samples[category] = int(value)
+    return samples
+
+
+def assignmentsIn(spec: str) -> list[tuple[str, str]]:
+    assignments: list[tuple[str, str]] = []
+    for item in spec.split(SPEC_SEPARATOR):
+        if item.strip() == "":
+            continue
+        (category, assignment, value) = item.partition(SPEC_ASSIGNMENT)
+        if assignment == "" or category.strip() not in CATEGORIES:
+            raise ValueError(f"`{item.strip()}` does not have the form CATEGORY{SPEC_ASSIGNMENT}VALUE, where CATEGORY is one of {', '.join(CATEGORIES)}")
+        assignments.append((category.strip(), value.strip()))
+    return assignments
+
+
+def summaryLine(record: Record, count: int) -> str:
+    firstLine = record.message.strip().split("\n")[0]
+    return f"The following message was logged {count} more time(s) in the last {round(SUMMARY_INTERVAL_SECONDS)} seconds: {firstLine}"
+
+
+class Logger(threading.Thread):
+    # `sink` gets the level and the message; it must be called on the event loop and may raise if it cannot take the message.
+    def __init__(self, stdout: TextIO = sys.stdout, stderr: TextIO = sys.stderr, sink: Optional[Callable[[str, str], None]] = None) -> None:
+        super().__init__(daemon=True)
+        self.stdout = stdout
+        self.stderr = stderr
+        self.sink = sink
+        self.verbosity = LEVEL_INFO
+        self.levels: dict[str, str] = {}
+        self.samples: dict[str, int] = {}
+        self._queue: queue.SimpleQueue[Optional[Record]] = queue.SimpleQueue() # None means stop
+        self._counters: dict[str, int] = {} # by category, for sampling
+        self._sampledOut: dict[str, int] = {} # by category, since the last summary
+        self._countLock = threading.Lock() # for both of the above, since messages are logged from worker threads too
+        self._seen: dict[Record, int] = {} # repetitions since the last summary, by record
+        self._writeLock = threading.Lock()
+        self._asynchronous = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # Whether a message would be written at all; for callers that want to skip formatting it.
+    def wants(self, level: str, category: str = CATEGORY_GENERAL) -> bool:
+        return LEVELS[level] <= min(LEVELS[self.verbosity], LEVELS[self.levels.get(category, LEVEL_INFO)])
+
+    def log(self, level: str, message: str, category: str = CATEGORY_GENERAL) -> None:
+        if not self.wants(level, category):
+            return
+        sampleEvery = self.samples.get(category, 1)
+        if sampleEvery > 1:
+            with self._countLock:
+                counter = self._counters.get(category, 0) + 1
+                self._counters[category] = counter
+                sampledOut = counter % sampleEvery != 1 # so that the very first one is written
+                if sampledOut:
+                    self._sampledOut[category] = self._sampledOut.get(category, 0) + 1
+            if sampledOut:
+                return
+        record = Record(level, category, message)
+        if self._asynchronous:
+            self._queue.put(record)
+        else:
+            self._write([ record ])
+
+    # Called on `loop` when the proxy is up and running; from then on, messages are handled by the background thread.
+    def goAsynchronous(self, loop: asyncio.AbstractEventLoop) -> None:
+        if not self._asynchronous:
+            self._loop = loop
+            self._asynchronous = True
+            self.start()
+
+    def run(self) -> None:
+        nextSummary = time.monotonic() + SUMMARY_INTERVAL_SECONDS
+        while True:
+            batch: list[Optional[Record]] = []
+            try:
+                batch.append(self._queue.get(timeout=max(0, nextSummary - time.monotonic())))
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            stopped = None in batch
+            self._write([ r for r in batch if r is not None ])
+            if stopped or time.monotonic() >= nextSummary:
+                self._writeSummaries()
+                nextSummary = time.monotonic() + SUMMARY_INTERVAL_SECONDS
+            if stopped:
+                return
+
+    # Writes whatever is still queued, including summaries.
+    def stop(self) -> None:
+        if self._asynchronous:
+            self._queue.put(None)
+            self.join()
+            self._asynchronous = False
+        else:
+            self._writeSummaries()
+
+    def _write(self, records: list[Record]) -> None:
+        written: list[tuple[str, str]] = [] # level and message
+        with self._writeLock:
+            for record in records:
+                repetitions = self._seen.get(record)
+                if repetitions is not None:
+                    self._seen[record] = repetitions + 1
+                    continue # written before; will be summarized
+                if record.category != CATEGORY_GENERAL and len(self._seen) < MAX_DISTINCT:
+                    self._seen[record] = 0
+                written.append((record.level, record.message))
+        self._deliver(written)
+
+    def _writeSummaries(self) -> None:
+        written: list[tuple[str, str]] = []
+        with self._writeLock:
+            for (record, count) in self._seen.items():
+                if count > 0:
+                    written.append((record.level, summaryLine(record, count)))
+            self._seen.clear()
+        with self._countLock:
+            for (category, count) in self._sampledOut.items():
+                if count > 0:
+                    written.append((LEVEL_INFO, f"{count} `{category}` message(s) were left out by sampling in the last {round(SUMMARY_INTERVAL_SECONDS)} seconds."))
+            self._sampledOut.clear()
+        self._deliver(written)
+
+    # From the background thread, messages are handed to the sink on the event loop, in the order they were written.
+    def _deliver(self, written: list[tuple[str, str]]) -> None:
+        if len(written) == 0:
+            return
+        loop = self._loop
+        if threading.current_thread() is not self or loop is None:
+            self._emit(written)
+            return
+        try:
+            loop.call_soon_threadsafe(self._emit, written)
+        except RuntimeError: # the event loop is closed
+            self._print(written)
+
+    def _emit(self, written: list[tuple[str, str]]) -> None:
+        sink = self.sink
+        if sink is None:
+            self._print(written)
+            return
+        for (position, (level, message)) in enumerate(written):
+            try:
+                sink(level, message)
+            except Exception:
+                self._print(written[position:]) # e.g. mitmproxy is not running (yet or anymore)
+                return
+
+    def _print(self, written: list[tuple[str, str]]) -> None:
+        try:
+            for (stream, lines) in [ (self.stdout, [ m for (l, m) in written if l != LEVEL_ERROR ]), (self.stderr, [ m for (l, m) in written if l == LEVEL_ERROR ]) ]:
+                if len(lines) > 0:
+                    stream.write("".join(line + "\n" for line in lines))
+                    stream.flush()
+        except (OSError, ValueError):
+            pass # e.g. the terminal is gone; there is nowhere to report that anyway.
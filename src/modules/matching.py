@@ -0,0 +1,119 @@
+import re
+from typing import Iterable, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from modules.patterns import MatchPatternMatcher, isIncludePattern_regex
+from modules.userscript import Userscript
+
+# An index over all loaded userscripts that narrows down which of them can
+# possibly apply to a URL, based on the host it points to. It only produces
+# candidates; whether a candidate actually applies is still decided by
+# userscript.applicableChecker.
+
+LABEL_SEPARATOR: str = "."
+
+# An @include glob only pins down the host if the scheme and host are literal and followed by a path:
+REGEX_INCLUDE_LITERAL_HOST: re.Pattern = re.compile(r"^https?://([^/*:@?#]+)(?::\d+)?/", re.IGNORECASE)
+
+
+class TrieNode(NamedTuple):
+    children: dict[str, "TrieNode"]
+    positions: set[int]
+
+
+class MatchIndex(NamedTuple):
+    userscripts: list[Userscript]
+    everywhere: set[int] # <all_urls>, host `*` and patterns we cannot index by host
+    exact: dict[str, set[int]]
+    suffixes: TrieNode # by reversed host labels, e.g. com -> example for *.example.com
+
+
+class HostKey(NamedTuple):
+    host: Optional[str] # None means any host
+    includeSubdomains: bool
+
+
+def emptyTrieNode() -> TrieNode:
+    return TrieNode(children={}, positions=set())
+
+
+def hostKeyOfMatcher(matcher: MatchPatternMatcher) -> HostKey:
+    return HostKey(
+        None if matcher.host is None else indexedHost(matcher.host),
+        matcher.includeSubdomains,
+    )
+
+
+# The host as hostOf would see it, without any userinfo or port, e.g. example.com for user@example.com:8080.
+# None (i.e. any host) if it cannot be determined, so that the pattern is checked for every URL instead.
+def indexedHost(host: str) -> Optional[str]:
+    try:
+        return urlsplit("//" + host).hostname or None
+    except ValueError:
+        return None
+
+
+def hostKeyOfIncludePattern(pattern: str) -> HostKey:
+    if isIncludePattern_regex(pattern):
+        return HostKey(None, False)
+    match = REGEX_INCLUDE_LITERAL_HOST.match(pattern)
+    return HostKey(None, False) if match is None else HostKey(match.group(1).lower(), False)
+
+
+def reversedLabels(host: str) -> list[str]:
+    return list(reversed(host.split(LABEL_SEPARATOR)))
+
+
+def index(userscripts: list[Userscript]) -> MatchIndex:
+    everywhere: set[int] = set()
+    exact: dict[str, set[int]] = {}
+    suffixes: TrieNode = emptyTrieNode()
+    for position, script in enumerate(userscripts):
+        # Exclude patterns can only make a script inapplicable, so they are irrelevant here.
+        keys: Iterable[HostKey] = (
+            [ hostKeyOfMatcher(matcher) for matcher in script.matchPatternMatchers ]
+            + [ hostKeyOfIncludePattern(pattern) for pattern in script.includePatterns ]
+        )
+        for key in set(keys):
+            if key.host is None:
+                everywhere.add(position)
+            elif key.includeSubdomains:
+                node = suffixes
+                for label in reversedLabels(key.host):
+                    node = node.children.setdefault(label, emptyTrieNode())
+                node.positions.add(position)
+            else:
+                exact.setdefault(key.host, set()).add(position)
+    return MatchIndex(
+        userscripts = userscripts,
+        everywhere = everywhere,
+        exact = exact,
+        suffixes = suffixes,
+    )
+
+
+def hostOf(url: str) -> str:
+    try:
+        return urlsplit(url).hostname or ""
+    except ValueError:
+        return ""
+
+
+# Returns the positions of the scripts that may apply to the URL, in ascending order.
+def lookupPositions(matchIndex: MatchIndex, url: str) -> list[int]:
+    host = hostOf(url)
+    positions: set[int] = set(matchIndex.everywhere)
+    positions.update(matchIndex.exact.get(host, set()))
+    node: TrieNode = matchIndex.suffixes
+    for label in reversedLabels(host):
+        child = node.children.get(label)
+        if child is None:
+            break
+        positions.update(child.positions)
+        node = child
+    return sorted(positions)
+
+
+# Returns the scripts that may apply to the URL, in the same order as in the index.
+def lookup(matchIndex: MatchIndex, url: str) -> list[Userscript]:
+    return [ matchIndex.userscripts[position] for position in lookupPositions(matchIndex, url) ]
@@ -1,9 +1,8 @@
-import functools
 import re
 from string import Template
-from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional, TypeVar, Union
+from typing import Any, Callable, NamedTuple, Optional, TypeVar, Union
 
-from modules.utilities import first, second
+from modules.utilities import first
 
 class MetadataError(Exception):
     def __init__(self,*args: Any,**kwargs: Any) -> None:
@@ -96,11 +95,14 @@ STRING_ERROR_PREDICATE_FAILED: Template = Template(f"""Detected a {tag("$tagName
 """)
 
 
+REGEX_WHITESPACE_LINE: re.Pattern = re.compile(r"^\s*$")
+REGEX_COMMENT_LINE: re.Pattern = re.compile(r"^\s*" + PREFIX_COMMENT + r".*$")
+
 def isWhitespaceLine(s: str) -> bool:
-    return re.compile(r"^\s*$").match(s) is not None
+    return REGEX_WHITESPACE_LINE.match(s) is not None
 
 def isCommentLine(s: str) -> bool:
-    return re.compile(r"^\s*" + PREFIX_COMMENT + r".*$").match(s) is not None
+    return REGEX_COMMENT_LINE.match(s) is not None
 
 def extract(userscriptContent: str) -> str: # raises MetadataError
     match_metadataBlock: Optional[re.Match] = REGEX_METADATA_BLOCK.search(userscriptContent)
@@ -139,9 +141,21 @@ def tagByName(tags: list[Tag], tagName: str) -> Optional[Tag]:
     return next((x for x in tags if x.name == tagName), None)
 
 
+TagIndex = dict[str, Tag]
+
+def tagIndex(tags: list[Tag]) -> TagIndex:
+    index: TagIndex = {}
+    for tag in tags:
+        index.setdefault(tag.name, tag) # first one wins, like in tagByName
+    return index
+
+
 def validatePair(tags: list[Tag], pair: MetadataItem) -> MetadataItem:
+    return validatePairAgainst(tagByName(tags, first(pair)), pair)
+
+
+def validatePairAgainst(tag: Optional[Tag], pair: MetadataItem) -> MetadataItem:
     (tagName, tagValue) = pair
-    tag: Optional[Tag] = tagByName(tags, tagName)
     if tag is None:
         # Unrecognized key.
         return (tagName, tagValue)
@@ -159,57 +173,53 @@ def validatePair(tags: list[Tag], pair: MetadataItem) -> MetadataItem:
 
 
 def validate(tags: list[Tag], metadata: Metadata) -> Metadata: # raises MetadataError
-    def handleDuplicate(acc: Iterable[MetadataItem], pair: MetadataItem) -> Iterable[MetadataItem]:
+    return validateWith(tags, tagIndex(tags), metadata)
+
+
+# Linear in the number of items. Errors are reported in the same order as if
+# we first checked for required directives, then removed duplicates of unique
+# directives, then added defaults and finally validated each item.
+def validateWith(tags: list[Tag], index: TagIndex, metadata: Metadata) -> Metadata: # raises MetadataError
+    seenTagNames: set[str] = set()
+    validated: Metadata = []
+    firstError: Optional[MetadataError] = None
+    for pair in metadata:
         name: str = first(pair)
-        tag: Optional[Tag] = tagByName(tags, name)
-        seenTagNames: Iterator[str] = map(first, acc)
+        tag: Optional[Tag] = index.get(name)
         # Throw away pair if it has the same tag name as some already seen, known, unique directive:
-        return acc if tag is not None and tag.unique and name in seenTagNames else list(acc) + [pair]
-
-    def withoutDuplicates(metadata: Metadata) -> Metadata:
-        empty: Iterable[tuple[str, Union[str, bool]]] = [] # to satisfy mypy
-        return list(functools.reduce(handleDuplicate, metadata, empty))
-
-    # Awkwardly written to satisfy mypy:
-    def withDefaults(metadata: Metadata) -> Metadata:
-        tagNamesThatWeHave: list[str] = list(map(first, metadata))
-        unseenItems = map(
-            lambda tag: (tag.name, tag.default),
-            filter(
-                lambda tag: tag.name not in tagNamesThatWeHave,
-                tags
-            )
-        )
-        neededDefaults: Metadata = []
-        for (tagName, default) in unseenItems:
-            if default is not None:
-                neededDefaults.append((tagName, default))
-        return metadata + neededDefaults
-
-    def assertRequiredPresent(metadata: Metadata) -> Metadata:
-        ourTagNames: Iterator[str] = map(first, metadata)
-        requiredTags: Iterator[Tag] = filter(lambda tag: tag.required, tags)
-        for tag in requiredTags:
-            if (tag.name not in ourTagNames):
-                raise MetadataError(STRING_ERROR_MISSING_TAG.substitute(tagName=tag.name))
-        return metadata
-
-    return list(map(
-        lambda *args: validatePair(tags, *args),
-        withDefaults(withoutDuplicates(
-            assertRequiredPresent(metadata)
-        ))
-    ))
+        if tag is not None and tag.unique and name in seenTagNames:
+            continue
+        seenTagNames.add(name)
+        if firstError is None:
+            try:
+                validated.append(validatePairAgainst(tag, pair))
+            except MetadataError as error:
+                firstError = error # A missing required directive takes precedence.
+    for tag in tags:
+        if tag.required and tag.name not in seenTagNames:
+            raise MetadataError(STRING_ERROR_MISSING_TAG.substitute(tagName=tag.name))
+    if firstError is not None:
+        raise firstError
+    for tag in tags:
+        if tag.name not in seenTagNames and tag.default is not None:
+            validated.append(validatePairAgainst(index.get(tag.name), (tag.name, tag.default)))
+    return validated
 
 
 def validator(tags: list[Tag]) -> Callable[[Metadata], Metadata]:
-    return lambda metadata: validate(tags, metadata)
+    index = tagIndex(tags)
+    return lambda metadata: validateWith(tags, index, metadata)
 
 
 def valueGetter_all(metadata: Metadata) -> Callable[[Tag], list[TagValue]]:
-    return lambda tag: [second(pair) for pair in metadata if first(pair) == tag.name]
+    valuesByName: dict[str, list[TagValue]] = {}
+    for (name, value) in metadata:
+        valuesByName.setdefault(name, []).append(value)
+    return lambda tag: list(valuesByName.get(tag.name, []))
 
 
 def valueGetter_one(metadata: Metadata) -> Callable[[Tag], Optional[TagValue]]:
-    v = valueGetter_all(metadata)
-    return lambda tag: None if len(v(tag)) == 0 else v(tag)[0]
+    firstValueByName: dict[str, TagValue] = {}
+    for (name, value) in metadata:
+        firstValueByName.setdefault(name, value)
+    return lambda tag: firstValueByName.get(tag.name)
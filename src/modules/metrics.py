@@ -0,0 +1,279 @@
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Iterable
+
+# Counters and latency histograms, exposed in the OpenMetrics (Prometheus)
+# text format. Each mitmdump process records its own metrics and periodically
+# writes a snapshot of them to a shared directory; whoever serves the metrics
+# (see restartable_launcher.py) adds up the snapshots of all processes, and
+# folds the snapshot of a process that has exited into the retired totals, so
+# that counters never go down. This module only uses the standard library, so
+# that it can be imported outside mitmproxy.
+
+PREFIX: str = "userscript_proxy_"
+CONTENT_TYPE: str = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+SNAPSHOT_PREFIX: str = "metrics-"
+SNAPSHOT_SUFFIX: str = ".json"
+RETIRED_NAME: str = "retired" # what processes that have exited recorded, added up
+EXPORT_INTERVAL_SECONDS: float = 5.0
+
+# Upper bounds in seconds; from well below what a tiny page costs to well above what a huge one does:
+BUCKETS: list[float] = [ 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 ]
+
+# Stages of handling a response, in order:
+STAGE_CONTENT_TYPE: str = "content_type"
+STAGE_MATCH: str = "match"
+STAGE_DECODE: str = "decode"
+STAGE_PARSE: str = "parse"
+STAGE_INJECT: str = "inject"
+STAGE_SERIALIZE: str = "serialize"
+STAGE_ENCODE: str = "encode"
+STAGE_CSP: str = "csp"
+STAGE_TOTAL: str = "total" # including waiting for a worker
+
+STAGE_SECONDS: str = "stage_seconds"
+PAGES: str = "pages"
+BYTES_IN: str = "bytes_in"
+BYTES_OUT: str = "bytes_out"
+INJECTIONS: str = "injections"
+CONNECTIONS: str = "connections"
+
+OUTCOME_REWRITTEN: str = "rewritten"
+OUTCOME_CACHED: str = "cached" # served from the page cache
+OUTCOME_COALESCED: str = "coalesced" # got the result of a rewrite of the same page that was already in progress
+OUTCOME_SKIPPED: str = "skipped" # no userscripts to inject
+OUTCOME_STREAMED: str = "streamed"
+OUTCOME_OVERLOADED: str = "overloaded" # passed through because too many pages were being rewritten
+OUTCOME_FAILED: str = "failed"
+
+DECISION_IGNORED: str = "ignored" # passed through without being looked at, due to the host rules
+DECISION_INTERCEPTED: str = "intercepted"
+
+HELP: dict[str, str] = {
+    STAGE_SECONDS: "Time spent in each stage of handling a web page",
+    PAGES: "Web pages handled, by outcome",
+    BYTES_IN: "Bytes of web pages received from servers, as received",
+    BYTES_OUT: "Bytes of rewritten web pages sent to clients, as sent",
+    INJECTIONS: "Userscripts injected, by name",
+    CONNECTIONS: "Connections, by whether the host rules made mitmproxy ignore them",
+}
+
+KEY_COUNTERS: str = "counters"
+KEY_HISTOGRAMS: str = "histograms"
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def labelsFrom(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.buckets: list[int] = [ 0 for _ in BUCKETS ] # not cumulative; see render
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+# Thread-safe, because responses may be finished in worker threads.
+class Metrics:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, Labels], float] = {}
+        self._histograms: dict[tuple[str, Labels], Histogram] = {}
+
+    def count(self, name: str, labels: dict[str, str] = {}, value: float = 1) -> None:
+        key = (name, labelsFrom(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict[str, str], seconds: float) -> None:
+        key = (name, labelsFrom(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram()
+                self._histograms[key] = histogram
+            histogram.observe(seconds)
+
+    def observeStages(self, timings: dict[str, float]) -> None:
+        for stage, seconds in timings.items():
+            self.observe(STAGE_SECONDS, { "stage": stage }, seconds)
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                KEY_COUNTERS: [ [ name, dict(labels), value ] for (name, labels), value in self._counters.items() ],
+                KEY_HISTOGRAMS: [ [ name, dict(labels), h.buckets.copy(), h.count, h.sum ] for (name, labels), h in self._histograms.items() ],
+            }
+
+
+# `name` identifies the process, e.g. worker-1-2 for the second generation of worker 1.
+def snapshotPath(directory: str, name: str) -> str:
+    return os.path.join(directory, f"{SNAPSHOT_PREFIX}{name}{SNAPSHOT_SUFFIX}")
+
+
+def writeJSON(path: str, data: dict[str, Any]) -> None: # raises OSError
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file first, so that a reader never sees a half-written snapshot:
+    (fd, temporaryPath) = tempfile.mkstemp(dir=directory, prefix=".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temporaryPath, path)
+    except BaseException:
+        os.unlink(temporaryPath)
+        raise
+
+
+def writeSnapshot(directory: str, name: str, metrics: Metrics) -> None: # raises OSError
+    writeJSON(snapshotPath(directory, name), metrics.snapshot())
+
+
+def readSnapshot(path: str) -> dict[str, Any]: # raises OSError and ValueError
+    with open(path) as f:
+        return json.load(f)
+
+
+# Snapshots that cannot be read (e.g. deleted in the meantime) are skipped.
+def readSnapshots(directory: str) -> list[dict[str, Any]]:
+    snapshots: list[dict[str, Any]] = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return snapshots
+    for name in sorted(names):
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+            try:
+                snapshots.append(readSnapshot(os.path.join(directory, name)))
+            except (OSError, ValueError):
+                continue
+    return snapshots
+
+
+# Adds the last snapshot of a process that has exited to the retired totals and removes it. The caller must make sure
+# that nobody reads the snapshots in the meantime, or they would see that process counted twice (or not at all).
+def retireSnapshot(directory: str, name: str) -> None: # raises OSError
+    path = snapshotPath(directory, name)
+    try:
+        snapshot = readSnapshot(path)
+    except FileNotFoundError:
+        return # e.g. the process exited before writing one
+    except ValueError:
+        snapshot = {}
+    retiredPath = snapshotPath(directory, RETIRED_NAME)
+    try:
+        retired = readSnapshot(retiredPath)
+    except (FileNotFoundError, ValueError):
+        retired = {}
+    writeJSON(retiredPath, added([ retired, snapshot ]))
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def removeSnapshots(directory: str) -> None:
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class Exporter(threading.Thread):
+    def __init__(self, directory: str, name: str, metrics: Metrics) -> None:
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.snapshotName = name
+        self.metrics = metrics
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(EXPORT_INTERVAL_SECONDS):
+            self.export()
+
+    def export(self) -> None:
+        try:
+            writeSnapshot(self.directory, self.snapshotName, self.metrics)
+        except OSError:
+            pass # Metrics are not worth crashing or spamming the log over; the next attempt may work.
+
+    # Writes a final snapshot, so that nothing recorded since the last one is lost.
+    def stop(self) -> None:
+        self._stopped.set()
+        self.export()
+
+
+def escaped(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def formattedLabels(labels: Iterable[tuple[str, str]]) -> str:
+    pairs = [ f'{name}="{escaped(value)}"' for name, value in labels ]
+    return "" if len(pairs) == 0 else "{" + ",".join(pairs) + "}"
+
+
+def formattedNumber(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# Adds up snapshots into one.
+def added(snapshots: list[dict[str, Any]]) -> dict[str, Any]:
+    (counters, histograms) = totals(snapshots)
+    return {
+        KEY_COUNTERS: [ [ name, dict(labels), value ] for name, family in counters.items() for labels, value in family.items() ],
+        KEY_HISTOGRAMS: [ [ name, dict(labels), *histogram ] for name, family in histograms.items() for labels, histogram in family.items() ],
+    }
+
+
+def totals(snapshots: list[dict[str, Any]]) -> tuple[dict[str, dict[Labels, float]], dict[str, dict[Labels, tuple[list[int], int, float]]]]:
+    counters: dict[str, dict[Labels, float]] = {}
+    histograms: dict[str, dict[Labels, tuple[list[int], int, float]]] = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot.get(KEY_COUNTERS, []):
+            family = counters.setdefault(name, {})
+            key = labelsFrom(labels)
+            family[key] = family.get(key, 0) + value
+        for name, labels, buckets, count, total in snapshot.get(KEY_HISTOGRAMS, []):
+            histogramFamily = histograms.setdefault(name, {})
+            key = labelsFrom(labels)
+            (oldBuckets, oldCount, oldTotal) = histogramFamily.get(key, ([ 0 for _ in BUCKETS ], 0, 0.0))
+            histogramFamily[key] = ([ a + b for a, b in zip(oldBuckets, buckets) ], oldCount + count, oldTotal + total)
+    return (counters, histograms)
+
+
+# Adds up the snapshots of all processes.
+def render(snapshots: list[dict[str, Any]]) -> str:
+    (counters, histograms) = totals(snapshots)
+    lines: list[str] = []
+    for name in sorted(histograms):
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+        for labels, (buckets, count, total) in sorted(histograms[name].items()):
+            cumulative = 0
+            for bound, inBucket in zip(BUCKETS, buckets):
+                cumulative += inBucket
+                lines.append(f"{PREFIX}{name}_bucket{formattedLabels([ *labels, ('le', repr(bound)) ])} {cumulative}")
+            lines.append(f"{PREFIX}{name}_bucket{formattedLabels([ *labels, ('le', '+Inf') ])} {count}")
+            lines.append(f"{PREFIX}{name}_count{formattedLabels(labels)} {count}")
+            lines.append(f"{PREFIX}{name}_sum{formattedLabels(labels)} {formattedNumber(total)}")
+    for name in sorted(counters):
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+        for labels, value in sorted(counters[name].items()):
+            lines.append(f"{PREFIX}{name}_total{formattedLabels(labels)} {formattedNumber(value)}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
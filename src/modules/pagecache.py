@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import modules.compression as compression
+import modules.csp as csp
+from modules.settings import Settings
+
+# Rewritten web pages, keyed by everything the rewritten bytes depend on, so
+# that a page that is requested again unchanged (e.g. a popular start page) is
+# not decompressed, parsed and compressed all over again. Pages that get a
+# nonce are not cached, since a nonce must be unpredictable and therefore
+# different for every response. The cache is bounded by the total size of the
+# cached bodies. Pages evicted from memory can be spilled to a directory,
+# which is bounded in the same way, and are read back from there when
+# requested again.
+
+SPILL_SUFFIX: str = ".page"
+# The spill directory may hold this many times as much as memory:
+SPILL_FACTOR: int = 8
+HEADER_SEPARATOR: bytes = b"\n"
+
+KEY_KEY: str = "key"
+KEY_CONTENT_ENCODING: str = "contentEncoding"
+KEY_SOURCES: str = "sources"
+
+
+# What the output depends on for each injected userscript:
+class InjectionKey(NamedTuple):
+    payload: str # digest
+    mode: str
+    hashed: bool
+    source: str # to allow in the Content-Security-Policy header
+    scripts: tuple[tuple[str, Optional[str]], ...] # name and version of the userscript and any bundled with it, as listed by --list-injected
+
+
+class PageKey(NamedTuple):
+    body: str # digest of the body as received from the server
+    contentEncoding: Optional[str] # of the body as received from the server
+    encoding: Optional[str] # charset
+    injections: tuple[InjectionKey, ...] # in order
+    rewriteEngine: str
+    listInjected: bool
+    inline: bool
+    bypassCsp: Optional[str]
+    cspHashes: bool
+    serveUserscripts: bool
+    bundleUserscripts: bool
+    newContentEncoding: str
+    level: int
+
+
+class CachedPage(NamedTuple):
+    raw: bytes
+    contentEncoding: str
+    sources: list[str] # to allow in the Content-Security-Policy header
+
+
+def bodyDigest(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+
+def isCacheable(candidates: list[csp.Injection]) -> bool:
+    return all(c.nonce is None for c in candidates)
+
+
+def injectionKey(injection: csp.Injection) -> InjectionKey:
+    return InjectionKey(
+        payload = injection.payload.digest,
+        mode = injection.mode,
+        hashed = injection.hashed,
+        source = csp.source(injection),
+        scripts = tuple((s.name, s.version) for s in (injection.userscript, *injection.bundled)),
+    )
+
+
+# Only for candidates that are cacheable.
+def keyFor(
+    body: str,
+    contentEncoding: Optional[str],
+    encoding: Optional[str],
+    candidates: list[csp.Injection],
+    settings: Settings,
+    newContentEncoding: str,
+    level: int,
+) -> PageKey:
+    return PageKey(
+        body = body,
+        contentEncoding = contentEncoding,
+        encoding = encoding,
+        injections = tuple(injectionKey(c) for c in candidates),
+        rewriteEngine = settings.rewriteEngine,
+        listInjected = settings.listInjected,
+        inline = settings.inline,
+        bypassCsp = settings.bypassCsp,
+        cspHashes = settings.cspHashes,
+        serveUserscripts = settings.serveUserscripts,
+        bundleUserscripts = settings.bundleUserscripts,
+        newContentEncoding = newContentEncoding,
+        level = 0 if newContentEncoding == compression.IDENTITY else level, # uncompressed is uncompressed at any level
+    )
+
+
+def serializedKey(key: PageKey) -> str:
+    return json.dumps(key)
+
+
+class PageCache:
+    # Raises OSError if spillDirectory cannot be used.
+    def __init__(self, maxBytes: int, spillDirectory: Optional[str]) -> None:
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[PageKey, CachedPage] = OrderedDict()
+        self._bytes = 0
+        self._spilled: OrderedDict[str, int] = OrderedDict() # file name -> size, least recently spilled first
+        self._spilledBytes = 0
+        self.maxBytes = maxBytes
+        self.spillDirectory = spillDirectory
+        self.hits = 0
+        self.spillHits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.bytesSaved = 0
+        if spillDirectory is not None and self.enabled():
+            os.makedirs(spillDirectory, exist_ok=True)
+            # Pages spilled by an earlier run are not known to this one, so they would only take up space:
+            for name in os.listdir(spillDirectory):
+                if name.endswith(SPILL_SUFFIX):
+                    os.unlink(os.path.join(spillDirectory, name))
+
+    def enabled(self) -> bool:
+        return self.maxBytes > 0
+
+    def get(self, key: PageKey) -> Optional[CachedPage]:
+        with self._lock:
+            page = self._entries.get(key)
+            if page is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.bytesSaved += len(page.raw)
+                return page
+            page = self._readSpilled(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.spillHits += 1
+            self.bytesSaved += len(page.raw)
+        self.put(key, page)
+        return page
+
+    # For a request that missed, but got the page from another request for the same page that was already being rewritten.
+    def recordCoalesced(self, page: CachedPage) -> None:
+        with self._lock:
+            self.coalesced += 1
+            self.bytesSaved += len(page.raw)
+
+    def put(self, key: PageKey, page: CachedPage) -> None:
+        if len(page.raw) > self.maxBytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.raw)
+            self._entries[key] = page
+            self._bytes += len(page.raw)
+            while self._bytes > self.maxBytes:
+                (evictedKey, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.raw)
+                self._spill(evictedKey, evicted)
+
+    def _fileName(self, key: PageKey) -> str:
+        return hashlib.sha256(serializedKey(key).encode()).hexdigest() + SPILL_SUFFIX
+
+    # The cache is only an optimization, so a spill directory that stops working is simply not used.
+    def _spill(self, key: PageKey, page: CachedPage) -> None:
+        if self.spillDirectory is None:
+            return
+        name = self._fileName(key)
+        if name in self._spilled:
+            self._spilled.move_to_end(name) # already on disk from an earlier eviction
+            return
+        header = json.dumps({
+            KEY_KEY: key,
+            KEY_CONTENT_ENCODING: page.contentEncoding,
+            KEY_SOURCES: page.sources,
+        }).encode()
+        try:
+            # Write to a temporary file first, so that a crash cannot leave a half-written page behind:
+            (fd, temporaryPath) = tempfile.mkstemp(dir=self.spillDirectory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(header + HEADER_SEPARATOR + page.raw)
+                os.replace(temporaryPath, os.path.join(self.spillDirectory, name))
+            except BaseException:
+                os.unlink(temporaryPath)
+                raise
+        except OSError:
+            return
+        self._spilled[name] = len(page.raw)
+        self._spilledBytes += len(page.raw)
+        while self._spilledBytes > SPILL_FACTOR * self.maxBytes:
+            (oldest, size) = self._spilled.popitem(last=False)
+            self._spilledBytes -= size
+            try:
+                os.unlink(os.path.join(self.spillDirectory, oldest))
+            except OSError:
+                pass
+
+    def _readSpilled(self, key: PageKey) -> Optional[CachedPage]:
+        name = self._fileName(key)
+        if self.spillDirectory is None or name not in self._spilled:
+            return None
+        try:
+            with open(os.path.join(self.spillDirectory, name), "rb") as f:
+                (header, raw) = f.read().split(HEADER_SEPARATOR, 1)
+            stored = json.loads(header)
+            if stored[KEY_KEY] != json.loads(serializedKey(key)):
+                return None
+            return CachedPage(raw=raw, contentEncoding=stored[KEY_CONTENT_ENCODING], sources=stored[KEY_SOURCES])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def summary(self) -> str:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return (
+                f"{self.hits} hits ({self.spillHits} from disk), {self.misses} misses ({self.coalesced} of them coalesced with a rewrite in progress), "
+                + f"{0 if lookups == 0 else round(100 * self.hits / lookups)}% hit ratio, "
+                + f"{self.bytesSaved} bytes served without rewriting, "
+                + f"{self._bytes}/{self.maxBytes} bytes in memory, {self._spilledBytes} bytes on disk"
+            )
@@ -1,5 +1,6 @@
+import functools
 import re
-from typing import Optional
+from typing import NamedTuple, Optional
 
 from modules.utilities import first
 
@@ -80,3 +81,93 @@ def hostIn(matchPattern: str) -> Optional[str]:
 
 def pathIn(matchPattern: str) -> Optional[str]:
     return extractGroup(REGEXGROUP_MATCH_PATH, matchPattern)
+
+
+# @match patterns are compiled once, at load time, into matchers that behave
+# exactly like urlmatch(pattern, url), which would otherwise parse the pattern
+# and build a regex for it on every call.
+
+URLMATCH_PATTERN_SEPARATOR = ","
+URLMATCH_SCHEMES_ANY = frozenset(["http", "https"])
+URLMATCH_SCHEME_SEPARATOR = "://"
+URLMATCH_ANY = "*"
+REGEX_URLMATCH_SCHEME = re.compile(r"^(\*|https?):\/\/")
+REGEX_URLMATCH_HOST = re.compile(r"^(?:\*|(\*\.)?([^\/*]+))(?=\/)")
+# urlmatch allows HTTP auth in front of the host:
+REGEX_URLMATCH_AUTH = re.compile(r"[^\/:.]+(?:\:[^\/:.]+)?@")
+
+
+class MatchPatternMatcher(NamedTuple):
+    schemes: frozenset[str]
+    host: Optional[str] # None means any host
+    includeSubdomains: bool
+    pathRegex: re.Pattern
+
+
+class SplitURL(NamedTuple):
+    scheme: str
+    authority: str # everything between :// and the first / after it
+    path: str # everything from that / on, including any query string
+
+
+# Returns None if the pattern is not valid according to urlmatch (which would raise an exception for it).
+def matcherFromMatchPatternPart(part: str) -> Optional[MatchPatternMatcher]:
+    scheme = REGEX_URLMATCH_SCHEME.search(part)
+    if scheme is None:
+        return None
+    rest = part[scheme.end():]
+    host = REGEX_URLMATCH_HOST.search(rest)
+    if host is None:
+        return None
+    path = rest[host.end():]
+    return MatchPatternMatcher(
+        schemes = URLMATCH_SCHEMES_ANY if scheme.group(1) == URLMATCH_ANY else frozenset([scheme.group(1)]),
+        host = host.group(2),
+        includeSubdomains = host.group(1) is not None,
+        pathRegex = re.compile(".*".join(map(re.escape, path.split(URLMATCH_ANY))) + r"(\/.*)?$"),
+    )
+
+
+@functools.lru_cache(maxsize=None) # so that scripts with identical patterns share matchers
+def matchersFromMatchPattern(pattern: str) -> list[MatchPatternMatcher]:
+    # urlmatch treats a comma-separated pattern as several patterns:
+    matchers: list[MatchPatternMatcher] = []
+    for part in pattern.split(URLMATCH_PATTERN_SEPARATOR):
+        matcher = matcherFromMatchPatternPart(part.strip())
+        if matcher is not None:
+            matchers.append(matcher)
+    return matchers
+
+
+def splitURL(url: str) -> Optional[SplitURL]:
+    separator = url.find(URLMATCH_SCHEME_SEPARATOR)
+    if separator < 0:
+        return None
+    rest = url[separator+len(URLMATCH_SCHEME_SEPARATOR):]
+    slash = rest.find("/")
+    if slash < 0:
+        return None # urlmatch requires a path
+    return SplitURL(
+        scheme = url[:separator],
+        authority = rest[:slash],
+        path = rest[slash:],
+    )
+
+
+def hostMatches(matcher: MatchPatternMatcher, authority: str) -> bool:
+    host = matcher.host
+    if host is None:
+        return authority != ""
+    if authority == host:
+        return True
+    if matcher.includeSubdomains and len(authority) > len(host) + 1 and authority.endswith("." + host):
+        return True
+    return authority.endswith(host) and REGEX_URLMATCH_AUTH.fullmatch(authority[:len(authority)-len(host)]) is not None
+
+
+def matcherMatches(matcher: MatchPatternMatcher, url: SplitURL) -> bool:
+    return (
+        url.scheme in matcher.schemes
+        and hostMatches(matcher, url.authority)
+        and matcher.pathRegex.match(url.path) is not None
+    )
@@ -8,7 +8,14 @@ from mitmproxy import http
 
 from modules.utilities import equals
 
+ACCEPT: str = "Accept"
+ACCEPT_ENCODING: str = "Accept-Encoding"
+CONTENT_LENGTH: str = "Content-Length"
 CONTENT_TYPE: str = "Content-Type"
+VARY: str = "Vary"
+CONTENT_ENCODING: str = "Content-Encoding"
+TRANSFER_ENCODING: str = "Transfer-Encoding"
+CHUNKED: str = "chunked"
 REGEX_CHARSET: re.Pattern = re.compile(r"charset=([^;\s]+)")
 
 def inferEncoding(response: http.HTTPResponse) -> Optional[str]:
@@ -0,0 +1,184 @@
+import time
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+import modules.arguments as A
+import modules.charset as charset
+import modules.compression as compression
+import modules.csp as csp
+import modules.inject as inject
+import modules.metrics as metrics
+import modules.splice as splice
+import modules.text as T
+from modules.settings import Settings
+from modules.utilities import fromOptional
+
+# BeautifulSoup is only needed by the soup engine, and importing it (and lxml)
+# is a noticeable part of starting the proxy, so it is imported when first used:
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+# Inserting userscripts into a complete web page. Nothing here depends on
+# mitmproxy or logs anything, so that it can run in a worker thread or process;
+# problems are reported back in the result instead.
+
+CHARSET_DEFAULT: str = "utf-8"
+HTML_PARSER: str = "lxml"
+# lxml handles non-uppercase DOCTYPE correctly; html.parser does not: It emits
+# <!DOCTYPE doctype html> if the original source code contained <!doctype html>.
+HTML_INFO_COMMENT_PREFIX: str = f"""
+[{T.INFO_MESSAGE}]
+"""
+WARM_UP_PAGE: bytes = b"<!DOCTYPE html><html><head><title></title></head><body><p></p></body></html>"
+
+
+class RewriteResult(NamedTuple):
+    content: bytes
+    injections: list[csp.Injection]
+    errors: list[str] # to be logged
+    timings: dict[str, float] # seconds by metrics.STAGE_*
+
+
+# A rewritten, re-encoded response body:
+class Rewritten(NamedTuple):
+    raw: bytes
+    contentEncoding: str
+    injections: list[csp.Injection]
+    errors: list[str]
+    measurements: compression.Measurements
+    timings: dict[str, float]
+
+
+def indexOfDTD(soup: "BeautifulSoup") -> Optional[int]:
+    from bs4 import Doctype
+    index: int = 0
+    for item in soup.contents:
+        if isinstance(item, Doctype):
+            return index
+        index += 1
+    return None
+
+
+# Does the one-time work of the first page up front: importing BeautifulSoup and
+# lxml and letting them set up their parser, and running the splice engine's
+# regexes once.
+def warmUp() -> None:
+    from bs4 import BeautifulSoup
+    str(BeautifulSoup(WARM_UP_PAGE, HTML_PARSER, from_encoding=CHARSET_DEFAULT))
+    splice.insertionPointsFor(WARM_UP_PAGE, CHARSET_DEFAULT)
+
+
+# Raises ValueError if the body cannot be decompressed.
+def rewriteBody(
+    raw: bytes,
+    contentEncoding: Optional[str],
+    encoding: Optional[str],
+    candidates: list[csp.Injection],
+    settings: Settings,
+    acceptEncoding: str,
+    level: int,
+) -> Rewritten:
+    stats = compression.Stats()
+    start = time.perf_counter()
+    content = compression.decompressed(raw, contentEncoding, stats)
+    decoded = time.perf_counter()
+    result = rewrite(content, encoding, candidates, settings)
+    newContentEncoding = compression.chosenEncoding(acceptEncoding, level)
+    rewritten = time.perf_counter()
+    newRaw = compression.compressed(result.content, newContentEncoding, level, stats)
+    return Rewritten(
+        raw = newRaw,
+        contentEncoding = newContentEncoding,
+        injections = result.injections,
+        errors = result.errors,
+        measurements = stats.measurements(),
+        timings = {
+            metrics.STAGE_DECODE: decoded - start,
+            **result.timings,
+            metrics.STAGE_ENCODE: time.perf_counter() - rewritten,
+        },
+    )
+
+
+# `encoding` is the charset from the Content-Type header, if any.
+def rewrite(content: bytes, encoding: Optional[str], candidates: list[csp.Injection], settings: Settings) -> RewriteResult:
+    # Unless the page declares no charset at all, BeautifulSoup does not need to guess it from the entire document:
+    encoding = charset.resolve(encoding, content)
+    rewritten: Optional[RewriteResult] = None
+    if settings.rewriteEngine == A.rewrite_engine_splice:
+        rewritten = rewriteWithSplice(content, encoding, candidates, settings)
+    return rewriteWithSoup(content, encoding, candidates, settings) if rewritten is None else rewritten
+
+
+def encodedTags(injections: list[csp.Injection], encoding: str) -> tuple[bytes, bytes]:
+    return inject.encodedTags([ (i.payload, i.nonce) for i in injections ], encoding)
+
+
+def infoCommentText(injections: list[csp.Injection], settings: Settings) -> Optional[str]:
+    if not settings.listInjected:
+        return None
+    namesOfInjectedScripts = [ s.name + ("" if s.version is None else " " + T.stringifyVersion(s.version)) for i in injections for s in (i.userscript, *i.bundled) ]
+    return HTML_INFO_COMMENT_PREFIX + (
+        "No matching userscripts for this URL." if namesOfInjectedScripts == []
+        else "These scripts were inserted:\n" + T.bulletList(namesOfInjectedScripts)
+    ) + "\n"
+
+
+def rewriteWithSoup(content: bytes, encoding: Optional[str], candidates: list[csp.Injection], settings: Settings) -> RewriteResult:
+    from bs4 import BeautifulSoup, Comment
+    injections: list[csp.Injection] = []
+    errors: list[str] = []
+    start = time.perf_counter()
+    soup = BeautifulSoup(
+        content,
+        HTML_PARSER,
+        from_encoding=encoding
+    )
+    parsed = time.perf_counter()
+    for candidate in candidates:
+        result = inject.inject(inject.withNonce(candidate.payload.tag, candidate.nonce), soup)
+        if type(result) is BeautifulSoup:
+            soup = result
+            injections.append(candidate)
+        else:
+            errors.append("Injection failed due to the following error:")
+            errors.append(str(result))
+    index_DTD: Optional[int] = indexOfDTD(soup)
+    # Insert information comment:
+    infoComment = infoCommentText(injections, settings)
+    if infoComment is not None:
+        soup.insert(0 if index_DTD is None else 1+index_DTD, Comment(infoComment))
+    injected = time.perf_counter()
+    # Serialize and encode; str(soup) would turn any <meta charset> into UTF-8, which the page is not re-encoded in.
+    # BeautifulSoup drops the byte order mark, which may be all that tells the browser the charset:
+    serialized = charset.byteOrderMark(content) + soup.decode(eventual_encoding=None).encode(
+        fromOptional(soup.original_encoding, CHARSET_DEFAULT),
+        "replace"
+    )
+    return RewriteResult(
+        content = serialized,
+        injections = injections,
+        errors = errors,
+        timings = {
+            metrics.STAGE_PARSE: parsed - start,
+            metrics.STAGE_INJECT: injected - parsed,
+            metrics.STAGE_SERIALIZE: time.perf_counter() - injected,
+        },
+    )
+
+
+# Returns None if the page must be handled by the soup engine instead.
+def rewriteWithSplice(content: bytes, encoding: Optional[str], candidates: list[csp.Injection], settings: Settings) -> Optional[RewriteResult]:
+    start = time.perf_counter()
+    points = splice.insertionPointsFor(content, encoding)
+    if points is None or encoding is None:
+        return None
+    parsed = time.perf_counter()
+    (early, late) = encodedTags(candidates, encoding)
+    comment = splice.encodedComment(infoCommentText(candidates, settings), encoding)
+    injected = time.perf_counter()
+    spliced = splice.spliced(content, points, early, late, comment)
+    return RewriteResult(spliced, candidates, [], {
+        metrics.STAGE_PARSE: parsed - start, # finding the insertion points
+        metrics.STAGE_INJECT: injected - parsed, # preparing the tags
+        metrics.STAGE_SERIALIZE: time.perf_counter() - injected,
+    })
@@ -0,0 +1,222 @@
+# Due to its mitmproxy dependency, this module can only be imported by files run
+# "in" mitm[dump|proxy], e.g. not in the launcher script.
+
+import hashlib
+import json
+import re
+import threading
+import urllib.parse
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional
+
+from mitmproxy import http
+
+import modules.compression as compression
+import modules.constants as C
+import modules.csp as csp
+import modules.inject as inject
+from modules.requests import ACCEPT_ENCODING, CONTENT_ENCODING, CONTENT_TYPE, VARY
+from modules.utilities import stripIndentation
+
+# Serving userscripts that would otherwise be inlined from the proxy itself,
+# at a reserved path on the site they are injected into. Each userscript gets
+# a URL derived from a hash of what is served, so browsers can cache it
+# forever; if the userscript changes, so does the URL.
+#
+# A path on the site itself rather than a separate host is used because the
+# proxy is already intercepting that site (otherwise nothing would have been
+# injected), and because CSP and mixed-content rules are less likely to get in
+# the way of a same-origin script.
+#
+# Userscripts that are injected next to each other can also be served as one
+# bundle, so that a page with many userscripts needs only one request. A
+# bundle's URL is derived from the hashes of its parts, so it is just as
+# immutable as theirs, and it is only built when it is requested.
+#
+# A bundle is not simply the concatenation of its parts, because that would
+# change what they mean: a "use strict" at the start of one part would apply
+# to all of them (or to none), and a syntax error in one part would keep all of
+# them from running. Instead, the bundle inserts each part as an inline
+# <script> of its own, which runs right away just as if it had been served
+# separately. Such a <script> is only allowed through the site's
+# Content-Security-Policy by the bundle's own nonce, so only userscripts that
+# get a nonce are bundled.
+
+PATH_PREFIX: str = "/.userscript-proxy/"
+SUFFIX: str = ".js"
+REGEX_PATH: re.Pattern = re.compile("^" + re.escape(PATH_PREFIX) + r"([0-9a-f]{64})" + re.escape(SUFFIX) + r"(?:\?.*)?$")
+CHARSET: str = "utf-8"
+MIME_TYPE: str = "text/javascript; charset=" + CHARSET
+CACHE_CONTROL_IMMUTABLE: str = "public, max-age=31536000, immutable"
+
+CACHE_CONTROL: str = "Cache-Control"
+ETAG: str = "ETag"
+IF_NONE_MATCH: str = "If-None-Match"
+X_CONTENT_TYPE_OPTIONS: str = "X-Content-Type-Options"
+
+# Bundles are only built for sets of userscripts that have actually been injected, so these are plenty:
+MAX_BUNDLE_SETS: int = 4096
+MAX_BUNDLE_BYTES: int = 16 * 1024 * 1024
+
+
+class ServedScript(NamedTuple):
+    digest: str # of content
+    content: bytes
+    late: bool # like ScriptTag.late
+    variants: dict[str, bytes] # compressed content by content encoding, filled in as needed
+
+
+def servedScript(payloads: inject.Payloads) -> ServedScript:
+    tag = payloads.inline.tag # with the same wrapping (noframes, load listener) as if it were inlined
+    content = ("" if tag.string is None else tag.string).encode(CHARSET, "replace")
+    return ServedScript(
+        digest = hashlib.sha256(content).hexdigest(),
+        content = content,
+        late = tag.late,
+        variants = {},
+    )
+
+
+def urlFor(script: ServedScript, pageURL: str) -> str:
+    # Absolute, because a <base> element in the page would otherwise change where the browser looks for the script:
+    return urllib.parse.urljoin(pageURL, PATH_PREFIX + script.digest + SUFFIX)
+
+
+def payloadFor(script: ServedScript, pageURL: str) -> inject.Payload:
+    return inject.payloadFor(inject.ScriptTag(
+        attributes = { C.ATTRIBUTE_UP_VERSION: C.VERSION, "src": urlFor(script, pageURL) },
+        string = None,
+        late = script.late,
+    ))
+
+
+# The parts are JSON strings, which are valid JavaScript string literals. Each one is removed again once it has run, like the <script> of a served userscript would not remain in the document either.
+def bundleContent(parts: Iterable[ServedScript]) -> bytes:
+    return (stripIndentation(f"""
+        (function (parts) {{
+            const bundle = document.currentScript;
+            for (const part of parts) {{
+                const script = document.createElement("script");
+                script.nonce = bundle.nonce;
+                script.textContent = part;
+                bundle.parentNode.insertBefore(script, bundle);
+                script.remove();
+            }}
+        }})([
+        """) + ",\n".join([ json.dumps(p.content.decode(CHARSET)) for p in parts ]) + "\n]);\n").encode(CHARSET)
+
+
+class Bundles:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._parts: OrderedDict[str, tuple[ServedScript, ...]] = OrderedDict() # in document order
+        self._built: OrderedDict[str, ServedScript] = OrderedDict()
+        self._builtBytes = 0
+
+    # Returns a ServedScript without content; the content is built by get when the bundle is requested.
+    def register(self, parts: list[ServedScript]) -> ServedScript:
+        digest = hashlib.sha256(" ".join([ C.VERSION, *[ p.digest for p in parts ] ]).encode()).hexdigest()
+        with self._lock:
+            if digest in self._parts:
+                self._parts.move_to_end(digest)
+            else:
+                self._parts[digest] = tuple(parts)
+                while len(self._parts) > MAX_BUNDLE_SETS:
+                    self._parts.popitem(last=False)
+        return ServedScript(digest=digest, content=b"", late=parts[0].late, variants={})
+
+    def get(self, digest: str) -> Optional[ServedScript]:
+        with self._lock:
+            built = self._built.get(digest)
+            if built is not None:
+                self._built.move_to_end(digest)
+                return built
+            parts = self._parts.get(digest)
+            if parts is None:
+                return None
+            built = ServedScript(
+                digest = digest,
+                content = bundleContent(parts),
+                late = parts[0].late,
+                variants = {},
+            )
+            # Only the uncompressed content is counted; the compressed variants are much smaller.
+            self._built[digest] = built
+            self._builtBytes += len(built.content)
+            while self._builtBytes > MAX_BUNDLE_BYTES and len(self._built) > 1:
+                (_, evicted) = self._built.popitem(last=False)
+                self._builtBytes -= len(evicted.content)
+            return built
+
+    def clear(self) -> None:
+        with self._lock:
+            self._parts.clear()
+            self._built.clear()
+            self._builtBytes = 0
+
+
+# Replaces each run of adjacent served injections that have a nonce (None in `served` means not served) with one injection of a bundle.
+def withBundles(candidates: list[csp.Injection], served: list[Optional[ServedScript]], bundles: Bundles, pageURL: str) -> list[csp.Injection]:
+    # Early tags are inserted in reverse order (see inject.encodedTags), late ones in order, so they are grouped separately:
+    groups: list[list[tuple[csp.Injection, Optional[ServedScript]]]] = []
+    lastGroup: dict[bool, list[tuple[csp.Injection, Optional[ServedScript]]]] = {}
+    for candidate, servedOrNot in zip(candidates, served):
+        script = servedOrNot if candidate.nonce is not None else None # see the top of this module
+        late = candidate.payload.tag.late
+        previous = lastGroup.get(late)
+        if script is not None and previous is not None and previous[-1][1] is not None:
+            previous.append((candidate, script))
+        else:
+            lastGroup[late] = [(candidate, script)]
+            groups.append(lastGroup[late])
+    result: list[csp.Injection] = []
+    for group in groups:
+        if len(group) == 1:
+            result.append(group[0][0])
+            continue
+        late = group[0][0].payload.tag.late
+        parts = [ script for _, script in (group if late else reversed(group)) if script is not None ]
+        result.append(csp.Injection(
+            userscript = group[0][0].userscript,
+            nonce = csp.generateNonce(),
+            payload = payloadFor(bundles.register(parts), pageURL),
+            mode = inject.MODE_BUNDLED,
+            bundled = tuple(candidate.userscript for candidate, _ in group[1:]),
+        ))
+    return result
+
+
+def digestFromPath(path: str) -> Optional[str]:
+    match = REGEX_PATH.match(path)
+    return None if match is None else match.group(1)
+
+
+def variant(script: ServedScript, acceptEncoding: str, stats: compression.Stats) -> tuple[str, bytes]:
+    contentEncoding = compression.chosenEncoding(acceptEncoding, compression.MAX_LEVEL)
+    if contentEncoding == compression.IDENTITY:
+        return (contentEncoding, script.content)
+    raw = script.variants.get(contentEncoding)
+    if raw is None:
+        # Compressed only once per userscript, so the highest level is affordable:
+        raw = compression.compressed(script.content, contentEncoding, compression.MAX_LEVEL, stats)
+        script.variants[contentEncoding] = raw
+    return (contentEncoding, raw)
+
+
+def response(script: Optional[ServedScript], request: http.HTTPRequest, stats: compression.Stats) -> http.HTTPResponse:
+    if script is None:
+        # E.g. requested by a page that was rewritten before the userscript changed.
+        return http.HTTPResponse.make(404, b"", { CONTENT_TYPE: MIME_TYPE })
+    etag = f'W/"{script.digest}"' # weak, because the compressed variants share it
+    headers = {
+        CACHE_CONTROL: CACHE_CONTROL_IMMUTABLE,
+        ETAG: etag,
+        VARY: ACCEPT_ENCODING,
+    }
+    if script.digest in request.headers.get(IF_NONE_MATCH, ""):
+        return http.HTTPResponse.make(304, b"", headers)
+    (contentEncoding, raw) = variant(script, request.headers.get(ACCEPT_ENCODING, ""), stats)
+    served = http.HTTPResponse.make(200, raw, { **headers, CONTENT_TYPE: MIME_TYPE, X_CONTENT_TYPE_OPTIONS: "nosniff" })
+    if contentEncoding != compression.IDENTITY:
+        served.headers[CONTENT_ENCODING] = contentEncoding # after setting the content, which would otherwise be compressed again
+    return served
@@ -0,0 +1,17 @@
+from typing import NamedTuple, Optional
+
+
+# Snapshot of the options, so that handling a response does not have to look each of them up through ctx.options:
+class Settings(NamedTuple):
+    inline: bool
+    listInjected: bool
+    bypassCsp: Optional[str]
+    cspHashes: bool
+    queryParamToDisable: str
+    rewriteEngine: str
+    streamThreshold: Optional[int]
+    upstreamEncoding: Optional[str]
+    compressionLevel: int
+    lanCompressionLevel: int
+    serveUserscripts: bool
+    bundleUserscripts: bool
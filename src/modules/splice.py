@@ -0,0 +1,174 @@
+import codecs
+import re
+from typing import NamedTuple, Optional
+
+# Byte-level alternative to parsing the entire page with BeautifulSoup: We only
+# scan for the insertion points used by inject.insertEarlyIn/insertLateIn and
+# splice the prepared <script> tags in, leaving the rest of the page untouched.
+# Pages whose structure we cannot determine with confidence are not handled
+# here; the caller is expected to fall back to the soup engine.
+
+UTF8_BOM: bytes = codecs.BOM_UTF8
+ASCII_INCOMPATIBLE_ENCODING_PREFIXES: list[str] = ["utf-16", "utf-32", "utf-7"]
+ASCII_PROBE: str = "<!-- <body></body> -->"
+
+REGEXGROUP_COMMENT: str = "comment"
+REGEXGROUP_RAWTEXT: str = "rawtext"
+REGEXGROUP_RAWTEXT_NAME: str = "rawtextname"
+REGEXGROUP_DECLARATION: str = "declaration"
+REGEXGROUP_ENDTAG: str = "endtag"
+REGEXGROUP_ENDTAG_NAME: str = "endtagname"
+REGEXGROUP_STARTTAG: str = "starttag"
+REGEXGROUP_STARTTAG_NAME: str = "starttagname"
+REGEXGROUP_BODY_END: str = "bodyend"
+REGEXGROUP_UNTERMINATED: str = "unterminated"
+
+# Attribute values may contain `>`, so quoted strings must be consumed as a whole:
+REGEX_TAG_REST: bytes = rb"""(?:[^>"']|"[^"]*"|'[^']*')*>"""
+REGEX_COMMENT: bytes = rb"(?P<" + REGEXGROUP_COMMENT.encode() + rb"><!--.*?-->)"
+# Elements whose content is not markup, so a `<body` or `</body>` inside them must not be mistaken for a tag:
+RAWTEXT_ELEMENTS: bytes = rb"script|style|title|textarea|xmp|noembed|noframes"
+REGEX_RAWTEXT: bytes = (
+    rb"(?P<" + REGEXGROUP_RAWTEXT.encode() + rb"><(?P<" + REGEXGROUP_RAWTEXT_NAME.encode() + rb">" + RAWTEXT_ELEMENTS + rb")(?=[\s/>])"
+    + REGEX_TAG_REST + rb".*?</(?P=" + REGEXGROUP_RAWTEXT_NAME.encode() + rb")\s*>)"
+)
+# Must come after the complete alternatives, so that it only matches if they did not:
+REGEX_UNTERMINATED: bytes = rb"(?P<" + REGEXGROUP_UNTERMINATED.encode() + rb"><!--|<(?:" + RAWTEXT_ELEMENTS + rb")(?=[\s/>]))"
+
+REGEX_TOKEN: re.Pattern = re.compile(
+    REGEX_COMMENT + rb"|" + REGEX_RAWTEXT + rb"|" + REGEX_UNTERMINATED
+    + rb"|(?P<" + REGEXGROUP_DECLARATION.encode() + rb"><[!?][^>]*>)"
+    + rb"|(?P<" + REGEXGROUP_ENDTAG.encode() + rb"></(?P<" + REGEXGROUP_ENDTAG_NAME.encode() + rb">[a-zA-Z][^\s/>]*)[^>]*>)"
+    + rb"|(?P<" + REGEXGROUP_STARTTAG.encode() + rb"><(?P<" + REGEXGROUP_STARTTAG_NAME.encode() + rb">[a-zA-Z][^\s/>]*)" + REGEX_TAG_REST + rb")",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Only what can hide a `</body>` needs to be skipped when looking for the end of the body:
+REGEX_BODY_END: re.Pattern = re.compile(
+    REGEX_COMMENT + rb"|" + REGEX_RAWTEXT
+    + rb"|(?P<" + REGEXGROUP_BODY_END.encode() + rb"></body\s*>)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+REGEX_LEADING_DOCTYPE: re.Pattern = re.compile(
+    rb"^(?:" + re.escape(UTF8_BOM) + rb")?\s*(?:<!--.*?-->\s*)*<!doctype[^>]*>",
+    re.IGNORECASE | re.DOTALL,
+)
+
+TAG_BODY: bytes = b"body"
+TAG_TITLE: bytes = b"title"
+
+
+class InsertionPoints(NamedTuple):
+    early: int
+    late: int
+    comment: int
+
+
+def isAsciiCompatible(encoding: str) -> bool:
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return False
+    if any(map(name.startswith, ASCII_INCOMPATIBLE_ENCODING_PREFIXES)):
+        return False
+    return ASCII_PROBE.encode(name) == ASCII_PROBE.encode("ascii")
+
+
+class EarlyScan(NamedTuple):
+    bodyStart: Optional[int]
+    early: Optional[int] # first element in <body>
+    titleEnd: Optional[int]
+    bodyEnded: bool # <body> was closed before any element was found in it
+    truncated: bool # scanning stopped at an unterminated comment or raw text element
+    safeEnd: int # end of the last complete token, outside any comment or raw text element
+
+
+def scanForEarly(document: bytes) -> EarlyScan:
+    bodyStart: Optional[int] = None
+    titleEnd: Optional[int] = None
+    safeEnd: int = len(UTF8_BOM) if document.startswith(UTF8_BOM) else 0
+    for match in REGEX_TOKEN.finditer(document):
+        kind = match.lastgroup
+        if kind == REGEXGROUP_UNTERMINATED:
+            return EarlyScan(bodyStart, None, titleEnd, False, True, safeEnd)
+        if kind == REGEXGROUP_STARTTAG:
+            if bodyStart is not None:
+                return EarlyScan(bodyStart, match.start(), titleEnd, False, False, safeEnd)
+            if match.group(REGEXGROUP_STARTTAG_NAME).lower() == TAG_BODY:
+                bodyStart = match.end()
+        elif kind == REGEXGROUP_RAWTEXT:
+            if bodyStart is not None:
+                return EarlyScan(bodyStart, match.start(), titleEnd, False, False, safeEnd)
+            if titleEnd is None and match.group(REGEXGROUP_RAWTEXT_NAME).lower() == TAG_TITLE:
+                titleEnd = match.end()
+        elif kind == REGEXGROUP_ENDTAG:
+            if bodyStart is not None and match.group(REGEXGROUP_ENDTAG_NAME).lower() == TAG_BODY:
+                return EarlyScan(bodyStart, None, titleEnd, True, False, safeEnd)
+        safeEnd = match.end()
+    return EarlyScan(bodyStart, None, titleEnd, False, False, safeEnd)
+
+
+def commentInsertionPointIn(document: bytes) -> int:
+    leadingDoctype = REGEX_LEADING_DOCTYPE.match(document)
+    return (
+        leadingDoctype.end() if leadingDoctype is not None
+        else len(UTF8_BOM) if document.startswith(UTF8_BOM)
+        else 0
+    )
+
+
+# Returns None if we cannot be sure where BeautifulSoup would have inserted the tags.
+def insertionPointsIn(document: bytes) -> Optional[InsertionPoints]:
+    scan = scanForEarly(document)
+    if scan.bodyStart is None or scan.truncated:
+        # Without an explicit <body>, the parser would have to decide what goes where.
+        return None
+    early: Optional[int] = scan.early
+    if early is None:
+        # With no element in <body>, insertEarlyIn puts a tag either after
+        # <title> or before a tag inserted into <body> earlier, depending on the
+        # order of the userscripts, which one insertion point cannot express.
+        return None
+    late: Optional[int] = None
+    for match in REGEX_BODY_END.finditer(document, scan.bodyStart):
+        if match.lastgroup == REGEXGROUP_BODY_END:
+            late = match.start()
+    if late is None or late < early:
+        return None
+    return InsertionPoints(
+        early = early,
+        late = late,
+        comment = commentInsertionPointIn(document),
+    )
+
+
+def comment(text: str) -> str:
+    return f"<!--{text}-->"
+
+
+def encodedComment(infoComment: Optional[str], encoding: str) -> bytes:
+    return b"" if infoComment is None else comment(infoComment).encode(encoding, "replace")
+
+
+# Returns None if the document cannot be handled at the byte level.
+def insertionPointsFor(document: bytes, encoding: Optional[str]) -> Optional[InsertionPoints]:
+    if encoding is None or not isAsciiCompatible(encoding):
+        return None
+    return insertionPointsIn(document)
+
+
+def spliced(document: bytes, points: InsertionPoints, early: bytes, late: bytes, comment: bytes) -> bytes:
+    insertions: list[tuple[int, bytes]] = [
+        (points.comment, comment),
+        (points.early, early),
+        (points.late, late),
+    ]
+    parts: list[bytes] = []
+    previous = 0
+    for offset, insertion in insertions: # offsets are non-decreasing
+        parts.append(document[previous:offset])
+        parts.append(insertion)
+        previous = offset
+    parts.append(document[previous:])
+    return b"".join(parts)
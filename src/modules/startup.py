@@ -0,0 +1,59 @@
+import os
+import time
+from typing import Optional
+
+# Where the time goes between starting the proxy and it handling its first
+# connection. The launcher and the injector run in different processes, so the
+# launcher hands its timestamps over in environment variables; they are wall
+# clock times, while the phases measured inside the injector are durations.
+
+ENV_LAUNCHER_STARTED: str = "USERSCRIPT_PROXY_LAUNCHER_STARTED"
+ENV_MITMDUMP_STARTED: str = "USERSCRIPT_PROXY_MITMDUMP_STARTED"
+
+PHASE_LAUNCHER: str = "launcher" # parsing arguments, reading and printing rules
+PHASE_MITMPROXY: str = "mitmproxy" # starting Python and mitmdump, up to loading the injector
+PHASE_IMPORTS: str = "imports" # the injector's own imports
+PHASE_HOST_RULES: str = "host rules"
+PHASE_USERSCRIPTS: str = "userscripts"
+PHASE_WARM_UP: str = "warm-up" # see rewriting.warmUp; done in the background with --fast-start
+PHASE_OTHER: str = "other" # e.g. mitmproxy's own addons, options and certificates
+
+
+def timestampFromEnvironment(name: str) -> Optional[float]:
+    try:
+        return float(os.environ[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class Report:
+    # `importStarted` is when the injector started importing its modules.
+    def __init__(self, importStarted: float, importsDone: float) -> None:
+        self.launcherStarted = timestampFromEnvironment(ENV_LAUNCHER_STARTED)
+        self.mitmdumpStarted = timestampFromEnvironment(ENV_MITMDUMP_STARTED)
+        self.importStarted = importStarted
+        self.phases: dict[str, float] = { PHASE_IMPORTS: importsDone - importStarted }
+        if self.launcherStarted is not None and self.mitmdumpStarted is not None:
+            self.phases[PHASE_LAUNCHER] = self.mitmdumpStarted - self.launcherStarted
+        if self.mitmdumpStarted is not None:
+            self.phases[PHASE_MITMPROXY] = importStarted - self.mitmdumpStarted
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    # Without the launcher (e.g. mitmdump -s injector.py), only the time since the injector was loaded is known.
+    def summary(self, ready: float) -> str:
+        started = next(t for t in [ self.launcherStarted, self.mitmdumpStarted, self.importStarted ] if t is not None)
+        total = ready - started
+        phases = [ PHASE_LAUNCHER, PHASE_MITMPROXY, PHASE_IMPORTS, PHASE_HOST_RULES, PHASE_USERSCRIPTS, PHASE_WARM_UP ]
+        measured = { phase: self.phases[phase] for phase in phases if phase in self.phases }
+        measured[PHASE_OTHER] = max(0.0, total - sum(measured.values()))
+        return f"{total:.3f} s until the proxy was ready: " + ", ".join(f"{phase} {seconds:.3f} s" for phase, seconds in measured.items())
+
+
+def environmentForMitmdump(launcherStarted: float) -> dict[str, str]:
+    return {
+        **os.environ,
+        ENV_LAUNCHER_STARTED: str(launcherStarted),
+        ENV_MITMDUMP_STARTED: str(time.time()),
+    }
@@ -0,0 +1,137 @@
+import re
+import zlib
+from typing import Callable, Iterable, Iterator, Optional
+
+import brotli
+import zstandard
+
+import modules.splice as splice
+
+# Injection into a response body that is passed on to the client while it is
+# still being received. Only a bounded amount of data is held back at any time:
+# up to LOOKAHEAD_BYTES while looking for where the early tags should go, and up
+# to HOLD_BYTES after a </body> that may or may not be the last one.
+
+LOOKAHEAD_BYTES: int = 64 * 1024
+HOLD_BYTES: int = 64 * 1024
+MAX_START_TAG_BYTES: int = 4 * 1024
+
+REGEXGROUP_COMMENT_START: str = "commentstart"
+REGEXGROUP_RAWTEXT_START: str = "rawtextstart"
+REGEXGROUP_RAWTEXT_NAME: str = "rawtextname"
+REGEXGROUP_BODY_END: str = "bodyend"
+
+REGEX_MARKUP: re.Pattern = re.compile(
+    rb"(?P<" + REGEXGROUP_COMMENT_START.encode() + rb"><!--)"
+    + rb"|(?P<" + REGEXGROUP_RAWTEXT_START.encode() + rb"><(?P<" + REGEXGROUP_RAWTEXT_NAME.encode() + rb">" + splice.RAWTEXT_ELEMENTS + rb")(?=[\s/>])" + splice.REGEX_TAG_REST + rb")"
+    + rb"|(?P<" + REGEXGROUP_BODY_END.encode() + rb"></body\s*>)",
+    re.IGNORECASE,
+)
+REGEX_COMMENT_END: re.Pattern = re.compile(rb"-->")
+MAX_CLOSER_BYTES: int = 32 # enough for e.g. `</noframes   >`
+
+ENCODING_IDENTITY: str = "identity"
+ENCODING_GZIP: str = "gzip"
+ENCODING_BROTLI: str = "br"
+ENCODING_ZSTANDARD: str = "zstd"
+STREAMABLE_ENCODINGS: list[str] = [ ENCODING_IDENTITY, ENCODING_GZIP, ENCODING_BROTLI, ENCODING_ZSTANDARD ]
+
+
+def isStreamableEncoding(contentEncoding: str) -> bool:
+    return contentEncoding.strip().lower() in STREAMABLE_ENCODINGS + [""]
+
+
+def decoded(chunks: Iterable[bytes], contentEncoding: str) -> Iterator[bytes]:
+    encoding = contentEncoding.strip().lower()
+    decompress: Callable[[bytes], bytes]
+    flush: Callable[[], bytes] # whatever the decompressor still holds at the end of the stream
+    if encoding == ENCODING_GZIP:
+        gzipDecompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        (decompress, flush) = (gzipDecompressor.decompress, gzipDecompressor.flush)
+    elif encoding == ENCODING_BROTLI:
+        (decompress, flush) = (brotli.Decompressor().process, bytes) # process returns all output it can produce
+    elif encoding == ENCODING_ZSTANDARD:
+        zstdDecompressor = zstandard.ZstdDecompressor().decompressobj()
+        (decompress, flush) = (zstdDecompressor.decompress, zstdDecompressor.flush)
+    else:
+        yield from chunks
+        return
+    for chunk in chunks:
+        yield decompress(chunk)
+    yield flush()
+
+
+def closerFor(rawtextName: bytes) -> re.Pattern:
+    return re.compile(rb"</" + re.escape(rawtextName) + rb"\s*>", re.IGNORECASE)
+
+
+def injected(chunks: Iterable[bytes], early: bytes, late: bytes, comment: bytes) -> Iterator[bytes]:
+    iterator = iter(chunks)
+
+    # Phase 1: Find where the early tags go, like splice.insertionPointsIn, but without waiting for the entire document.
+    buffer = b""
+    insertionPoint: Optional[int] = None
+    for chunk in iterator:
+        buffer += chunk
+        scan = splice.scanForEarly(buffer)
+        if scan.early is not None:
+            insertionPoint = scan.early
+        elif scan.bodyEnded:
+            insertionPoint = scan.safeEnd if scan.titleEnd is None else scan.titleEnd
+        elif len(buffer) >= LOOKAHEAD_BYTES:
+            insertionPoint = scan.safeEnd # first safe boundary
+        if insertionPoint is not None:
+            break
+    if insertionPoint is None:
+        # The entire document fit in the lookahead buffer.
+        points = splice.insertionPointsIn(buffer)
+        if points is not None:
+            yield buffer[:points.comment] + comment + buffer[points.comment:points.early] + early + buffer[points.early:points.late] + late + buffer[points.late:]
+        else:
+            insertionPoint = splice.scanForEarly(buffer).safeEnd
+            commentPoint = min(splice.commentInsertionPointIn(buffer), insertionPoint)
+            yield buffer[:commentPoint] + comment + buffer[commentPoint:insertionPoint] + early + buffer[insertionPoint:] + late
+        return
+    commentPoint = min(splice.commentInsertionPointIn(buffer), insertionPoint)
+    yield buffer[:commentPoint] + comment + buffer[commentPoint:insertionPoint] + early
+
+    # Phase 2: Pass everything through, holding back from the last </body> seen so that the late tags can be inserted before it.
+    pending = buffer[insertionPoint:]
+    position = 0 # everything before this has been scanned
+    closer: Optional[re.Pattern] = None # set while inside a comment or raw text element
+    held: Optional[int] = None # start of the last </body> seen
+    while True:
+        while True:
+            if closer is not None:
+                match = closer.search(pending, position)
+                if match is None:
+                    position = max(position, len(pending) - MAX_CLOSER_BYTES)
+                    break
+                position = match.end()
+                closer = None
+            else:
+                match = REGEX_MARKUP.search(pending, position)
+                if match is None:
+                    lastTagStart = pending.rfind(b"<", position)
+                    position = lastTagStart if lastTagStart >= 0 and len(pending) - lastTagStart < MAX_START_TAG_BYTES else len(pending)
+                    break
+                position = match.end()
+                if match.lastgroup == REGEXGROUP_COMMENT_START:
+                    closer = REGEX_COMMENT_END
+                elif match.lastgroup == REGEXGROUP_RAWTEXT_START:
+                    closer = closerFor(match.group(REGEXGROUP_RAWTEXT_NAME))
+                else:
+                    held = match.start()
+        if held is not None and len(pending) - held > HOLD_BYTES:
+            held = None # The late tags will be appended at the end instead.
+        emittable = position if held is None else held
+        if emittable > 0:
+            yield pending[:emittable]
+            pending = pending[emittable:]
+            position -= emittable
+            held = None if held is None else held - emittable
+        nextChunk = next(iterator, None)
+        if nextChunk is None:
+            break
+        pending += nextChunk
+    yield (late + pending) if held is not None else (pending + late)
@@ -1,4 +1,8 @@
+import functools
+from typing import Callable, Iterable
+
 import modules.constants as C
+from modules.utilities import itemList
 
 description = "Inject userscripts using mitmproxy."
 
@@ -14,3 +18,8 @@ WELCOME_MESSAGE: str = "\n".join([
     "╚═" + "═" * len(INFO_MESSAGE) + "═╝",
     "",
 ])
+
+TAB: str = "    "
+LIST_ITEM_PREFIX: str = TAB + "• "
+
+bulletList: Callable[[Iterable[str]], str] = functools.partial(itemList, LIST_ITEM_PREFIX)
@@ -0,0 +1,113 @@
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Optional
+
+# One JSON line per traced web page, to find out why a particular page was
+# slow. Records are handed over to a background thread, which writes them in
+# batches and rotates the file when it gets too large, so that tracing costs
+# the proxy little more than building the records.
+
+FLUSH_INTERVAL_SECONDS: float = 1.0
+MAX_BYTES: int = 64 * 1024 * 1024 # per file
+BACKUPS: int = 3 # FILE.1 (newest) to FILE.3 (oldest)
+
+# Keys in a trace record:
+URL: str = "url"
+SIZE: str = "size" # of the body as received from the server
+ENCODING: str = "encoding"
+SCRIPTS: str = "scripts" # applicable userscripts
+INJECTIONS: str = "injections"
+SCRIPT: str = "script"
+MODE: str = "mode"
+NONCE: str = "nonce"
+HASH: str = "hash"
+CSP: str = "csp"
+OUTCOME: str = "outcome"
+MICROSECONDS: str = "us" # by stage
+TIME: str = "time" # when the response started being handled, in seconds since the epoch
+
+# Values of CSP:
+CSP_NONE: str = "none" # no Content-Security-Policy header
+CSP_ALLOWED: str = "allowed" # userscripts added to script-src
+CSP_REMOVED: str = "removed"
+CSP_KEPT: str = "kept" # left alone, maybe blocking userscripts
+
+
+class TraceWriter(threading.Thread):
+    def __init__(self, path: str) -> None:
+        super().__init__(daemon=True)
+        self.path = path
+        self._queue: queue.SimpleQueue[dict[str, Any]] = queue.SimpleQueue()
+        self._stopped = threading.Event()
+        self._fileLock = threading.Lock() # stop may flush while the thread is flushing
+
+    def write(self, record: dict[str, Any]) -> None:
+        self._queue.put(record)
+
+    def run(self) -> None:
+        while not self._stopped.wait(FLUSH_INTERVAL_SECONDS):
+            self.flush()
+
+    def flush(self) -> None:
+        lines: list[str] = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+        if len(lines) == 0:
+            return
+        try:
+            with self._fileLock:
+                with open(self.path, "a") as f:
+                    f.write("".join(lines))
+                    size = f.tell()
+                if size >= MAX_BYTES:
+                    rotate(self.path)
+        except OSError:
+            pass # Tracing must never break the proxy; records are lost until the file is writable again.
+
+    # Writes whatever is still queued.
+    def stop(self) -> None:
+        self._stopped.set()
+        self.flush()
+
+
+def rotate(path: str) -> None: # raises OSError
+    for n in range(BACKUPS - 1, 0, -1):
+        older = f"{path}.{n}"
+        if os.path.exists(older):
+            os.replace(older, f"{path}.{n + 1}")
+    os.replace(path, f"{path}.1")
+
+
+# Decides which pages to trace: one in every `sampleEvery` pages, and of those only the ones that took at least `slowSeconds`.
+class Tracer:
+    def __init__(self, writer: TraceWriter, sampleEvery: int, slowSeconds: float) -> None:
+        self.writer = writer
+        self.sampleEvery = max(1, sampleEvery)
+        self.slowSeconds = slowSeconds
+        self._counter = 0
+
+    # Returns a record to fill in, or None if this page is not sampled.
+    def begin(self, url: str) -> Optional[dict[str, Any]]:
+        self._counter += 1
+        if self._counter % self.sampleEvery != 0:
+            return None
+        return { TIME: time.time(), URL: url, MICROSECONDS: {} }
+
+    def addTimings(self, record: dict[str, Any], timings: dict[str, float]) -> None:
+        micros: dict[str, int] = record[MICROSECONDS]
+        for stage, seconds in timings.items():
+            micros[stage] = micros.get(stage, 0) + round(seconds * 1_000_000)
+
+    def end(self, record: dict[str, Any], totalSeconds: float) -> None:
+        if totalSeconds >= self.slowSeconds:
+            self.writer.write(record)
+
+    def stop(self) -> None:
+        self.writer.stop()
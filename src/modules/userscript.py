@@ -1,15 +1,15 @@
+import functools
 import re
 from string import Template
+import sys
 from typing import Callable, NamedTuple, Optional
 import warnings
 
-from urlmatch import urlmatch
-
 import modules.inline as inline
 import modules.metadata as metadata
 from modules.metadata import Metadata, Tag, Tag_boolean, Tag_string
-from modules.patterns import isIncludePattern, isMatchPattern, regexFromIncludePattern
-from modules.utilities import compose2, stripIndentation, strs
+from modules.patterns import MatchPatternMatcher, isIncludePattern, isMatchPattern, matcherMatches, matchersFromMatchPattern, normalizeMatchPattern, regexFromIncludePattern, splitURL
+from modules.utilities import stripIndentation, strs
 
 REGEX_URL: re.Pattern = re.compile(r"^https?://")
 
@@ -115,6 +115,8 @@ class Userscript(NamedTuple):
     runAt: str
     noframes: bool
     matchPatterns: list[str]
+    matchPatternMatchers: list[MatchPatternMatcher]
+    includePatterns: list[str]
     includePatternRegexes: list[re.Pattern]
     excludePatternRegexes: list[re.Pattern]
     downloadURL: Optional[str]
@@ -124,39 +126,68 @@ class Userscript(NamedTuple):
         return self.name
 
 
-def create(content: str) -> Userscript:
+# The result of the expensive part of creating a Userscript (parsing and
+# validating the metadata, scanning for unsafe sequences), consisting only of
+# JSON-compatible values so that it can be cached on disk.
+class CompiledMetadata(NamedTuple):
+    name: str
+    version: Optional[str]
+    runAt: str
+    noframes: bool
+    matchPatterns: list[str] # normalized
+    includePatterns: list[str]
+    excludePatterns: list[str]
+    downloadURL: Optional[str]
+    unsafeSequences: list[str]
+
+
+def compiledMetadata(content: str) -> CompiledMetadata:
     validMetadata: Metadata = validateMetadata(metadata.parse(metadata.extract(content)))
     valueOf = metadata.valueGetter_one(validMetadata)
     allValuesOf = metadata.valueGetter_all(validMetadata)
-    includePatternRegexes: list[re.Pattern] = list(filter(
-        lambda x: x is not None,
-        map(
-            compose2(regexFromIncludePattern_safe, str),
-            allValuesOf(tag_include)
-        )
-    ))
-    excludePatternRegexes: list[re.Pattern] = list(filter(
-        lambda x: x is not None,
-        map(
-            compose2(regexFromIncludePattern_safe, str),
-            allValuesOf(tag_exclude)
-        )
-    ))
-    return Userscript(
+    return CompiledMetadata(
         name = str(valueOf(tag_name)),
         version = None if valueOf(tag_version) is None else str(valueOf(tag_version)),
-        content = content,
         runAt = str(valueOf(tag_run_at)),
         noframes = bool(valueOf(tag_noframes)),
-        matchPatterns = strs(allValuesOf(tag_match)),
-        includePatternRegexes = includePatternRegexes,
-        excludePatternRegexes = excludePatternRegexes,
+        matchPatterns = [ normalizeMatchPattern(pattern) for pattern in strs(allValuesOf(tag_match)) ],
+        includePatterns = strs(allValuesOf(tag_include)),
+        excludePatterns = strs(allValuesOf(tag_exclude)),
         downloadURL = None if valueOf(tag_downloadURL) is None else str(valueOf(tag_downloadURL)),
         unsafeSequences = inline.unsafeSequencesIn(content),
     )
 
 
+def fromCompiled(content: str, compiled: CompiledMetadata) -> Userscript:
+    includePatternRegexes: list[re.Pattern] = [
+        regex for regex in map(regexFromIncludePattern_safe, compiled.includePatterns) if regex is not None
+    ]
+    excludePatternRegexes: list[re.Pattern] = [
+        regex for regex in map(regexFromIncludePattern_safe, compiled.excludePatterns) if regex is not None
+    ]
+    matchPatterns = [ sys.intern(pattern) for pattern in compiled.matchPatterns ]
+    return Userscript(
+        name = compiled.name,
+        version = compiled.version,
+        content = content,
+        runAt = compiled.runAt,
+        noframes = compiled.noframes,
+        matchPatterns = matchPatterns,
+        matchPatternMatchers = [ matcher for pattern in matchPatterns for matcher in matchersFromMatchPattern(pattern) ],
+        includePatterns = [ sys.intern(pattern) for pattern in compiled.includePatterns ],
+        includePatternRegexes = includePatternRegexes,
+        excludePatternRegexes = excludePatternRegexes,
+        downloadURL = compiled.downloadURL,
+        unsafeSequences = compiled.unsafeSequences,
+    )
+
+
+def create(content: str) -> Userscript:
+    return fromCompiled(content, compiledMetadata(content))
+
+
 def applicableChecker(url: str) -> Callable[[Userscript], bool]:
+    split = splitURL(url)
     def isApplicable(userscript: Userscript) -> bool:
         for regex in userscript.excludePatternRegexes:
             if regex.search(url) is not None:
@@ -164,9 +195,10 @@ def applicableChecker(url: str) -> Callable[[Userscript], bool]:
         for regex in userscript.includePatternRegexes:
             if regex.search(url) is not None:
                 return True
-        for pattern in userscript.matchPatterns:
-            if urlmatch(pattern, url):
-                return True
+        if split is not None:
+            for matcher in userscript.matchPatternMatchers:
+                if matcherMatches(matcher, split):
+                    return True
         return False
     return isApplicable
 
@@ -187,6 +219,8 @@ def withVersionSuffix(url: str, version: Optional[str]) -> str:
     return url + ("" if version is None else "?v=" + version)
 
 
+# Identical patterns are common across scripts, so each one is compiled only once:
+@functools.lru_cache(maxsize=None)
 def regexFromIncludePattern_safe(pattern: str) -> Optional[re.Pattern]:
     try:
         return regexFromIncludePattern(pattern)
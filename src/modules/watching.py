@@ -0,0 +1,129 @@
+import ctypes
+import os
+import select
+import threading
+from typing import Callable, NamedTuple, Optional
+
+# Notices when files in a directory tree change, so that they can be reloaded
+# without restarting the proxy. Uses inotify where available (via libc, so
+# Linux only) and falls back to polling the modification times otherwise.
+# Either way, what counts as a change is decided by comparing FileStates.
+
+POLL_INTERVAL_SECONDS: float = 1.0
+# With inotify, we only rescan periodically as a safety net (e.g. if a watch could not be added):
+RESCAN_INTERVAL_SECONDS: float = 60.0
+# Editors often write a file in several steps; give them some time to finish:
+SETTLE_SECONDS: float = 0.2
+
+IN_MODIFY: int = 0x00000002
+IN_ATTRIB: int = 0x00000004
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_FROM: int = 0x00000040
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_DELETE: int = 0x00000200
+IN_DELETE_SELF: int = 0x00000400
+IN_MOVE_SELF: int = 0x00000800
+INOTIFY_MASK: int = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+INOTIFY_READ_BYTES: int = 64 * 1024
+
+
+class FileState(NamedTuple):
+    mtime: int # nanoseconds
+    size: int
+
+
+def stateOf(path: str) -> FileState:
+    stat = os.stat(path)
+    return FileState(mtime=stat.st_mtime_ns, size=stat.st_size)
+
+
+def statesOf(paths: list[str]) -> dict[str, Optional[FileState]]:
+    states: dict[str, Optional[FileState]] = {}
+    for path in paths:
+        try:
+            states[path] = stateOf(path)
+        except OSError:
+            states[path] = None # e.g. deleted since it was listed
+    return states
+
+
+class Inotify:
+    def __init__(self, libc: ctypes.CDLL, fd: int) -> None:
+        self.libc = libc
+        self.fd = fd
+
+    def watchTree(self, directory: str) -> None:
+        # Adding a watch that already exists just returns the existing one, so this can be repeated to pick up new subdirectories.
+        for (dirpath, _, _) in os.walk(directory):
+            self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), INOTIFY_MASK)
+
+    # Returns True if anything happened within the timeout.
+    def wait(self, timeout: float) -> bool:
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        return len(readable) > 0
+
+    def drain(self) -> None:
+        try:
+            while os.read(self.fd, INOTIFY_READ_BYTES):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def inotify() -> Optional[Inotify]:
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (AttributeError, OSError):
+        return None # not Linux
+    return None if fd < 0 else Inotify(libc, fd)
+
+
+# Calls onChange (in the watcher thread) whenever the states of the files returned by listFiles change.
+# The files are expected to be in the trees of the given directories, which are watched with inotify.
+class Watcher:
+    def __init__(self, directories: list[str], listFiles: Callable[[], list[str]], onChange: Callable[[], None]) -> None:
+        self.directories = directories
+        self.listFiles = listFiles
+        self.onChange = onChange
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.usesInotify = False
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def run(self) -> None:
+        notifier = inotify()
+        self.usesInotify = notifier is not None
+        states = statesOf(self.listFiles())
+        try:
+            while not self.stopping.is_set():
+                if notifier is None:
+                    self.stopping.wait(POLL_INTERVAL_SECONDS)
+                else:
+                    for directory in self.directories:
+                        notifier.watchTree(directory)
+                    waited = 0.0
+                    while not self.stopping.is_set() and waited < RESCAN_INTERVAL_SECONDS:
+                        if notifier.wait(POLL_INTERVAL_SECONDS):
+                            self.stopping.wait(SETTLE_SECONDS)
+                            notifier.drain()
+                            break
+                        waited += POLL_INTERVAL_SECONDS
+                if self.stopping.is_set():
+                    break
+                current = statesOf(self.listFiles())
+                if current != states:
+                    states = current
+                    self.onChange()
+        finally:
+            if notifier is not None:
+                notifier.close()
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+# A pool of threads or processes with a bounded number of pending jobs, so that
+# a burst of large pages cannot pile up unboundedly. When the pool is full,
+# the caller is expected to handle the job some other way.
+
+KIND_THREAD: str = "thread"
+KIND_PROCESS: str = "process"
+
+
+class WorkerPool:
+    def __init__(self, kind: str, workers: int, maxPending: int) -> None:
+        self.kind = kind
+        self.workers = workers
+        self.maxPending = maxPending
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = self._newExecutor()
+
+    def _newExecutor(self) -> Executor:
+        return ProcessPoolExecutor(max_workers=self.workers) if self.kind == KIND_PROCESS else ThreadPoolExecutor(max_workers=self.workers)
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._pending
+
+    # Returns None if there are already maxPending jobs. For a process pool, fn and its arguments must be picklable.
+    def trySubmit(self, fn: Callable[[], Any]) -> Optional[Future]:
+        with self._lock:
+            if self._pending >= self.maxPending:
+                return None
+            self._pending += 1
+            try:
+                try:
+                    future = self._executor.submit(fn)
+                except BrokenProcessPool:
+                    # A worker process died (e.g. killed by the OOM killer); start over with a fresh pool.
+                    self._executor = self._newExecutor()
+                    future = self._executor.submit(fn)
+            except BaseException:
+                self._pending -= 1
+                raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _: Future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -1,11 +1,16 @@
+import json
 import os
+import re
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Optional
+from typing import Any, Optional
+
+import modules.metrics as metrics
 
 HOST = os.environ.get("RESTART_CONTROL_HOST", "0.0.0.0")
 PORT = int(os.environ.get("RESTART_CONTROL_PORT", "8765"))
@@ -13,35 +18,146 @@ RESTART_PATH = os.environ.get("RESTART_CONTROL_PATH", "/internal/restart")
 SHUTDOWN_TIMEOUT_SECONDS = float(
     os.environ.get("RESTART_CONTROL_SHUTDOWN_TIMEOUT_SECONDS", "10")
 )
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), "userscript-proxy-metrics")
+)
+
+WORKERS = max(1, int(os.environ.get("PROXY_WORKERS", "1")))
+HEARTBEAT_DIR = os.environ.get(
+    "HEARTBEAT_DIR",
+    os.path.join(tempfile.gettempdir(), "userscript-proxy-heartbeats"),
+)
+# Only files named like this are removed from HEARTBEAT_DIR, which may be shared with other things:
+HEARTBEAT_FILE_NAME = re.compile(r"worker-\d+-\d+")
+HEARTBEAT_TIMEOUT_SECONDS = float(
+    os.environ.get("PROXY_WORKER_HEARTBEAT_TIMEOUT_SECONDS", "30")
+)
+STARTUP_TIMEOUT_SECONDS = float(
+    os.environ.get("PROXY_WORKER_STARTUP_TIMEOUT_SECONDS", "120")
+)
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("PROXY_DRAIN_TIMEOUT_SECONDS", "30"))
+HEALTH_CHECK_INTERVAL_SECONDS = 1.0
+
+LAUNCHER_COMMAND = [
+    sys.executable,
+    "-u",
+    "src/launcher.py",
+    "--metrics-dir",
+    METRICS_DIR,
+    *sys.argv[1:],
+]
+
+
+# One process for a worker slot; a restart replaces it with the next generation.
+class Worker:
+    def __init__(self, number: int, generation: int = 1) -> None:
+        self.number = number
+        self.generation = generation
+        self.process: Optional[subprocess.Popen[str]] = None
+        self.started_at = 0.0  # wall-clock time, like the heartbeat file's
+        self.heartbeat_path = os.path.join(
+            HEARTBEAT_DIR, f"worker-{number}-{generation}"
+        )
+        # Replacements run next to the process they replace, so each generation writes its own snapshot:
+        self.metrics_name = f"worker-{number}-{generation}"
+
+    @property
+    def name(self) -> str:
+        return "Child" if WORKERS == 1 else f"Worker {self.number}"
+
+    def command(self) -> list[str]:
+        # Workers always share the port, so that a replacement can start listening before the process it replaces stops:
+        return [
+            *LAUNCHER_COMMAND,
+            "--heartbeat-file",
+            self.heartbeat_path,
+            "--metrics-name",
+            self.metrics_name,
+            "--worker",
+            str(self.number),
+        ]
+
+    # Whether the proxy has come up since the worker was (re)started; the heartbeat file is removed before that.
+    def is_ready(self) -> bool:
+        return self.last_heartbeat() is not None
+
+    def forget_heartbeat(self) -> None:
+        try:
+            os.unlink(self.heartbeat_path)
+        except FileNotFoundError:
+            pass
 
-LAUNCHER_COMMAND = [sys.executable, "-u", "src/launcher.py", *sys.argv[1:]]
+    def last_heartbeat(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.heartbeat_path)
+        except OSError:
+            return None
+
+    # Returns why the worker must be restarted, if it must.
+    def problem(self) -> Optional[str]:
+        process = self.process
+        if process is None:
+            return "is not running"
+
+        return_code = process.poll()
+        if return_code is not None:
+            return f"exited unexpectedly with code {return_code}"
+
+        now = time.time()
+        last_heartbeat = self.last_heartbeat()
+        if last_heartbeat is None:
+            if now - self.started_at > STARTUP_TIMEOUT_SECONDS:
+                return f"did not start within {STARTUP_TIMEOUT_SECONDS:g} seconds"
+        elif now - last_heartbeat > HEARTBEAT_TIMEOUT_SECONDS:
+            return f"has not responded for {HEARTBEAT_TIMEOUT_SECONDS:g} seconds"
+
+        return None
 
 
 class LauncherSupervisor:
-    def __init__(self) -> None:
+    def __init__(self, worker_count: int) -> None:
         self._lock = threading.RLock()
-        self._process: Optional[subprocess.Popen[str]] = None
+        self._workers = [Worker(number) for number in range(1, worker_count + 1)]
         self._stopping = False
         self._restart_in_progress = False
+        # Held while workers are being restarted, whether on request or by the health check:
+        self._restart_lock = threading.Lock()
+        self._last_restart: Optional[dict[str, Any]] = None
+        # Replacements still starting and old processes still draining, which must be stopped on shutdown too:
+        self._changing: list[Worker] = []
 
-    def start_child(self) -> None:
+    def start_children(self) -> None:
+        for worker in self._workers:
+            self.start_child(worker)
+
+    def start_child(self, worker: Worker) -> None:
         with self._lock:
             if self._stopping:
                 return
 
-            if self._process is not None and self._process.poll() is None:
+            if worker.process is not None and worker.process.poll() is None:
                 return
 
-            print(f"Starting child process: {LAUNCHER_COMMAND}", flush=True)
-            self._process = subprocess.Popen(
-                LAUNCHER_COMMAND,
+            command = worker.command()
+            print(f"Starting {worker.name.lower()} process: {command}", flush=True)
+            worker.forget_heartbeat()
+            worker.started_at = time.time()
+            worker.process = subprocess.Popen(
+                command,
                 stdout=None,
                 stderr=None,
                 text=True,
                 start_new_session=True,
             )
 
-    def restart_child(self) -> None:
+    # Replaces one worker at a time: the replacement is started next to the old
+    # process and only takes over once it is up, and the old process is then
+    # given time to finish its open connections, so the port always has a
+    # listener. Connections still waiting to be accepted by the old process when
+    # it stops listening are reset by Linux, unless net.ipv4.tcp_migrate_req is
+    # set, which hands them to the replacement instead.
+    def restart_children(self) -> None:
         with self._lock:
             if self._stopping:
                 return
@@ -55,68 +171,178 @@ class LauncherSupervisor:
 
             self._restart_in_progress = True
 
+        started = time.monotonic()
+        reports: list[dict[str, Any]] = []
         try:
-            self._stop_child()
-            self.start_child()
+            with self._restart_lock:
+                for index in range(len(self._workers)):
+                    reports.append(self._replace_child(index))
         finally:
             with self._lock:
                 self._restart_in_progress = False
+                self._last_restart = {
+                    "ok": len(reports) == len(self._workers)
+                    and all(report["ok"] for report in reports),
+                    "finished_at": time.time(),
+                    "seconds": round(time.monotonic() - started, 3),
+                    "workers": reports,
+                }
+
+    def restart_status(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "in_progress": self._restart_in_progress,
+                "last_restart": self._last_restart,
+            }
 
     def begin_shutdown(self) -> None:
         with self._lock:
             self._stopping = True
-
-        self._stop_child()
+            workers = self._workers + [
+                worker for worker in self._changing if worker not in self._workers
+            ]
+
+        stoppers = [
+            threading.Thread(target=self._stop_child, args=(worker,), daemon=True)
+            for worker in workers
+        ]
+        for stopper in stoppers:
+            stopper.start()
+        for stopper in stoppers:
+            stopper.join()
 
     def is_running(self) -> bool:
         with self._lock:
-            return self._process is not None and self._process.poll() is None
+            return any(
+                worker.process is not None and worker.process.poll() is None
+                for worker in self._workers
+            )
 
-    def wait_forever(self) -> None:
+    # Restarts each worker that has exited or stopped responding, on its own.
+    def monitor_forever(self) -> None:
         while True:
+            time.sleep(HEALTH_CHECK_INTERVAL_SECONDS)
+
             with self._lock:
                 if self._stopping:
                     return
-                process = self._process
 
-            if process is None:
-                time.sleep(0.2)
-                continue
+            if not self._restart_lock.acquire(blocking=False):
+                continue  # The workers are being restarted anyway.
+
+            try:
+                for worker in self._workers:
+                    problem = worker.problem()
+                    with self._lock:
+                        if self._stopping:
+                            return
+                    if problem is None:
+                        continue
+
+                    print(f"{worker.name} {problem}; restarting.", flush=True)
+                    self._stop_child(worker)
+                    self.start_child(worker)
+            finally:
+                self._restart_lock.release()
 
-            return_code = process.wait()
+    def _replace_child(self, index: int) -> dict[str, Any]:
+        with self._lock:
+            old = self._workers[index]
+            replacement = Worker(old.number, old.generation + 1)
+            self._changing += [old, replacement]
 
+        try:
+            return self._hand_over(index, old, replacement)
+        finally:
             with self._lock:
-                if self._stopping:
-                    print(
-                        f"Child exited during shutdown with code {return_code}.",
-                        flush=True,
-                    )
-                    return
+                self._changing.remove(old)
+                self._changing.remove(replacement)
+
+    def _hand_over(self, index: int, old: Worker, replacement: Worker) -> dict[str, Any]:
+        started = time.monotonic()
+        self.start_child(replacement)
+        ready = self._wait_until_ready(replacement)
+        startup_seconds = round(time.monotonic() - started, 3)
+        if not ready:
+            # The old process keeps serving, e.g. if the new configuration is broken.
+            print(
+                f"Replacement for {old.name.lower()} did not come up; keeping the old process.",
+                flush=True,
+            )
+            self._stop_child(replacement)
+            replacement.forget_heartbeat()
+            return {
+                "worker": old.number,
+                "ok": False,
+                "startup_seconds": startup_seconds,
+            }
 
-                print(
-                    f"Child exited unexpectedly with code {return_code}; restarting.",
-                    flush=True,
-                )
-                self._process = None
+        with self._lock:
+            self._workers[index] = replacement
+        handover_started = time.monotonic()
+        self._drain_child(old)
+        old.forget_heartbeat()
+        handover_seconds = round(time.monotonic() - handover_started, 3)
+        print(
+            f"{old.name} replaced (startup: {startup_seconds:g} s, handover: {handover_seconds:g} s).",
+            flush=True,
+        )
+        return {
+            "worker": old.number,
+            "ok": True,
+            "startup_seconds": startup_seconds,
+            "handover_seconds": handover_seconds,
+        }
+
+    def _wait_until_ready(self, worker: Worker) -> bool:
+        deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+        while time.time() < deadline:
+            process = worker.process
+            if process is None or process.poll() is not None:
+                return False
+
+            if worker.is_ready():
+                return True
+
+            time.sleep(0.1)
+
+        return False
+
+    # Asks the process to stop accepting connections and to exit once the open ones are closed (see the launcher), and stops it if that takes too long.
+    def _drain_child(self, worker: Worker) -> None:
+        with self._lock:
+            process = worker.process
+
+        if process is None:
+            return
+
+        print(f"Draining old {worker.name.lower()} process.", flush=True)
+        try:
+            os.kill(process.pid, signal.SIGUSR1)
+            process.wait(timeout=DRAIN_TIMEOUT_SECONDS)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            print(
+                f"Old {worker.name.lower()} process still has open connections after {DRAIN_TIMEOUT_SECONDS:g} seconds.",
+                flush=True,
+            )
 
-            time.sleep(1.0)
-            self.start_child()
+        self._stop_child(worker)
 
-    def _stop_child(self) -> None:
+    def _stop_child(self, worker: Worker) -> None:
         with self._lock:
-            process = self._process
+            process = worker.process
 
         if process is None:
             return
 
         if process.poll() is not None:
-            with self._lock:
-                if self._process is process:
-                    self._process = None
+            self._forget_process(worker, process)
             return
 
         print("", flush=True)
-        print("Stopping child process group.", flush=True)
+        print(f"Stopping {worker.name.lower()} process group.", flush=True)
         print("", flush=True)
 
         try:
@@ -126,32 +352,70 @@ class LauncherSupervisor:
 
         try:
             process.wait(timeout=SHUTDOWN_TIMEOUT_SECONDS)
-            print("Child process group stopped cleanly.", flush=True)
+            print(f"{worker.name} process group stopped cleanly.", flush=True)
         except subprocess.TimeoutExpired:
-            print("Child did not stop in time; killing process group.", flush=True)
+            print(
+                f"{worker.name} did not stop in time; killing process group.",
+                flush=True,
+            )
             try:
                 os.killpg(process.pid, signal.SIGKILL)
             except ProcessLookupError:
                 pass
             process.wait()
 
+        self._forget_process(worker, process)
+
+    def _forget_process(self, worker: Worker, process: subprocess.Popen[str]) -> None:
         with self._lock:
-            if self._process is process:
-                self._process = None
+            if worker.process is process:
+                worker.process = None
+        retire_metrics(worker)
 
 
-supervisor = LauncherSupervisor()
+supervisor = LauncherSupervisor(WORKERS)
 shutdown_started = False
 shutdown_lock = threading.Lock()
+# Held while the metrics are read or a snapshot is retired, so that nobody sees a process counted twice or not at all:
+metrics_lock = threading.Lock()
+
+
+# Keeps what a process that has exited recorded, so that counters do not go down when it is replaced.
+def retire_metrics(worker: Worker) -> None:
+    with metrics_lock:
+        try:
+            metrics.retireSnapshot(METRICS_DIR, worker.metrics_name)
+        except OSError as e:
+            print(f"Could not keep the metrics of {worker.name.lower()}: {e}", flush=True)
 
 
 class ControlHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path == RESTART_PATH:
+            # How the last restart went, including how long each worker took to start and to hand over:
+            self._send_json(200, json.dumps(supervisor.restart_status()).encode())
+            return
+
+        if self.path != METRICS_PATH:
+            self._send_not_found()
+            return
+
+        # Every mitmdump process writes its own snapshot; they are added up here.
+        with metrics_lock:
+            snapshots = metrics.readSnapshots(METRICS_DIR)
+        body = metrics.render(snapshots).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_POST(self) -> None:
         if self.path != RESTART_PATH:
             self._send_not_found()
             return
 
-        threading.Thread(target=supervisor.restart_child, daemon=True).start()
+        threading.Thread(target=supervisor.restart_children, daemon=True).start()
         self._send_json(202, b'{"ok":true,"message":"Restart requested."}')
 
     def log_message(self, format: str, *args: object) -> None:
@@ -193,14 +457,35 @@ def install_signal_handlers(server: ThreadingHTTPServer) -> None:
     signal.signal(signal.SIGINT, handle_shutdown)
 
 
+# Heartbeat files left by an earlier run would make its workers look alive.
+def remove_heartbeat_files() -> None:
+    for name in os.listdir(HEARTBEAT_DIR):
+        if HEARTBEAT_FILE_NAME.fullmatch(name) is None:
+            continue
+        try:
+            os.unlink(os.path.join(HEARTBEAT_DIR, name))
+        except (FileNotFoundError, IsADirectoryError):
+            pass
+
+
 def main() -> int:
-    supervisor.start_child()
+    # Snapshots left by an earlier run would be counted along with the new ones:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    metrics.removeSnapshots(METRICS_DIR)
+
+    os.makedirs(HEARTBEAT_DIR, exist_ok=True)
+    remove_heartbeat_files()
+
+    supervisor.start_children()
+    threading.Thread(target=supervisor.monitor_forever, daemon=True).start()
 
     server = ThreadingHTTPServer((HOST, PORT), ControlHandler)
     install_signal_handlers(server)
 
     print(f"Control server listening on http://{HOST}:{PORT}", flush=True)
     print(f"Restart endpoint: {RESTART_PATH}", flush=True)
+    print(f"Metrics endpoint: {METRICS_PATH}", flush=True)
+    print(f"Proxy workers: {WORKERS}", flush=True)
 
     try:
         server.serve_forever()
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import modules.matching as matching
+import modules.userscript as userscript
+from modules.userscript import Userscript
+
+
+def scriptWith(*directives: str) -> Userscript:
+    return userscript.create("\n".join([
+        "// ==UserScript==",
+        "// @name Test",
+        *[ f"// {directive}" for directive in directives ],
+        "// ==/UserScript==",
+    ]) + "\n")
+
+
+class TestLookup(unittest.TestCase):
+    def assertCandidate(self, script: Userscript, url: str) -> None:
+        self.assertTrue(userscript.applicableChecker(url)(script), url)
+        self.assertEqual(matching.lookup(matching.index([script]), url), [script], url)
+
+    def test_match_pattern_with_port(self) -> None:
+        self.assertCandidate(scriptWith("@match http://example.com:8080/*"), "http://example.com:8080/page")
+
+    def test_match_pattern_with_port_and_subdomains(self) -> None:
+        self.assertCandidate(scriptWith("@match *://*.example.com:8443/*"), "https://www.example.com:8443/")
+
+    def test_include_pattern_with_port(self) -> None:
+        self.assertCandidate(scriptWith("@include http://example.com:8080/*"), "http://example.com:8080/page")
+
+    def test_other_hosts_are_not_candidates(self) -> None:
+        script = scriptWith("@match http://example.com:8080/*")
+        self.assertEqual(matching.lookup(matching.index([script]), "http://example.org:8080/page"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
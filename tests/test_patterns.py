@@ -0,0 +1,85 @@
+import itertools
+import os
+import random
+import sys
+import unittest
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from urlmatch import BadMatchPattern, urlmatch
+
+from modules.patterns import REGEX_MATCH_ALL, matcherMatches, matchersFromMatchPattern, normalizeMatchPattern, splitURL
+
+# The matchers built by matchersFromMatchPattern must behave exactly like
+# urlmatch, which they replace, so they are compared with it on every
+# combination of these building blocks.
+
+PATTERN_SCHEMES: list[str] = [ "*", "http", "https", "file", "ftp" ]
+PATTERN_HOSTS: list[str] = [
+    "*", "", "example.com", "*.example.com", "EXAMPLE.com", "example.com:8080", "*.example.com:8080",
+    "user@example.com", "user:pw@example.com", "ex*ample.com", "*example.com", "127.0.0.1", "[::1]:8080",
+]
+PATTERN_PATHS: list[str] = [ "/*", "/", "", "/a/*", "/a*b", "/a?b=*", "/*.html", "/a/b", "/A/*" ]
+
+URL_SCHEMES: list[str] = [ "http", "https", "file", "ftp" ]
+URL_HOSTS: list[str] = [
+    "", "example.com", "www.example.com", "a.b.example.com", "EXAMPLE.COM", "example.com:8080", "example.com:80",
+    "www.example.com:8080", "user@example.com", "user:pw@example.com", "user@www.example.com", "u.x:pw@example.com",
+    "evil-example.com", "notexample.com", "example.com.evil.org", "127.0.0.1", "[::1]:8080",
+]
+URL_PATHS: list[str] = [ "/", "", "/a", "/a/", "/a/b", "/ab", "/axb", "/a?b=c", "/x.html", "/x.html?y", "/a#b", "/A/b" ]
+
+RANDOM_SEED: int = 0
+COMBINED_PATTERNS: int = 100
+
+
+def patterns() -> list[str]:
+    return [ REGEX_MATCH_ALL ] + [ f"{scheme}://{host}{path}" for scheme, host, path in itertools.product(PATTERN_SCHEMES, PATTERN_HOSTS, PATTERN_PATHS) ]
+
+
+def urls() -> list[str]:
+    return [ f"{scheme}://{host}{path}" for scheme, host, path in itertools.product(URL_SCHEMES, URL_HOSTS, URL_PATHS) ]
+
+
+def matchersMatch(pattern: str, url: str) -> bool:
+    split = splitURL(url)
+    return split is not None and any(matcherMatches(matcher, split) for matcher in matchersFromMatchPattern(normalizeMatchPattern(pattern)))
+
+
+# None if urlmatch rejects the pattern.
+def urlmatchMatches(pattern: str, url: str) -> Optional[bool]:
+    try:
+        return urlmatch(normalizeMatchPattern(pattern), url)
+    except BadMatchPattern:
+        return None
+
+
+class TestMatchersAgainstUrlmatch(unittest.TestCase):
+    def assertSameAsUrlmatch(self, pattern: str, testedURLs: list[str]) -> None:
+        for url in testedURLs:
+            expected = urlmatchMatches(pattern, url)
+            if expected is None:
+                return # see test_rejected_patterns
+            self.assertEqual(matchersMatch(pattern, url), expected, f"{pattern} on {url}")
+
+    def test_single_patterns(self) -> None:
+        testedURLs = urls()
+        for pattern in patterns():
+            self.assertSameAsUrlmatch(pattern, testedURLs)
+
+    def test_comma_separated_patterns(self) -> None:
+        generator = random.Random(RANDOM_SEED)
+        valid = [ p for p in patterns() if urlmatchMatches(p, "http://example.com/") is not None ]
+        testedURLs = urls()
+        for _ in range(COMBINED_PATTERNS):
+            self.assertSameAsUrlmatch(",".join(generator.sample(valid, 2)), testedURLs)
+
+    def test_rejected_patterns(self) -> None:
+        for pattern in patterns():
+            if urlmatchMatches(pattern, "http://example.com/") is None:
+                self.assertEqual(matchersFromMatchPattern(normalizeMatchPattern(pattern)), [], pattern)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from bs4 import BeautifulSoup
+
+import modules.arguments as A
+import modules.csp as csp
+import modules.inject as inject
+import modules.rewriting as rewriting
+import modules.splice as splice
+import modules.userscript as userscript
+from modules.settings import Settings
+
+# The splice engine must insert the userscripts exactly where the soup engine
+# would, so both are run on the same documents with every order of early and
+# late userscripts. The soup engine re-serializes the entire page, so what the
+# splice engine produces is parsed the same way before comparing.
+
+CHARSET: str = "utf-8"
+
+DOCUMENTS: list[bytes] = [
+    b"<!DOCTYPE html><html><head><title>T</title></head><body><p>Text</p></body></html>",
+    b"<!DOCTYPE html><html><head><title>x</title><script>var a='<body>';</script></head><body class='a>b'>text<!-- <p> --><h1>Hi</h1><p>x</p></body></html>",
+    b"<html><head><title>T</title></head><body></body></html>",
+    b"<html><head></head><body><div>a</div></body>\n<script>x</script></html>",
+    b"\xef\xbb\xbf<!doctype html><html><body><p>\xc3\xa5</p></body></html>",
+]
+
+RUN_AT_EARLY: str = "document-start"
+RUN_AT_LATE: str = "document-end"
+
+
+def candidate(name: str, runAt: str) -> csp.Injection:
+    script = userscript.create("\n".join([
+        "// ==UserScript==",
+        f"// @name {name}",
+        "// @match *://*/*",
+        f"// @run-at {runAt}",
+        "// ==/UserScript==",
+        f"console.log('{name}');",
+    ]))
+    return csp.Injection(
+        userscript = script,
+        nonce = None,
+        payload = inject.payloadsFor(script).inline,
+        mode = inject.MODE_INLINE,
+    )
+
+
+def settingsWith(engine: str) -> Settings:
+    return Settings(
+        inline = True,
+        listInjected = True,
+        bypassCsp = None,
+        cspHashes = False,
+        queryParamToDisable = "",
+        rewriteEngine = engine,
+        streamThreshold = None,
+        upstreamEncoding = None,
+        compressionLevel = 0,
+        lanCompressionLevel = 0,
+        serveUserscripts = False,
+        bundleUserscripts = False,
+    )
+
+
+def reserialized(document: bytes) -> str:
+    return BeautifulSoup(document, rewriting.HTML_PARSER).decode()
+
+
+class TestSpliceLikeSoup(unittest.TestCase):
+    def test_every_order_of_early_and_late_userscripts(self) -> None:
+        candidates = [ candidate("A", RUN_AT_EARLY), candidate("B", RUN_AT_EARLY), candidate("C", RUN_AT_LATE), candidate("D", RUN_AT_LATE) ]
+        for document in DOCUMENTS:
+            for ordered in itertools.permutations(candidates):
+                soup = rewriting.rewrite(document, CHARSET, list(ordered), settingsWith(A.rewrite_engine_soup))
+                spliced = rewriting.rewrite(document, CHARSET, list(ordered), settingsWith(A.rewrite_engine_splice))
+                names = " ".join(c.userscript.name for c in ordered)
+                self.assertEqual(reserialized(spliced.content), reserialized(soup.content), f"{names} in {document!r}")
+
+    def test_empty_body_is_left_to_soup(self) -> None:
+        self.assertIsNone(splice.insertionPointsIn(b"<html><head><title>T</title></head><body></body></html>"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import gzip
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import brotli
+import zstandard
+
+import modules.streaming as streaming
+
+RANDOM_SEED: int = 0
+SPLITS: int = 50
+
+DOCUMENT: bytes = (
+    b"<!DOCTYPE html><html><head><title>Test</title></head><body>"
+    + b"".join(b"<p>Paragraph %d</p>" % i for i in range(5000))
+    + b"</body></html>"
+)
+
+
+# Splits `data` at random positions, including some 1-byte chunks and empty ones.
+def randomChunks(data: bytes, generator: random.Random) -> list[bytes]:
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = generator.choice([ 0, 1, 2, generator.randint(1, 100), generator.randint(1, 10000) ])
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+class TestDecoded(unittest.TestCase):
+    def assertDecodedAtAnyBoundaries(self, encoded: bytes, contentEncoding: str) -> None:
+        generator = random.Random(RANDOM_SEED)
+        for _ in range(SPLITS):
+            chunks = randomChunks(encoded, generator)
+            self.assertEqual(b"".join(streaming.decoded(chunks, contentEncoding)), DOCUMENT)
+
+    def test_gzip(self) -> None:
+        self.assertDecodedAtAnyBoundaries(gzip.compress(DOCUMENT), streaming.ENCODING_GZIP)
+
+    def test_gzip_in_one_chunk(self) -> None:
+        self.assertEqual(b"".join(streaming.decoded([ gzip.compress(DOCUMENT) ], streaming.ENCODING_GZIP)), DOCUMENT)
+
+    def test_brotli(self) -> None:
+        self.assertDecodedAtAnyBoundaries(brotli.compress(DOCUMENT), streaming.ENCODING_BROTLI)
+
+    def test_zstandard(self) -> None:
+        self.assertDecodedAtAnyBoundaries(zstandard.ZstdCompressor().compress(DOCUMENT), streaming.ENCODING_ZSTANDARD)
+
+    def test_identity(self) -> None:
+        self.assertDecodedAtAnyBoundaries(DOCUMENT, streaming.ENCODING_IDENTITY)
+
+
+class TestInjected(unittest.TestCase):
+    def test_gzip_at_any_boundaries(self) -> None:
+        generator = random.Random(RANDOM_SEED)
+        for _ in range(SPLITS):
+            chunks = randomChunks(gzip.compress(DOCUMENT), generator)
+            result = b"".join(streaming.injected(streaming.decoded(chunks, streaming.ENCODING_GZIP), b"<early>", b"<late>", b"<!--comment-->"))
+            self.assertEqual(result.replace(b"<early>", b"").replace(b"<late>", b"").replace(b"<!--comment-->", b""), DOCUMENT)
+            self.assertLess(result.index(b"<early>"), result.index(b"<p>"))
+            self.assertEqual(result.index(b"<late>"), result.rindex(b"</body>") - len(b"<late>"))
+
+
+if __name__ == "__main__":
+    unittest.main()